@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -151,6 +152,94 @@ REDIS_URL = f"{REDIS_PROTOCOL}://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
 CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = REDIS_URL
 
+# Attachment downloads have their own queue so they never occupy send workers;
+# run a worker for it: celery -A jbcast_backend worker -Q attachments
+# (the prefetch fan-out and its callback, which starts sending, stay on the default queue)
+ATT_PREFETCH_QUEUE = os.getenv("ATT_PREFETCH_QUEUE", "attachments")
+# Sent-folder (IMAP) archiving likewise: celery -A jbcast_backend worker -Q archive
+IMAP_ARCHIVE_QUEUE = os.getenv("IMAP_ARCHIVE_QUEUE", "archive")
+CELERY_TASK_ROUTES = {
+    'mailing.tasks.prefetch_attachment_urls': {'queue': ATT_PREFETCH_QUEUE},
+    'mailing.tasks.archive_sent_messages': {'queue': IMAP_ARCHIVE_QUEUE},
+}
+# Periodic tasks; run one scheduler: celery -A jbcast_backend beat
+CLAIM_SWEEP_INTERVAL = int(os.getenv("CLAIM_SWEEP_INTERVAL", "300"))  # seconds between sweeps for lost send tasks
+CELERY_BEAT_SCHEDULE = {
+    'reclaim-expired-claims': {
+        'task': 'mailing.tasks.reclaim_expired_claims',
+        'schedule': CLAIM_SWEEP_INTERVAL,
+    },
+}
+
+# Shared cache (web + workers): ingestion progress counters, etc.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'jbcast',
+    }
+}
+
+# Mailing: file ingestion
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))  # rows per bulk INSERT
+INGEST_SHARD_BYTES = int(os.getenv("INGEST_SHARD_BYTES", str(32 * 1024 * 1024)))  # CSV bytes per parallel shard
+INGEST_MAX_SHARDS = int(os.getenv("INGEST_MAX_SHARDS", "8"))
+
+# Mailing: chunked uploads
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))  # max bytes per PUT
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(1024 * 1024 * 1024)))  # max file size
+
+# Mailing: per-worker SMTP connection pool
+SMTP_POOL_MAX_MESSAGES = int(os.getenv("SMTP_POOL_MAX_MESSAGES", "100"))  # recycle a session after this many
+SMTP_POOL_IDLE_TIMEOUT = int(os.getenv("SMTP_POOL_IDLE_TIMEOUT", "60"))  # seconds before an idle session is closed
+SMTP_POOL_NOOP_AFTER = int(os.getenv("SMTP_POOL_NOOP_AFTER", "5"))  # seconds idle before a NOOP health check
+SMTP_POOL_MAX_IDLE = int(os.getenv("SMTP_POOL_MAX_IDLE", "2"))  # idle sessions kept per account
+
+# Mailing: sending
+SEND_BATCH_SIZE = int(os.getenv("SEND_BATCH_SIZE", "50"))  # records per send task (1 = one task per record)
+SEND_WINDOW_BATCHES = int(os.getenv("SEND_WINDOW_BATCHES", "20"))  # send tasks in flight per file
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "128"))  # pre-rendered subject/body pairs per worker process
+STATUS_FLUSH_RECORDS = int(os.getenv("STATUS_FLUSH_RECORDS", "100"))  # failed/deferred outcomes per bulk UPDATE (sent ones are written at once)
+STATUS_FLUSH_SECONDS = float(os.getenv("STATUS_FLUSH_SECONDS", "2"))  # max age of an unwritten failure
+CLAIM_LEASE_SECONDS = int(os.getenv("CLAIM_LEASE_SECONDS", "600"))  # a send task's hold on its records, renewed while it sends
+
+# Mailing: default per-account send limits (token buckets; 0 = no limit)
+SMTP_MAX_PER_SECOND = int(os.getenv("SMTP_MAX_PER_SECOND", "10"))
+SMTP_MAX_PER_HOUR = int(os.getenv("SMTP_MAX_PER_HOUR", "0"))
+SMTP_MAX_PER_DAY = int(os.getenv("SMTP_MAX_PER_DAY", "500"))
+SMTP_QUOTA_MAX_WAIT = float(os.getenv("SMTP_QUOTA_MAX_WAIT", "5"))  # seconds a send task waits for a token
+
+# Mailing: reaction to SMTP replies (4xx retried with jittered backoff; concurrency per account AIMD-adjusted)
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))  # attempts per record before a 4xx counts as failed
+SEND_RETRY_BASE_DELAY = int(os.getenv("SEND_RETRY_BASE_DELAY", "60"))  # seconds before the first retry, doubled per attempt
+SEND_RETRY_MAX_DELAY = int(os.getenv("SEND_RETRY_MAX_DELAY", "3600"))  # cap on the retry delay
+SMTP_CONCURRENCY_START = int(os.getenv("SMTP_CONCURRENCY_START", "4"))  # sessions per account at once, initially
+SMTP_CONCURRENCY_MIN = int(os.getenv("SMTP_CONCURRENCY_MIN", "1"))
+SMTP_CONCURRENCY_MAX = int(os.getenv("SMTP_CONCURRENCY_MAX", "10"))
+
+# Mailing: per-recipient-domain limits (sessions at once, messages per minute; 0 = no limit)
+SEND_DOMAIN_CONCURRENCY = int(os.getenv("SEND_DOMAIN_CONCURRENCY", "5"))
+SEND_DOMAIN_PER_MINUTE = int(os.getenv("SEND_DOMAIN_PER_MINUTE", "0"))
+SEND_DOMAIN_LIMITS = os.getenv("SEND_DOMAIN_LIMITS", "")  # overrides, e.g. "gmail.com=4/600,yahoo.co.jp=2/120"
+
+# Mailing: shared attachment download cache (per host, under the attachment tmp root)
+ATT_TMP_ROOT = os.getenv("ATT_TMP_ROOT", os.path.join(tempfile.gettempdir(), "jbcast_attachments"))  # temp dirs + cache
+ATT_CACHE_MAX_MB = int(os.getenv("ATT_CACHE_MAX_MB", "1024"))  # LRU-evicted beyond this size
+ATT_CACHE_REVALIDATE_SECONDS = int(os.getenv("ATT_CACHE_REVALIDATE_SECONDS", "300"))  # then ETag/Last-Modified check
+
+# Mailing: concurrent attachment downloads over a keep-alive session
+ATT_FETCH_CONCURRENCY = int(os.getenv("ATT_FETCH_CONCURRENCY", "4"))  # parallel downloads per worker process
+ATT_FETCH_PER_HOST = int(os.getenv("ATT_FETCH_PER_HOST", "2"))  # keep-alive connections per host
+ATT_FETCH_DEADLINE = int(os.getenv("ATT_FETCH_DEADLINE", "60"))  # seconds for all attachments of one email
+ATT_MIME_CACHE_MB = int(os.getenv("ATT_MIME_CACHE_MB", "128"))  # pre-encoded attachment parts kept per worker process
+
+# Mailing: Sent-folder archiving (IMAP host for accounts without their own, batching, backlog cap)
+IMAP_DEFAULT_HOST = os.getenv("IMAP_DEFAULT_HOST", "mail1014.onamae.ne.jp")
+IMAP_BATCH_SIZE = int(os.getenv("IMAP_BATCH_SIZE", "50"))  # messages appended per round over one session
+IMAP_BATCH_DELAY = int(os.getenv("IMAP_BATCH_DELAY", "5"))  # seconds sent messages accumulate before archiving
+IMAP_QUEUE_MAX = int(os.getenv("IMAP_QUEUE_MAX", "1000"))  # queued messages per account; beyond this, not archived
+IMAP_QUEUE_MAX_MB = int(os.getenv("IMAP_QUEUE_MAX_MB", "256"))  # spooled message bytes per account, likewise
+
 
 SESSION_COOKIE_AGE = 3600  # 1 hour in seconds
 
@@ -1,16 +1,28 @@
 from django.contrib import admin
-from .models import EmailFile, EmailRecord, SMTPAccount
+from .models import CampaignContent, EmailFile, EmailRecord, RejectedRow, SMTPAccount, UploadSession
+
+
+@admin.register(CampaignContent)
+class CampaignContentAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'content_hash', 'created_at')
+    search_fields = ('subject', 'content_hash')
+    readonly_fields = ('content_hash', 'created_at')
 
 
 @admin.register(EmailRecord)
 class EmailRecordAdmin(admin.ModelAdmin):
     list_display = (
-        'email', 'name', 'subject', 'is_sent',
+        'email', 'name', 'effective_subject', 'is_sent',
         'send_attempts', 'last_sent_at', 'file'
     )
     list_filter = ('is_sent', 'file', 'last_sent_at', 'created_at')
-    search_fields = ('email', 'name', 'subject', 'file__title')
-    readonly_fields = ('created_at', 'updated_at', 'last_sent_at', 'send_attempts', 'error_message')
+    list_select_related = ('file', 'content')
+    search_fields = ('email', 'name', 'domain', 'subject', 'content__subject', 'file__title')
+    raw_id_fields = ('content',)
+    readonly_fields = (
+        'domain', 'created_at', 'updated_at', 'last_sent_at', 'send_attempts', 'error_message', 'attachment_errors',
+        'claim_token', 'claimed_until', 'next_attempt_at',
+    )
 
 
 class EmailRecordInline(admin.TabularInline):
@@ -24,15 +36,33 @@ class EmailFileAdmin(admin.ModelAdmin):
     list_display = ('title', 'user', 'uploaded_at')
     list_filter = ('uploaded_at',)
     search_fields = ('title', 'user__username', 'user__email')
+    raw_id_fields = ('content',)
     inlines = [EmailRecordInline]
 
 
+@admin.register(RejectedRow)
+class RejectedRowAdmin(admin.ModelAdmin):
+    list_display = ('email', 'name', 'reason', 'row_number', 'file', 'created_at')
+    list_filter = ('reason',)
+    search_fields = ('email', 'name', 'file__title')
+    raw_id_fields = ('file',)
+
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'user', 'status', 'received_bytes', 'total_size', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('filename', 'title', 'user__username')
+    raw_id_fields = ('email_file',)
+    readonly_fields = ('id', 'sha256', 'received_bytes', 'created_at', 'updated_at')
+
+
 @admin.register(SMTPAccount)
 class SMTPAccountAdmin(admin.ModelAdmin):
     list_display = (
-        'user', 'email_host', 'email_port',
+        'user', 'email_host_user', 'email_host', 'email_port', 'is_active',
         'emails_sent_today', 'rate_limited', 'last_reset'
     )
     readonly_fields = ('last_reset', 'updated_at')
     search_fields = ('user__username', 'email_host_user', 'email_host')
-    list_filter = ('rate_limited',)
+    list_filter = ('is_active', 'rate_limited')
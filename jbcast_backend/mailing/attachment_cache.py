@@ -0,0 +1,244 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+
+from . import counters
+
+logger = get_task_logger(__name__)
+
+# -----------------------------
+# Shared attachment download cache (on disk)
+# -----------------------------
+# One entry per normalised URL (sha256 of the URL after _drive_direct_url):
+#   <key>.data  the downloaded bytes
+#   <key>.json  filename / mimetype / size / ETag / Last-Modified / fetched_at
+# Entries younger than ATT_CACHE_REVALIDATE_SECONDS are served as-is; older ones
+# are revalidated with a conditional GET (304 keeps the bytes). Files are
+# written to a temp name and os.replace()d, so readers never see partial
+# data; fetches of the same URL are serialised across worker processes with
+# flock on <key>.lock. The .json mtime is the last-use time, and the least
+# recently used entries are evicted once the cache exceeds ATT_CACHE_MAX_MB.
+# Callers hard-link the data into their own temp dir, so eviction never
+# removes a file that is about to be attached. (Empty .lock files are kept:
+# deleting one while another process holds it would break the locking.)
+
+ATT_CACHE_MAX_BYTES = int(getattr(settings, "ATT_CACHE_MAX_MB", 1024)) * 1024 * 1024
+ATT_CACHE_REVALIDATE_SECONDS = int(getattr(settings, "ATT_CACHE_REVALIDATE_SECONDS", 300))
+
+COUNTERS = ("hits", "misses", "revalidated", "stale", "evictions")
+STATS_TTL = 30 * 24 * 60 * 60  # seconds
+
+
+def _stat_key(name: str) -> str:
+    return f"mailing:attcache:{name}"
+
+
+def _count(name: str, delta: int = 1) -> None:
+    try:
+        counters.incr(_stat_key(name), delta, STATS_TTL)
+    except Exception as e:  # stats must never break a send
+        logger.debug(f"Attachment cache counter {name} not updated: {e}")
+
+
+def cache_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class AttachmentCache:
+    """
+    Content cache shared by all worker processes on a host.
+    get(url, fetch) returns {path, filename, mimetype, size} for the cached copy,
+    where fetch(url, dest_dir, extra_headers) downloads into dest_dir and returns
+    the same dict plus etag/last_modified, or None for 304 Not Modified.
+    """
+
+    def __init__(self, root: str, max_bytes: int = ATT_CACHE_MAX_BYTES,
+                 revalidate_after: int = ATT_CACHE_REVALIDATE_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        os.makedirs(root, exist_ok=True)
+
+    def _paths(self, key: str):
+        base = os.path.join(self.root, key)
+        return f"{base}.data", f"{base}.json", f"{base}.lock"
+
+    @contextmanager
+    def _flock(self, path: str, blocking: bool = True):
+        with open(path, "a") as fh:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(fh, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _read_meta(self, key: str):
+        data_path, meta_path, _ = self._paths(key)
+        try:
+            with open(meta_path) as fh:
+                meta = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(data_path):
+            return None
+        meta["path"] = data_path
+        return meta
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        _, meta_path, _ = self._paths(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".meta-")
+        with os.fdopen(fd, "w") as fh:
+            json.dump({k: v for k, v in meta.items() if k != "path"}, fh)
+        os.replace(tmp_path, meta_path)
+
+    def _touch(self, key: str) -> None:
+        try:
+            os.utime(self._paths(key)[1])
+        except FileNotFoundError:
+            pass
+
+    def _is_fresh(self, meta) -> bool:
+        return time.time() - meta.get("fetched_at", 0) < self.revalidate_after
+
+    def peek(self, url: str, not_before: float = 0):
+        """
+        The cached copy if it was fetched or revalidated at or after not_before
+        (a timestamp), without contacting the origin; None otherwise.
+        """
+        key = cache_key(url)
+        meta = self._read_meta(key)
+        if not meta or meta.get("fetched_at", 0) < not_before:
+            return None
+        self._touch(key)
+        _count("hits")
+        return meta
+
+    def get(self, url: str, fetch) -> dict:
+        key = cache_key(url)
+        meta = self._read_meta(key)
+        if meta and self._is_fresh(meta):
+            self._touch(key)
+            _count("hits")
+            return meta
+
+        data_path, _, lock_path = self._paths(key)
+        with self._flock(lock_path):
+            # Another process may have fetched it while we waited for the lock
+            meta = self._read_meta(key)
+            if meta and self._is_fresh(meta):
+                self._touch(key)
+                _count("hits")
+                return meta
+
+            headers = {}
+            if meta:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+
+            work_dir = tempfile.mkdtemp(dir=self.root, prefix=".fetch-")
+            try:
+                try:
+                    fetched = fetch(url, work_dir, headers)
+                except Exception as e:
+                    if not meta:
+                        raise
+                    # Origin unreachable: a stale copy beats failing every recipient
+                    logger.warning(f"Revalidation failed for {url}, serving cached copy: {e}")
+                    self._touch(key)
+                    _count("stale")
+                    return meta
+
+                if fetched is None:  # 304 Not Modified
+                    meta["fetched_at"] = time.time()
+                    self._write_meta(key, meta)
+                    _count("revalidated")
+                    return meta
+
+                os.replace(fetched["path"], data_path)
+                meta = {
+                    "url": url,
+                    "filename": fetched["filename"],
+                    "mimetype": fetched["mimetype"],
+                    "size": fetched["size"],
+                    "etag": fetched.get("etag"),
+                    "last_modified": fetched.get("last_modified"),
+                    "fetched_at": time.time(),
+                }
+                self._write_meta(key, meta)
+                meta["path"] = data_path
+                _count("misses")
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.evict()
+        return meta
+
+    def _entries(self) -> list:
+        """[(last_used, size, key)] for every complete entry."""
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.name.endswith(".json") or entry.name.startswith("."):
+                    continue
+                key = entry.name[:-5]
+                try:
+                    last_used = entry.stat().st_mtime
+                    size = os.path.getsize(self._paths(key)[0])
+                except FileNotFoundError:
+                    continue
+                entries.append((last_used, size, key))
+        return entries
+
+    def evict(self) -> int:
+        """Drop least recently used entries until the cache fits max_bytes. Returns entries removed."""
+        removed = 0
+        with self._flock(os.path.join(self.root, ".evict.lock"), blocking=False) as locked:
+            if not locked:
+                return 0  # another process is already evicting
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                data_path, meta_path, lock_path = self._paths(key)
+                with self._flock(lock_path, blocking=False) as entry_locked:
+                    if not entry_locked:
+                        continue  # being fetched right now
+                    for path in (meta_path, data_path):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                total -= size
+                removed += 1
+        if removed:
+            _count("evictions", removed)
+        return removed
+
+    def stats(self) -> dict:
+        """Counters (all workers) plus this host's cache size."""
+        values = cache.get_many([_stat_key(name) for name in COUNTERS])
+        out = {name: int(values.get(_stat_key(name)) or 0) for name in COUNTERS}
+        lookups = out["hits"] + out["revalidated"] + out["stale"] + out["misses"]
+        out["hit_ratio"] = round((lookups - out["misses"]) / lookups, 4) if lookups else None
+        entries = self._entries()
+        out["entries"] = len(entries)
+        out["size_bytes"] = sum(size for _, size, _ in entries)
+        out["max_bytes"] = self.max_bytes
+        return out
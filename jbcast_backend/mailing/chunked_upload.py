@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils.text import get_valid_filename
+
+# -----------------------------
+# Chunked uploads (disk side)
+# -----------------------------
+# Each UploadSession owns one partial file next to the finished uploads. A chunk
+# is copied from the request stream in small blocks (never buffered whole), and
+# the partial file is truncated to the committed offset first, so a chunk that
+# died half-way is simply overwritten by its retry.
+
+UPLOAD_CHUNK_SIZE = getattr(settings, "UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)
+UPLOAD_MAX_BYTES = getattr(settings, "UPLOAD_MAX_BYTES", 1024 * 1024 * 1024)
+COPY_BLOCK_SIZE = 256 * 1024
+
+UPLOAD_DIR = "uploads"
+
+
+def partial_path(session) -> str:
+    return os.path.join(settings.MEDIA_ROOT, UPLOAD_DIR, f".{session.id}.part")
+
+
+def write_chunk(session, stream, offset: int, length: int) -> int:
+    """
+    Copy up to `length` bytes from `stream` into the session's partial file at
+    `offset`. Returns the number of bytes actually written (less than `length`
+    if the client disconnected); the data is fsynced before returning.
+    """
+    path = partial_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "r+b" if os.path.exists(path) else "wb") as fh:
+        fh.seek(offset)
+        fh.truncate()
+        remaining = length
+        while remaining > 0:
+            block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            fh.write(block)
+            remaining -= len(block)
+        fh.flush()
+        os.fsync(fh.fileno())
+    return length - remaining
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(COPY_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def promote(session) -> str:
+    """
+    Move the verified partial file to its final place under uploads/ (same
+    filesystem, so a rename, not a copy). Returns the storage name for FileField.
+    """
+    name = default_storage.get_available_name(f"{UPLOAD_DIR}/{get_valid_filename(session.filename)}")
+    os.replace(partial_path(session), os.path.join(settings.MEDIA_ROOT, name))
+    return name
+
+
+def discard(session) -> None:
+    try:
+        os.remove(partial_path(session))
+    except FileNotFoundError:
+        pass
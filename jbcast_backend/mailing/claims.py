@@ -0,0 +1,120 @@
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import EmailRecord
+
+# -----------------------------
+# Record claims (leases)
+# -----------------------------
+# Before a send task touches a record it claims it: one conditional UPDATE sets
+# claim_token / claimed_until on the requested records that are unsent and not
+# under a live lease, so of two tasks racing for a record (bulk fan-out, a
+# single send, a second "send all") exactly one gets it. Where the database
+# supports it, the rows are first picked with SELECT ... FOR UPDATE SKIP LOCKED,
+# so concurrent claimers skip each other's rows instead of waiting; SQLite
+# serialises writers, which makes the UPDATE itself the compare-and-set.
+# The status write that records the outcome clears the claim (see
+# mailing.status_writer.STATUS_FIELDS), and only while the task still holds it;
+# records a task does not attempt are released.
+# A worker that dies leaves its lease to expire after CLAIM_LEASE_SECONDS, after
+# which the records are claimable again (the dispatcher re-checks them then, and
+# the periodic mailing.tasks.reclaim_expired_claims resumes files whose
+# dispatcher stopped).
+# A live task keeps its lease (and its session slots) by renewing it every
+# CLAIM_RENEW_SECONDS between records (Lease.keep), and stops sending as soon
+# as a renewal finds the lease gone: another task may own the records by then.
+
+CLAIM_LEASE_SECONDS = getattr(settings, "CLAIM_LEASE_SECONDS", 600)
+CLAIM_RENEW_SECONDS = CLAIM_LEASE_SECONDS / 3
+
+
+def claimable(now=None) -> Q:
+    """Unsent records without a live lease."""
+    now = now or timezone.now()
+    return Q(is_sent=False) & (Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+
+
+def claim(record_ids) -> uuid.UUID:
+    """
+    Lease the claimable records among record_ids to a new token and return it;
+    load them with EmailRecord.objects.filter(claim_token=token).
+    """
+    token = uuid.uuid4()
+    now = timezone.now()
+    lease = {'claim_token': token, 'claimed_until': now + timedelta(seconds=CLAIM_LEASE_SECONDS)}
+    candidates = EmailRecord.objects.filter(claimable(now), id__in=list(record_ids))
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            ids = list(candidates.select_for_update(skip_locked=True).values_list('id', flat=True))
+            # Re-check the condition in the UPDATE too; the row locks make it a formality
+            candidates = EmailRecord.objects.filter(claimable(now), id__in=ids)
+        candidates.update(**lease)
+    return token
+
+
+def renew(token) -> int:
+    """
+    Extend the lease on the records still claimed with token, unless it already
+    ran out (they may have been claimed again since). Returns how many were renewed.
+    """
+    now = timezone.now()
+    return EmailRecord.objects.filter(claim_token=token, claimed_until__gt=now).update(
+        claimed_until=now + timedelta(seconds=CLAIM_LEASE_SECONDS)
+    )
+
+
+def release(token, record_ids) -> None:
+    """Give back records claimed with token that were not attempted."""
+    if record_ids:
+        EmailRecord.objects.filter(claim_token=token, id__in=list(record_ids)).update(
+            claim_token=None, claimed_until=None
+        )
+
+
+def clear(record) -> None:
+    """Drop the claim in memory (persisted with the record's status fields)."""
+    record.claim_token = None
+    record.claimed_until = None
+
+
+class Lease:
+    """
+    A send task's hold on the records claimed with `token`, and on the session
+    slots (mailing.send_control) it takes while sending them. Call keep() before
+    each record: every CLAIM_RENEW_SECONDS it renews the claim and the held slots,
+    and once any of them is found gone it returns False for good.
+
+    Usage:
+        lease = Lease(claims.claim(record_ids))
+        lease.hold(renew_slot)   # a callable renewing a slot, False once lost
+        ...
+        if not lease.keep():
+            stop sending
+        ...
+        lease.drop(renew_slot)
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.lost = False
+        self._holds = []
+        self._renewed = time.monotonic()
+
+    def hold(self, renew_slot) -> None:
+        self._holds.append(renew_slot)
+
+    def drop(self, renew_slot) -> None:
+        self._holds.remove(renew_slot)
+
+    def keep(self) -> bool:
+        if self.lost or time.monotonic() - self._renewed < CLAIM_RENEW_SECONDS:
+            return not self.lost
+        self._renewed = time.monotonic()
+        self.lost = not renew(self.token) or not all(renew_slot() for renew_slot in self._holds)
+        return not self.lost
@@ -0,0 +1,18 @@
+from django.core.cache import cache
+
+# -----------------------------
+# Shared cache counters
+# -----------------------------
+# Progress and statistics counters live in the shared cache (Redis in
+# deployment) and are bumped with atomic cache.incr; a counter that expired or
+# was never set is started with cache.add instead.
+
+
+def incr(key: str, delta: int, timeout: int) -> None:
+    """Add `delta` to the counter at `key`, creating it with `timeout` if missing."""
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Missing counter: start it; if another writer just did, add to theirs
+        if not cache.add(key, delta, timeout=timeout):
+            cache.incr(key, delta)
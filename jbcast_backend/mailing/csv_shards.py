@@ -0,0 +1,120 @@
+import io
+import os
+
+# -----------------------------
+# CSV byte-range sharding
+# -----------------------------
+# A shard is a (start, end) byte range that begins and ends on a record boundary,
+# so each range can be parsed on its own once the header line is prepended.
+# Bodies may contain quoted newlines, so boundaries are only placed on a newline
+# that sits outside a quoted field (even number of '"' seen so far; an escaped
+# "" toggles twice and keeps the parity).
+
+SCAN_BLOCK_SIZE = 1024 * 1024  # 1 MB
+
+
+def _next_record_boundary(fh, pos: int, in_quotes: bool):
+    """
+    Starting at byte `pos` with the given quote state, return
+    (offset just after the first unquoted newline, quote state there),
+    or (None, state) at EOF.
+    """
+    fh.seek(pos)
+    offset = pos
+    while True:
+        block = fh.read(SCAN_BLOCK_SIZE)
+        if not block:
+            return None, in_quotes
+        start = 0
+        while True:
+            nl = block.find(b"\n", start)
+            if nl < 0:
+                in_quotes ^= block.count(b'"', start) % 2 == 1
+                break
+            in_quotes ^= block.count(b'"', start, nl) % 2 == 1
+            if not in_quotes:
+                return offset + nl + 1, in_quotes
+            start = nl + 1
+        offset += len(block)
+
+
+def plan_csv_shards(file_path: str, shard_bytes: int, max_shards: int):
+    """
+    Split a CSV file into record-aligned byte ranges of roughly `shard_bytes`.
+    Returns (header: bytes, shards: list[(start, end)]) where shards cover every
+    data row exactly once. Fewer shards are returned for small files.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as fh:
+        header_end, in_quotes = _next_record_boundary(fh, 0, False)
+        if header_end is None:
+            return b"", []
+        fh.seek(0)
+        header = fh.read(header_end)
+
+        data_bytes = size - header_end
+        if data_bytes <= 0:
+            return header, []
+        count = max(1, min(max_shards, -(-data_bytes // max(1, shard_bytes))))
+        step = data_bytes // count
+
+        shards = []
+        start = header_end
+        pos = header_end
+        for i in range(1, count):
+            target = header_end + i * step
+            if target <= start:
+                continue
+            # Quote state at `target` = state at `pos` plus the quotes in between
+            fh.seek(pos)
+            remaining = target - pos
+            while remaining > 0:
+                chunk = fh.read(min(SCAN_BLOCK_SIZE, remaining))
+                if not chunk:
+                    break
+                in_quotes ^= chunk.count(b'"') % 2 == 1
+                remaining -= len(chunk)
+            boundary, in_quotes = _next_record_boundary(fh, target, in_quotes)
+            if boundary is None or boundary >= size:
+                break
+            shards.append((start, boundary))
+            start = pos = boundary
+        shards.append((start, size))
+    return header, shards
+
+
+class CsvShardReader(io.RawIOBase):
+    """
+    Read-only binary stream over `header` followed by bytes [start, end) of a file.
+    Suitable for pd.read_csv(..., chunksize=...) without loading the shard in memory.
+    """
+
+    def __init__(self, file_path: str, header: bytes, start: int, end: int):
+        super().__init__()
+        self._fh = open(file_path, "rb")
+        self._fh.seek(start)
+        self._header = memoryview(header)
+        self._remaining = max(0, end - start)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = len(buffer)
+        if self._header:
+            take = min(n, len(self._header))
+            buffer[:take] = self._header[:take]
+            self._header = self._header[take:]
+            return take
+        if self._remaining <= 0:
+            return 0
+        data = self._fh.read(min(n, self._remaining))
+        self._remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        try:
+            self._fh.close()
+        finally:
+            super().close()
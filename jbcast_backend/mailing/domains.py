@@ -0,0 +1,71 @@
+from collections import namedtuple
+
+from django.conf import settings
+
+from . import quota, send_control
+
+# -----------------------------
+# Recipient-domain limits
+# -----------------------------
+# Big mailbox providers limit how many connections and messages per minute
+# they accept from one sender, independently of our SMTP accounts' quotas.
+# Every recipient domain gets a concurrency limit (send sessions delivering to
+# it at once, across workers and campaigns; leased slots, see
+# mailing.send_control) and a per-minute rate (token bucket, see
+# mailing.quota). SEND_DOMAIN_LIMITS overrides both per domain:
+#   "gmail.com=4/600, yahoo.co.jp=2/120"   (concurrency/per-minute)
+# either part may be left empty to keep the default; per-minute 0 = no limit.
+# The dispatcher builds windows of single-domain batches, interleaving the
+# domains and giving none more batches per window than its concurrency.
+
+Limits = namedtuple("Limits", ["concurrency", "per_minute"])
+
+SEND_DOMAIN_CONCURRENCY = max(1, int(getattr(settings, "SEND_DOMAIN_CONCURRENCY", 5)))
+SEND_DOMAIN_PER_MINUTE = int(getattr(settings, "SEND_DOMAIN_PER_MINUTE", 0))
+
+
+def _parse_limits(value) -> dict:
+    """{domain: Limits} from a SEND_DOMAIN_LIMITS string (or an already-built dict)."""
+    if isinstance(value, dict):
+        return {d.lower(): Limits(*v) for d, v in value.items()}
+    out = {}
+    for item in (value or "").split(","):
+        domain, _, spec = item.partition("=")
+        if not domain.strip():
+            continue
+        concurrency, _, per_minute = spec.partition("/")
+        out[domain.strip().lower()] = Limits(
+            max(1, int(concurrency)) if concurrency.strip() else SEND_DOMAIN_CONCURRENCY,
+            int(per_minute) if per_minute.strip() else SEND_DOMAIN_PER_MINUTE,
+        )
+    return out
+
+
+SEND_DOMAIN_LIMITS = _parse_limits(getattr(settings, "SEND_DOMAIN_LIMITS", ""))
+
+
+def limits_for(domain: str) -> Limits:
+    return SEND_DOMAIN_LIMITS.get(domain) or Limits(SEND_DOMAIN_CONCURRENCY, SEND_DOMAIN_PER_MINUTE)
+
+
+def take_tokens(domain: str, requested: int = 1) -> quota.Grant:
+    """Up to `requested` messages' worth of the domain's rate; take_tokens(domain, 0) only reports."""
+    return quota.acquire_domain(domain, limits_for(domain).per_minute, requested)
+
+
+def give_back_tokens(domain: str, count: int) -> None:
+    """Return rate taken with take_tokens() for messages that were not sent."""
+    quota.refund_domain(domain, limits_for(domain).per_minute, count)
+
+
+def acquire_slot(domain: str):
+    """A slot token if the domain is below its concurrency limit, else None."""
+    return send_control.acquire_domain_slot(domain, limits_for(domain).concurrency)
+
+
+def renew_slot(domain: str, token) -> bool:
+    return send_control.renew_domain_slot(domain, token)
+
+
+def release_slot(domain: str, token) -> None:
+    send_control.release_domain_slot(domain, token)
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mailing.models import CampaignContent, EmailFile, EmailRecord
+
+
+def _matching(queryset, subject, body):
+    """Filter on an exact subject/body pair, treating NULL as a value."""
+    filters = {}
+    for field, value in (("subject", subject), ("body", body)):
+        if value is None:
+            filters[f"{field}__isnull"] = True
+        else:
+            filters[field] = value
+    return queryset.filter(**filters)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move per-record subject/body copies into shared CampaignContent rows. "
+        "Records ingested before content deduplication get a content reference "
+        "and their own subject/body cleared; safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", type=int, action="append", dest="files",
+                            help="Only backfill this EmailFile ID (repeatable)")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+
+    def handle(self, *args, **options):
+        files = EmailFile.objects.order_by("id")
+        if options["files"]:
+            files = files.filter(id__in=options["files"])
+
+        total_records = 0
+        for email_file in files.iterator():
+            pending = EmailRecord.objects.filter(file=email_file, content__isnull=True)
+            if not pending.exists():
+                continue
+
+            # One UPDATE per distinct subject/body combination in the file
+            combos = list(pending.values_list("subject", "body").distinct())
+            first = pending.order_by("id").values_list("subject", "body").first()
+            updated = 0
+            with transaction.atomic():
+                for subject, body in combos:
+                    rows = _matching(pending, subject, body)
+                    if options["dry_run"]:
+                        updated += rows.count()
+                        continue
+                    content = CampaignContent.intern(subject or "", body or "")
+                    updated += rows.update(content=content, subject=None, body=None)
+
+                if not options["dry_run"] and email_file.content_id is None and first:
+                    email_file.content = CampaignContent.intern(first[0] or "", first[1] or "")
+                    email_file.save(update_fields=["content"])
+
+            total_records += updated
+            self.stdout.write(f"File {email_file.id}: {updated} records -> {len(combos)} shared content row(s)")
+
+        verb = "Would update" if options["dry_run"] else "Updated"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {total_records} records."))
@@ -0,0 +1,90 @@
+import random
+import time
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand
+
+from mailing.models import EmailRecord
+from mailing.tasks import (
+    _drive_direct_url,
+    _normalize_attachments,
+    _normalize_attachments_column,
+)
+
+
+# (cell, weight): roughly the mix seen in real contact sheets
+SAMPLE_CELLS = [
+    (None, 40),
+    ("", 10),
+    ("https://example.com/brochure.pdf", 30),
+    ("https://example.com/a.pdf; https://example.com/b.pdf", 10),
+    ("https://drive.google.com/file/d/1AbCdEfGhIjK/view?usp=sharing", 6),
+    ("https://drive.google.com/open?id=1ZyXwVuTsR\nhttps://example.com/c.docx", 2),
+    ("ftp://example.com/ignored.zip, https://example.com/d.png", 2),
+]
+
+
+def _legacy_attachments_list(value):
+    """The pre-validation read path: urlparse every URL on each serialization/send."""
+    if not value:
+        return []
+    out = []
+    for u in (u.strip() for u in value.split(',')):
+        if not u:
+            continue
+        try:
+            if urlparse(u).scheme in ("http", "https"):
+                out.append(u)
+        except Exception:
+            continue
+    return out
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark attachment URL handling: _normalize_attachments_column at ingest, "
+        "and the read path used by the serializer and send_email_record before and after "
+        "Drive links were rewritten at ingest."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100_000, help="Number of synthetic cells")
+        parser.add_argument("--batch", type=int, default=1000, help="Ingest batch size")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def _report(self, label, legacy_s, new_s, rows):
+        self.stdout.write(f"[{label}]")
+        self.stdout.write(f"  before: {legacy_s:.3f}s ({rows / legacy_s:,.0f} rows/sec)")
+        self.stdout.write(f"  after:  {new_s:.3f}s ({rows / new_s:,.0f} rows/sec)")
+        self.stdout.write(self.style.SUCCESS(f"  speed-up: {legacy_s / new_s:.1f}x"))
+
+    def handle(self, *args, **options):
+        rows, batch = options["rows"], max(1, options["batch"])
+        rnd = random.Random(options["seed"])
+        population, weights = zip(*SAMPLE_CELLS)
+        cells = rnd.choices(population, weights=weights, k=rows)
+
+        # Ingest: normalise + Drive rewrite (previously the rewrite happened at send time)
+        legacy = [_normalize_attachments(cell) for cell in cells]
+        started = time.perf_counter()
+        stored = []
+        for offset in range(0, rows, batch):
+            stored.extend(_normalize_attachments_column(cells[offset:offset + batch]))
+        ingest_s = time.perf_counter() - started
+
+        # Read path (serializer + send). Before: re-validate and rewrite Drive links per URL
+        started = time.perf_counter()
+        for value in legacy:
+            [_drive_direct_url(u) for u in _legacy_attachments_list(value)]
+        read_legacy_s = time.perf_counter() - started
+
+        record = EmailRecord()
+        started = time.perf_counter()
+        for value in stored:
+            record.attachments_urls = value
+            [_drive_direct_url(u) for u in record.attachments_list]
+        read_s = time.perf_counter() - started
+
+        self.stdout.write(f"rows={rows} batch={batch}")
+        self.stdout.write(f"[ingest]\n  {ingest_s:.3f}s ({rows / ingest_s:,.0f} rows/sec)")
+        self._report("read (serialize/send)", read_legacy_s, read_s, rows)
@@ -0,0 +1,64 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from mailing import rendering
+
+
+SAMPLE_NAMES = ["Ayesha Rahman", "O'Brien", "Tanvir <HR>", "Nusrat & Co.", "", "José Álvarez"]
+
+SAMPLE_BODIES = {
+    "plain": (
+        "We are pleased to share the schedule for next quarter.\n"
+        "Please review the attached documents and reply with any questions.\n" * 6
+    ),
+    "html": (
+        "<p>We are pleased to share the <b>schedule</b> for next quarter.</p>"
+        "<ul><li>Orientation</li><li>Training</li><li>Review</li></ul>"
+        "<p>Please review the attached documents.</p>" * 6
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark email rendering: full template render + strip_tags per message "
+        "vs. the render-once cache used by the send tasks (mailing.rendering)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=5_000, help="Messages rendered per run")
+        parser.add_argument("--campaigns", type=int, default=1, help="Distinct subject/body pairs")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        count, campaigns = options["messages"], max(1, options["campaigns"])
+        rnd = random.Random(options["seed"])
+        bodies = list(SAMPLE_BODIES.values())
+        messages = [
+            (
+                f"{rnd.choice(SAMPLE_NAMES)} {i}" if i % 10 else rnd.choice(SAMPLE_NAMES),
+                f"Quarterly update #{i % campaigns}",
+                bodies[i % campaigns % len(bodies)] + f"<!-- campaign {i % campaigns} -->",
+            )
+            for i in range(count)
+        ]
+
+        started = time.perf_counter()
+        legacy = [rendering.render_uncached(*message) for message in messages]
+        legacy_s = time.perf_counter() - started
+
+        rendering.clear()
+        started = time.perf_counter()
+        cached = [rendering.render_email(*message) for message in messages]
+        cached_s = time.perf_counter() - started
+
+        if cached != legacy:
+            self.stderr.write(self.style.ERROR("Rendered output differs between the two implementations."))
+            return
+
+        self.stdout.write(f"messages={count} campaigns={campaigns}")
+        self.stdout.write(f"  before: {legacy_s:.3f}s ({count / legacy_s:,.0f} messages/sec)")
+        self.stdout.write(f"  after:  {cached_s:.3f}s ({count / cached_s:,.0f} messages/sec)")
+        self.stdout.write(self.style.SUCCESS(f"  speed-up: {legacy_s / cached_s:.1f}x"))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mailing import chunked_upload
+from mailing.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = "Delete chunked upload sessions that were never completed, along with their partial files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=int, default=24,
+                            help="Purge open sessions with no chunk received for this many hours (default 24)")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options["hours"])
+        stale = UploadSession.objects.filter(status=UploadSession.STATUS_OPEN, updated_at__lt=cutoff)
+        purged = 0
+        for session in stale.iterator():
+            chunked_upload.discard(session)
+            session.delete()
+            purged += 1
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} stale upload session(s)."))
@@ -0,0 +1,91 @@
+import os
+import threading
+from collections import OrderedDict
+from email import encoders
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+
+# -----------------------------
+# Pre-encoded attachment MIME parts (per process)
+# -----------------------------
+# All recipients of a campaign get the same attachment files (hard links to
+# one cached copy, see mailing.attachment_cache). Instead of reading and
+# base64-encoding a file for every message, its MIME part is built once and
+# the same object is attached to every message: the email generator writes an
+# already-encoded payload as-is and never modifies the part. Parts are keyed by
+# the file's identity (device, inode, size, mtime) plus filename and mimetype,
+# so a re-downloaded file gets a new part, and are kept in a per-process LRU
+# bounded by encoded size (ATT_MIME_CACHE_MB). A part larger than the whole
+# cache is still built once per message, as before.
+
+ATT_MIME_CACHE_BYTES = int(getattr(settings, "ATT_MIME_CACHE_MB", 128)) * 1024 * 1024
+
+_parts = OrderedDict()  # key -> (part, encoded size)
+_size = 0
+_lock = threading.Lock()
+
+
+def _build(path: str, filename: str, mimetype: str):
+    """
+    A base64-encoded attachment part for the file, any type included; text that
+    is not UTF-8 goes out as application/octet-stream (as Django's attach() does).
+    """
+    maintype, _, subtype = (mimetype or "").partition("/")
+    if not maintype or not subtype:
+        maintype, subtype = "application", "octet-stream"
+    with open(path, "rb") as fh:
+        data = fh.read()
+    params = {}
+    if maintype == "text":
+        try:
+            data.decode("utf-8")
+            params["charset"] = "utf-8"
+        except UnicodeDecodeError:
+            maintype, subtype = "application", "octet-stream"
+    part = MIMEBase(maintype, subtype, **params)
+    part.set_payload(data)
+    encoders.encode_base64(part)
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        filename = ("utf-8", "", filename)  # RFC 2231
+    part.add_header("Content-Disposition", "attachment", filename=filename)
+    return part
+
+
+def attachment_part(path: str, filename: str, mimetype: str):
+    """
+    Shared, pre-encoded MIME part for a file; pass it to msg.attach(part).
+    Treat it as read-only: the same object goes into many messages.
+    """
+    global _size
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, filename, mimetype)
+    with _lock:
+        cached = _parts.get(key)
+        if cached is not None:
+            _parts.move_to_end(key)
+            return cached[0]
+
+    part = _build(path, filename, mimetype)
+    payload = part.get_payload()
+    size = len(payload) if isinstance(payload, (str, bytes)) else st.st_size
+    if size > ATT_MIME_CACHE_BYTES:
+        return part
+    with _lock:
+        if key not in _parts:
+            _parts[key] = (part, size)
+            _size += size
+        while _size > ATT_MIME_CACHE_BYTES:
+            _, (_, evicted) = _parts.popitem(last=False)
+            _size -= evicted
+    return part
+
+
+def clear() -> None:
+    """Drop every cached part in this process."""
+    global _size
+    with _lock:
+        _parts.clear()
+        _size = 0
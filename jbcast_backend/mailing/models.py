@@ -1,7 +1,38 @@
+import hashlib
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
-from urllib.parse import urlparse
+from django.utils import timezone
+
+
+class CampaignContent(models.Model):
+    """
+    Subject/body stored once and shared by every record that uses it,
+    deduplicated by a hash of the content.
+    """
+    content_hash = models.CharField(max_length=64, unique=True)
+    subject = models.CharField(max_length=255, blank=True, default='')
+    body = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.subject or 'No Subject'} ({self.content_hash[:12]})"
+
+    @staticmethod
+    def hash_for(subject, body) -> str:
+        payload = f"{subject or ''}\x00{body or ''}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    @classmethod
+    def intern(cls, subject, body):
+        """Return the shared row for this subject/body, creating it if needed."""
+        content, _ = cls.objects.get_or_create(
+            content_hash=cls.hash_for(subject, body),
+            defaults={'subject': subject or '', 'body': body or ''},
+        )
+        return content
 
 
 class EmailFile(models.Model):
@@ -14,6 +45,34 @@ class EmailFile(models.Model):
     file = models.FileField(upload_to='uploads/')
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    # Campaign defaults (subject/body from the first data row)
+    content = models.ForeignKey(
+        CampaignContent,
+        on_delete=models.PROTECT,
+        related_name='files',
+        blank=True,
+        null=True
+    )
+
+    # Ingestion checkpoints: data rows committed so far per stream ("rows" for a
+    # single-task ingest, "<start>-<end>" per CSV shard), written in the same
+    # transaction as each batch so a retried task resumes instead of re-inserting
+    ingest_checkpoints = models.JSONField(default=dict, blank=True)
+    ingest_completed_at = models.DateTimeField(blank=True, null=True)
+
+    # Records per send task over one SMTP session; empty = SEND_BATCH_SIZE setting
+    send_batch_size = models.PositiveIntegerField(blank=True, null=True)
+    # Start of the latest "send all" run (records fail at most once per run; the
+    # claim sweep resumes a stalled run with it, see reclaim_expired_claims)
+    send_started_at = models.DateTimeField(blank=True, null=True)
+
+    # When the attachment prefetch stage last staged this file's attachments
+    # (send workers then attach the staged copies instead of downloading)
+    attachments_prefetched_at = models.DateTimeField(blank=True, null=True)
+
+    # Copy sent emails to the SMTP account's IMAP Sent folder (see mailing.sent_archive)
+    archive_to_sent = models.BooleanField(default=True)
+
     def __str__(self):
         return f"{self.title} ({self.user.username})"
 
@@ -26,6 +85,19 @@ class EmailRecord(models.Model):
     )
     name = models.CharField(max_length=255)
     email = models.EmailField()
+    # Recipient domain (lower-cased); the send dispatcher groups and throttles by it
+    domain = models.CharField(max_length=255, blank=True, default='')
+    # Case-folded address; duplicates within a file are detected on it (see key_for)
+    email_key = models.CharField(max_length=320, blank=True, default='')
+
+    # Shared content; subject/body below are per-record overrides (NULL = use content)
+    content = models.ForeignKey(
+        CampaignContent,
+        on_delete=models.PROTECT,
+        related_name='records',
+        blank=True,
+        null=True
+    )
     subject = models.CharField(max_length=255, blank=True, null=True)
     body = models.TextField(blank=True, null=True)
     cc = models.TextField(blank=True, null=True)
@@ -37,51 +109,183 @@ class EmailRecord(models.Model):
         null=True,
         help_text="Comma-separated HTTP/HTTPS URLs to attachments."
     )
+    # Attachments the prefetch stage could not fetch: {url: error}
+    attachment_errors = models.JSONField(default=dict, blank=True)
 
     is_sent = models.BooleanField(default=False)
 
+    # Lease held by the send task working on this record (see mailing.claims)
+    claim_token = models.UUIDField(blank=True, null=True, db_index=True)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+
     # Tracking info
     send_attempts = models.PositiveIntegerField(default=0)
     last_sent_at = models.DateTimeField(blank=True, null=True)
     error_message = models.TextField(blank=True, null=True)
+    # Set after a temporary (4xx) failure: not retried before then (see mailing.send_control)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Send dispatcher pages unsent records of a file by id
+            models.Index(fields=['file', 'is_sent', 'id']),
+            # Cross-shard de-duplication groups a file's records by address
+            models.Index(fields=['file', 'email_key']),
+        ]
+
     def __str__(self):
         return f"{self.name} <{self.email}>"
 
+    @property
+    def is_claimed(self):
+        """A send task currently holds a lease on this record."""
+        return self.claimed_until is not None and self.claimed_until > timezone.now()
+
+    @property
+    def effective_subject(self):
+        """Per-record override if set, otherwise the shared content's subject."""
+        if self.subject is not None:
+            return self.subject
+        return self.content.subject if self.content_id else ''
+
+    @property
+    def effective_body(self):
+        """Per-record override if set, otherwise the shared content's body."""
+        if self.body is not None:
+            return self.body
+        return self.content.body if self.content_id else ''
+
     @property
     def attachments_list(self):
         """
-        Returns a clean list of http(s) URLs from attachments_urls.
-        Trims whitespace and ignores empty/non-http(s) entries.
+        Returns the list of http(s) URLs from attachments_urls.
+        Values are validated and normalised once at ingest, so this is a plain
+        split; the prefix check only guards values edited by hand (e.g. admin).
         """
-        if not self.attachments_urls:
+        return self.split_attachment_urls(self.attachments_urls)
+
+    @staticmethod
+    def domain_of(email):
+        """Lower-cased domain part of an address ('' without one)."""
+        _, at, domain = (email or '').strip().rpartition('@')
+        return domain.lower() if at else ''
+
+    @staticmethod
+    def key_for(email):
+        """De-duplication key of an address: case-folded, so ingest and SQL agree."""
+        return (email or '').strip().casefold()
+
+    def save(self, *args, **kwargs):
+        self.domain = self.domain_of(self.email)
+        self.email_key = self.key_for(self.email)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def split_attachment_urls(value):
+        """attachments_list for a raw attachments_urls value."""
+        if not value:
             return []
-        items = [u.strip() for u in self.attachments_urls.split(',')]
-        out = []
-        for u in items:
-            if not u:
-                continue
-            try:
-                p = urlparse(u)
-                if p.scheme in ("http", "https"):
-                    out.append(u)
-            except Exception:
-                continue
-        return out
+        items = [u.strip() for u in value.split(',')]
+        return [u for u in items if u[:8].lower().startswith(("http://", "https://"))]
+
+
+class RejectedRow(models.Model):
+    """A row of an uploaded file that was not turned into an EmailRecord."""
+    REASON_MISSING_EMAIL = 'missing_email'
+    REASON_INVALID_EMAIL = 'invalid_email'
+    REASON_DUPLICATE = 'duplicate'
+    REASON_CHOICES = [
+        (REASON_MISSING_EMAIL, 'Missing email'),
+        (REASON_INVALID_EMAIL, 'Invalid email'),
+        (REASON_DUPLICATE, 'Duplicate within file'),
+    ]
+
+    file = models.ForeignKey(
+        EmailFile,
+        on_delete=models.CASCADE,
+        related_name='rejected_rows'
+    )
+    # Spreadsheet row (header = 1); NULL when not known (e.g. parallel CSV shards)
+    row_number = models.PositiveIntegerField(blank=True, null=True)
+    name = models.CharField(max_length=255, blank=True, default='')
+    email = models.CharField(max_length=320, blank=True, default='')
+    reason = models.CharField(max_length=32, choices=REASON_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.email or '(no email)'}: {self.reason}"
+
+
+class UploadSession(models.Model):
+    """
+    A chunked upload in progress. Chunks are appended to a partial file under
+    MEDIA_ROOT/uploads/; the EmailFile is only created once the whole file has
+    arrived, and its ingest task checks the file against `sha256` before parsing.
+    """
+    STATUS_OPEN = 'open'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_OPEN, 'Open'),
+        (STATUS_COMPLETED, 'Completed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    title = models.CharField(max_length=255)
+    filename = models.CharField(max_length=255)
+    total_size = models.PositiveBigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    # Bytes written so far; chunks must arrive in order, so this is the resume offset
+    received_bytes = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    # Copied to the EmailFile created on completion
+    archive_to_sent = models.BooleanField(default=True)
+    email_file = models.OneToOneField(
+        EmailFile,
+        on_delete=models.SET_NULL,
+        related_name='upload_session',
+        blank=True,
+        null=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received_bytes}/{self.total_size} bytes)"
 
 
 class SMTPAccount(models.Model):
-    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # A user may own several accounts; campaigns are spread across the active ones
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='smtp_accounts'
+    )
+    is_active = models.BooleanField(default=True)
     email_host = models.CharField(max_length=255)
     email_port = models.PositiveIntegerField(default=587)
     email_host_user = models.EmailField()
     email_host_password = models.CharField(max_length=255)
     use_tls = models.BooleanField(default=True)
 
-    # Quota tracking
+    # Sent-folder archiving over IMAP (SSL); empty host = IMAP_DEFAULT_HOST setting
+    imap_host = models.CharField(max_length=255, blank=True, default='')
+    imap_port = models.PositiveIntegerField(default=993)
+    imap_sent_folder = models.CharField(max_length=255, default='Sent')
+
+    # Send limits (token buckets in Redis, see mailing.quota); empty = settings default, 0 = no limit
+    max_per_second = models.PositiveIntegerField(blank=True, null=True)
+    max_per_hour = models.PositiveIntegerField(blank=True, null=True)
+    max_per_day = models.PositiveIntegerField(blank=True, null=True)
+
+    # Quota tracking (reconciled from Redis periodically, not written per email)
     emails_sent_today = models.PositiveIntegerField(default=0)
     last_reset = models.DateTimeField(auto_now_add=True)
     rate_limited = models.BooleanField(default=False)
@@ -0,0 +1,84 @@
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import counters
+
+# -----------------------------
+# Ingestion progress (cache-backed)
+# -----------------------------
+# Counters live in the shared cache (Redis in deployment), never in the DB.
+# Writers buffer deltas in memory and push them with counters.incr at most
+# once per PROGRESS_FLUSH_INTERVAL, so parallel shard tasks can report into the
+# same file without contention and without a write per row.
+
+PROGRESS_TTL = 24 * 60 * 60  # seconds
+PROGRESS_FLUSH_INTERVAL = 1.0  # seconds between cache writes per task
+
+STATE_QUEUED = "queued"
+STATE_PARSING = "parsing"
+STATE_COMPLETED = "completed"
+STATE_FAILED = "failed"
+
+COUNTERS = ("rows_parsed", "rows_inserted", "rows_rejected")
+
+
+def _key(email_file_id, name: str) -> str:
+    return f"mailing:ingest:{email_file_id}:{name}"
+
+
+def set_state(email_file_id, state: str, error: str = "") -> None:
+    """Record the ingestion state (and optional error) for a file."""
+    cache.set_many({
+        _key(email_file_id, "state"): state,
+        _key(email_file_id, "error"): error[:500],
+        _key(email_file_id, "updated_at"): timezone.now().isoformat(),
+    }, timeout=PROGRESS_TTL)
+
+
+def reset(email_file_id, state: str = STATE_QUEUED) -> None:
+    """Zero all counters and set the initial state (called when a file is queued)."""
+    cache.set_many({_key(email_file_id, name): 0 for name in COUNTERS}, timeout=PROGRESS_TTL)
+    set_state(email_file_id, state)
+
+
+def get_progress(email_file_id) -> dict:
+    """Snapshot of the counters for one file; state is 'unknown' once expired."""
+    names = COUNTERS + ("state", "error", "updated_at")
+    values = cache.get_many([_key(email_file_id, name) for name in names])
+    out = {name: values.get(_key(email_file_id, name)) for name in names}
+    for name in COUNTERS:
+        out[name] = int(out[name] or 0)
+    out["state"] = out["state"] or "unknown"
+    out["error"] = out["error"] or ""
+    return out
+
+
+class IngestProgress:
+    """
+    Per-task buffered counter writer.
+    Call add() as batches are processed and flush() when the task ends.
+    """
+
+    def __init__(self, email_file_id, flush_interval: float = PROGRESS_FLUSH_INTERVAL):
+        self.email_file_id = email_file_id
+        self.flush_interval = flush_interval
+        self._pending = dict.fromkeys(COUNTERS, 0)
+        self._last_flush = time.monotonic()
+
+    def add(self, parsed: int = 0, inserted: int = 0, rejected: int = 0) -> None:
+        self._pending["rows_parsed"] += parsed
+        self._pending["rows_inserted"] += inserted
+        self._pending["rows_rejected"] += rejected
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        for name, delta in self._pending.items():
+            if not delta:
+                continue
+            counters.incr(_key(self.email_file_id, name), delta, PROGRESS_TTL)
+            self._pending[name] = 0
+        cache.set(_key(self.email_file_id, "updated_at"), timezone.now().isoformat(), timeout=PROGRESS_TTL)
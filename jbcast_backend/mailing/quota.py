@@ -0,0 +1,230 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import redis_client
+
+# -----------------------------
+# SMTP send quota (Redis token buckets)
+# -----------------------------
+# Each SMTPAccount has up to three limits (per second / hour / day). The
+# second and hour limits are token buckets: at most `limit` tokens, refilled
+# continuously at limit / window. The day limit is a hard cap per calendar
+# day (provider caps such as 500/day are not rolling allowances): a counter
+# of tokens taken today that starts over at local midnight, so an account
+# never gets more than `limit` tokens in one day, where a refilling bucket
+# would allow up to 2 x limit in any 24 hours. One Lua script checks and
+# debits all of an account's limits atomically on the Redis server, so
+# concurrent workers never read-modify-write a counter and never touch the
+# SMTPAccount row to send.
+# Sent counts go to a per-day Redis counter; reconcile() copies them to
+# SMTPAccount.emails_sent_today / rate_limited at most once per
+# QUOTA_RECONCILE_INTERVAL (for the admin and the API), never per email.
+
+QUOTA_MAX_PER_SECOND = getattr(settings, "SMTP_MAX_PER_SECOND", 10)
+QUOTA_MAX_PER_HOUR = getattr(settings, "SMTP_MAX_PER_HOUR", 0)  # 0 = no hourly limit
+QUOTA_MAX_PER_DAY = getattr(settings, "SMTP_MAX_PER_DAY", 500)
+QUOTA_RECONCILE_INTERVAL = 60  # seconds
+SENT_COUNTER_TTL = 2 * 24 * 60 * 60  # seconds
+
+# KEYS: bucket keys. ARGV: requested, then (limit, window seconds) per key; a
+# negative window marks a fixed-window counter (the day cap) whose window ends
+# in -window seconds. Grants min(requested, whole tokens in the emptiest bucket)
+# from every bucket.
+# Returns {granted, remaining (emptiest bucket, after debit), retry_after seconds}.
+_TOKEN_BUCKET_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local requested = tonumber(ARGV[1])
+local levels = {}
+local granted = requested
+for i, key in ipairs(KEYS) do
+  local limit = tonumber(ARGV[2 * i])
+  local window = tonumber(ARGV[2 * i + 1])
+  local tokens
+  if window < 0 then
+    tokens = limit - (tonumber(redis.call('GET', key)) or 0)
+  else
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    tokens = tonumber(state[1]) or limit
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(limit, tokens + math.max(0, now - ts) * limit / window)
+  end
+  levels[i] = tokens
+  granted = math.min(granted, math.floor(tokens))
+end
+if granted < 0 then granted = 0 end
+local remaining = -1
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+  local limit = tonumber(ARGV[2 * i])
+  local window = tonumber(ARGV[2 * i + 1])
+  local left = levels[i] - granted
+  if window < 0 then
+    if granted > 0 then
+      redis.call('INCRBY', key, granted)
+    end
+    redis.call('EXPIRE', key, math.ceil(-window) + 60)
+    if left < 1 then
+      retry_after = math.max(retry_after, -window)
+    end
+  else
+    redis.call('HSET', key, 'tokens', left, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(window) * 2)
+    if left < 1 then
+      retry_after = math.max(retry_after, (1 - left) * window / limit)
+    end
+  end
+  if remaining < 0 or left < remaining then remaining = left end
+end
+return {granted, tostring(math.floor(math.max(remaining, 0))), tostring(retry_after)}
+"""
+
+# KEYS: bucket keys. ARGV: count, then (limit, window seconds) per key, as for
+# _TOKEN_BUCKET_LUA. Puts `count` unused tokens back: never above a bucket's
+# limit, never below zero taken on a fixed-window counter.
+_REFUND_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local count = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+  local limit = tonumber(ARGV[2 * i])
+  local window = tonumber(ARGV[2 * i + 1])
+  if window < 0 then
+    local taken = tonumber(redis.call('GET', key)) or 0
+    if taken > 0 then
+      redis.call('DECRBY', key, math.min(count, taken))
+    end
+  else
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    if state[1] then
+      local tokens = tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * limit / window
+      redis.call('HSET', key, 'tokens', math.min(limit, tokens + count), 'ts', now)
+      redis.call('EXPIRE', key, math.ceil(window) * 2)
+    end
+  end
+end
+return 1
+"""
+
+Grant = namedtuple("Grant", ["granted", "remaining", "retry_after"])
+
+_token_bucket = redis_client.Script(_TOKEN_BUCKET_LUA)
+_refund = redis_client.Script(_REFUND_LUA)
+
+
+def _seconds_until_midnight() -> float:
+    now = timezone.localtime()
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max((midnight - now).total_seconds(), 1.0)
+
+
+def limits_for(smtp) -> list:
+    """
+    [(name, limit, window seconds)] for the account's enabled buckets; the day
+    cap's window is negative: it ends at local midnight (see _TOKEN_BUCKET_LUA).
+    """
+    configured = (
+        ("second", smtp.max_per_second, QUOTA_MAX_PER_SECOND, 1),
+        ("hour", smtp.max_per_hour, QUOTA_MAX_PER_HOUR, 60 * 60),
+        ("day", smtp.max_per_day, QUOTA_MAX_PER_DAY, -_seconds_until_midnight()),
+    )
+    out = []
+    for name, value, default, window in configured:
+        limit = default if value is None else value
+        if limit:
+            out.append((name, limit, window))
+    return out
+
+
+def _bucket_key(smtp, name) -> str:
+    if name == "day":
+        # One counter per calendar day: a new day starts from zero
+        return f"mailing:quota:{smtp.pk}:day:{timezone.localdate().isoformat()}"
+    return f"mailing:quota:{smtp.pk}:{name}"
+
+
+def _sent_key(smtp_id, day=None) -> str:
+    return f"mailing:quota:{smtp_id}:sent:{(day or timezone.localdate()).isoformat()}"
+
+
+def acquire(smtp, requested: int = 1) -> Grant:
+    """
+    Atomically take up to `requested` send tokens for an account.
+    acquire(smtp, 0) only reports the current state.
+    """
+    buckets = limits_for(smtp)
+    return _take([_bucket_key(smtp, name) for name, _, _ in buckets], buckets, requested)
+
+
+def refund(smtp, count: int) -> None:
+    """Give back `count` tokens taken with acquire() but not used."""
+    buckets = limits_for(smtp)
+    _give_back([_bucket_key(smtp, name) for name, _, _ in buckets], buckets, count)
+
+
+def _give_back(keys, buckets, count: int) -> None:
+    if buckets and count > 0:
+        args = [count]
+        for _, limit, window in buckets:
+            args += [limit, window]
+        _refund(keys=keys, args=args)
+
+
+def _take(keys, buckets, requested: int) -> Grant:
+    if not buckets:
+        return Grant(requested, -1, 0.0)
+    args = [requested]
+    for _, limit, window in buckets:
+        args += [limit, window]
+    granted, remaining, retry_after = _token_bucket(keys=keys, args=args)
+    return Grant(int(granted), int(remaining), float(retry_after))
+
+
+def _domain_key(domain) -> str:
+    return f"mailing:quota:domain:{domain}:minute"
+
+
+def acquire_domain(domain: str, per_minute: int, requested: int = 1) -> Grant:
+    """
+    Same as acquire(), for the per-minute bucket of a recipient domain
+    (mailing.domains); per_minute 0 means no limit.
+    """
+    buckets = [("minute", per_minute, 60)] if per_minute else []
+    return _take([_domain_key(domain)], buckets, requested)
+
+
+def refund_domain(domain: str, per_minute: int, count: int) -> None:
+    """Give back `count` tokens taken with acquire_domain() but not used."""
+    buckets = [("minute", per_minute, 60)] if per_minute else []
+    _give_back([_domain_key(domain)], buckets, count)
+
+
+def record_sent(smtp, count: int) -> None:
+    """Count delivered messages for today (reconciled to the DB by reconcile())."""
+    if count:
+        key = _sent_key(smtp.pk)
+        pipe = redis_client.client().pipeline()
+        pipe.incrby(key, count)
+        pipe.expire(key, SENT_COUNTER_TTL)
+        pipe.execute()
+
+
+def reconcile(smtp, force: bool = False) -> bool:
+    """
+    Copy today's sent count and the daily bucket state to the SMTPAccount row,
+    at most once per QUOTA_RECONCILE_INTERVAL across all workers (unless forced).
+    Returns True if the row was updated.
+    """
+    if not force and not cache.add(f"mailing:quota:{smtp.pk}:reconciled", True, QUOTA_RECONCILE_INTERVAL):
+        return False
+    sent_today = int(redis_client.client().get(_sent_key(smtp.pk)) or 0)
+    state = acquire(smtp, 0)
+    type(smtp).objects.filter(pk=smtp.pk).update(
+        emails_sent_today=sent_today,
+        rate_limited=state.remaining == 0 and state.retry_after > 1,
+    )
+    return True
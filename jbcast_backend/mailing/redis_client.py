@@ -0,0 +1,39 @@
+import redis
+from django.conf import settings
+
+# -----------------------------
+# Shared Redis client
+# -----------------------------
+# quota, send_control and sent_archive keep their state directly in Redis
+# (Lua scripts, lists, counters) rather than behind the Django cache. They share
+# one lazily created client per process, and their scripts are Script objects
+# registered on that client on first use.
+
+_client = None
+
+
+def client():
+    """The process-wide client for REDIS_URL (created on first use)."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(getattr(settings, "REDIS_URL", "redis://localhost:6379/0"))
+    return _client
+
+
+class Script:
+    """
+    A Lua script run on client(). Defined at import time, registered on the first
+    call (and again if the client was replaced, e.g. by tests).
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self._registered = (None, None)
+
+    def __call__(self, keys=(), args=()):
+        current = client()
+        registered_on, script = self._registered
+        if registered_on is not current:
+            script = current.register_script(self.source)
+            self._registered = (current, script)
+        return script(keys=keys, args=args)
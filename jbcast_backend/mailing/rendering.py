@@ -0,0 +1,97 @@
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.html import conditional_escape, strip_tags
+
+# -----------------------------
+# Render-once email bodies (per campaign)
+# -----------------------------
+# Subject and body are shared by every record of a file and only the recipient's
+# name differs, so the template is rendered (and stripped to plain text) once per
+# subject/body with a placeholder in place of the name. Each email is then built
+# by splicing the escaped name into the pre-rendered pieces, which yields exactly
+# what rendering the template for that record would. Compiled entries live in a
+# small per-process LRU. If the placeholder does not survive rendering intact
+# (e.g. the body breaks the markup around it), that subject/body falls back to a
+# full render per email.
+
+EMAIL_TEMPLATE = "emails/default_email.html"
+RENDER_CACHE_SIZE = max(1, int(getattr(settings, "RENDER_CACHE_SIZE", 128)))  # compiled subject/body pairs per process
+
+_HTML_TAG_RE = re.compile(r'</?[a-z][\s\S]*?>', re.IGNORECASE)
+_NAME_PLACEHOLDER = f"jbcast{uuid.uuid4().hex}name"
+
+_compiled = OrderedDict()  # (subject, body, has_name) -> _Compiled
+_lock = threading.Lock()
+
+
+def looks_like_html(text: str) -> bool:
+    """Heuristic: does the string contain any HTML tag-like patterns?"""
+    if not text:
+        return False
+    return bool(_HTML_TAG_RE.search(text))
+
+
+def render_uncached(name, subject: str, body: str) -> tuple[str, str]:
+    """Render one email from scratch. Returns (html, plain)."""
+    context = {
+        'name': name,
+        'body': body,
+        'subject': subject,
+        'is_html': looks_like_html(body),
+    }
+    html_content = render_to_string(EMAIL_TEMPLATE, context)
+    return html_content, strip_tags(html_content)
+
+
+class _Compiled:
+    """The rendered email split around the name placeholder (or whole, when there is no name)."""
+
+    def __init__(self, subject: str, body: str, has_name: bool):
+        html_content, plain_content = render_uncached(_NAME_PLACEHOLDER if has_name else None, subject, body)
+        self.html_parts = html_content.split(_NAME_PLACEHOLDER)
+        self.plain_parts = plain_content.split(_NAME_PLACEHOLDER)
+        # Splicing is only exact if every placeholder made it through to both outputs
+        self.spliceable = len(self.html_parts) == len(self.plain_parts) and (
+            len(self.html_parts) > 1 or not has_name
+        )
+
+    def render(self, name) -> tuple[str, str]:
+        value = str(conditional_escape(name)) if name else ""
+        return value.join(self.html_parts), value.join(self.plain_parts)
+
+
+def _get_compiled(subject: str, body: str, has_name: bool) -> _Compiled:
+    key = (subject, body, has_name)
+    with _lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+            return compiled
+    compiled = _Compiled(subject, body, has_name)
+    with _lock:
+        _compiled[key] = compiled
+        while len(_compiled) > RENDER_CACHE_SIZE:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def render_email(name, subject: str, body: str) -> tuple[str, str]:
+    """
+    (html, plain) for one recipient, identical to render_uncached() but with
+    the template rendered only once per subject/body in this process.
+    """
+    compiled = _get_compiled(subject, body, bool(name))
+    if not compiled.spliceable:
+        return render_uncached(name, subject, body)
+    return compiled.render(name)
+
+
+def clear() -> None:
+    """Drop every compiled entry (e.g. after the template changed)."""
+    with _lock:
+        _compiled.clear()
@@ -0,0 +1,223 @@
+import random
+import smtplib
+import socket
+import uuid
+from collections import namedtuple
+
+import redis
+from django.conf import settings
+
+from . import redis_client
+
+# -----------------------------
+# SMTP reply classification
+# -----------------------------
+# A failed send is one of:
+#   PERMANENT  5xx (unknown user, rejected content, ...): do not retry
+#   TRANSIENT  4xx for this message/recipient (greylisting, mailbox busy):
+#              retry the record later with backoff, keep using the session
+#   THROTTLED  the server is pushing back on us (421, 4.7.x rate/policy
+#              deferrals, dropped connections, timeouts): retry later, stop
+#              sending through this account for now and halve its concurrency
+
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+THROTTLED = "throttled"
+
+Reply = namedtuple("Reply", ["kind", "code", "message"])
+
+
+def _reply_for_code(code, message) -> Reply:
+    text = message.decode("utf-8", "replace") if isinstance(message, bytes) else str(message)
+    if 400 <= code < 500:
+        throttled = code == 421 or text.lstrip().startswith("4.7.")
+        return Reply(THROTTLED if throttled else TRANSIENT, code, text)
+    return Reply(PERMANENT, code, text)
+
+
+def classify(exc) -> Reply:
+    """Classify an exception raised while sending one message."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        replies = [_reply_for_code(code, msg) for code, msg in exc.recipients.values()]
+        for kind in (THROTTLED, TRANSIENT):
+            for reply in replies:
+                if reply.kind == kind:
+                    return reply
+        if replies:
+            return replies[0]
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return _reply_for_code(exc.smtp_code, exc.smtp_error)
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError)):
+        return Reply(THROTTLED, None, str(exc) or exc.__class__.__name__)
+    return Reply(PERMANENT, None, str(exc))
+
+
+# -----------------------------
+# Retry backoff
+# -----------------------------
+SEND_MAX_ATTEMPTS = max(1, int(getattr(settings, "SEND_MAX_ATTEMPTS", 5)))
+SEND_RETRY_BASE_DELAY = getattr(settings, "SEND_RETRY_BASE_DELAY", 60)  # seconds before the first retry
+SEND_RETRY_MAX_DELAY = getattr(settings, "SEND_RETRY_MAX_DELAY", 60 * 60)  # seconds
+
+
+def retry_delay(attempt: int) -> float:
+    """
+    Seconds before retry number `attempt` (1-based): exponential, capped, with
+    "equal jitter" (half fixed, half random) so deferred records spread out
+    instead of hitting the server again in lockstep.
+    """
+    ceiling = min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * 2 ** max(attempt - 1, 0))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+# -----------------------------
+# Per-account concurrency (AIMD)
+# -----------------------------
+# Each account has a concurrency limit (sessions sending at once, across all
+# workers) kept in Redis. Every message delivered adds 1/limit (about +1 per
+# limit's worth of messages); a THROTTLED reply halves it, at most once per
+# SMTP_CONCURRENCY_COOLDOWN seconds so one burst of deferrals counts once.
+# Send tasks take a slot before using an account: slots are leased entries in
+# a sorted set, so a worker that dies gives its slot back when the lease ends.
+# A task sending for longer renews its slots along with its record claim
+# (mailing.claims.Lease).
+
+SMTP_CONCURRENCY_MIN = max(1, int(getattr(settings, "SMTP_CONCURRENCY_MIN", 1)))
+SMTP_CONCURRENCY_MAX = max(SMTP_CONCURRENCY_MIN, int(getattr(settings, "SMTP_CONCURRENCY_MAX", 10)))
+SMTP_CONCURRENCY_START = min(
+    SMTP_CONCURRENCY_MAX, max(SMTP_CONCURRENCY_MIN, int(getattr(settings, "SMTP_CONCURRENCY_START", 4)))
+)
+SMTP_CONCURRENCY_COOLDOWN = 10  # seconds between two decreases
+SMTP_CONCURRENCY_DECREASE = 0.5
+SLOT_LEASE_SECONDS = getattr(settings, "CLAIM_LEASE_SECONDS", 600)
+
+# KEYS: slots zset, limit key. ARGV: token, lease seconds, start limit.
+# Takes a slot if fewer than floor(limit) live ones are held. Returns 1/0.
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local limit = tonumber(redis.call('GET', KEYS[2]) or ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= math.floor(limit) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])) * 2)
+return 1
+"""
+
+# KEYS: slots zset. ARGV: token, lease seconds.
+# Extends a held slot's lease unless it already ran out. Returns 1/0.
+_RENEW_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local expires = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1]) or 0)
+if expires <= now then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])) * 2)
+return 1
+"""
+
+# KEYS: limit key, cooldown key. ARGV: delta (> 0: that many messages delivered,
+# each adding 1/limit, i.e. limit^2 grows by 2 per message; < 0: multiply by
+# -delta), start, min, max, cooldown seconds. Returns the new limit.
+_ADJUST_LUA = """
+local limit = tonumber(redis.call('GET', KEYS[1]) or ARGV[2])
+local delta = tonumber(ARGV[1])
+if delta > 0 then
+  limit = math.sqrt(limit * limit + 2 * delta)
+elseif redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[5]) then
+  limit = limit * -delta
+end
+limit = math.max(tonumber(ARGV[3]), math.min(tonumber(ARGV[4]), limit))
+redis.call('SET', KEYS[1], tostring(limit), 'EX', 7 * 24 * 60 * 60)
+return tostring(limit)
+"""
+
+_acquire = redis_client.Script(_ACQUIRE_LUA)
+_renew = redis_client.Script(_RENEW_LUA)
+_adjust = redis_client.Script(_ADJUST_LUA)
+
+
+def _slots_key(smtp_id) -> str:
+    return f"mailing:smtp:{smtp_id}:slots"
+
+
+def _limit_key(smtp_id) -> str:
+    return f"mailing:smtp:{smtp_id}:concurrency"
+
+
+def concurrency_limit(smtp) -> float:
+    value = redis_client.client().get(_limit_key(smtp.pk))
+    return float(value) if value is not None else float(SMTP_CONCURRENCY_START)
+
+
+def _take_slot(slots_key, limit_key, default_limit):
+    token = uuid.uuid4().hex
+    granted = _acquire(keys=[slots_key, limit_key], args=[token, SLOT_LEASE_SECONDS, default_limit])
+    return token if int(granted) else None
+
+
+def _give_back_slot(slots_key, token) -> None:
+    try:
+        redis_client.client().zrem(slots_key, token)
+    except redis.RedisError:
+        pass  # the slot's lease runs out instead
+
+
+def _renew_slot(slots_key, token) -> bool:
+    """Push a held slot's lease out again; False if it already ran out (and may be reused)."""
+    try:
+        return bool(int(_renew(keys=[slots_key], args=[token, SLOT_LEASE_SECONDS])))
+    except redis.RedisError:
+        return True  # keep sending; at worst the lease runs out early
+
+
+def acquire_slot(smtp):
+    """A slot token if the account is below its concurrency limit, else None."""
+    return _take_slot(_slots_key(smtp.pk), _limit_key(smtp.pk), SMTP_CONCURRENCY_START)
+
+
+def renew_slot(smtp, token) -> bool:
+    return _renew_slot(_slots_key(smtp.pk), token)
+
+
+def release_slot(smtp, token) -> None:
+    _give_back_slot(_slots_key(smtp.pk), token)
+
+
+def acquire_domain_slot(domain: str, limit: int):
+    """
+    A slot token if fewer than `limit` sessions send to the recipient domain
+    (mailing.domains), else None. Domain limits are configured, not adapted:
+    their limit key is never written, so `limit` always applies.
+    """
+    return _take_slot(f"mailing:domain:{domain}:slots", f"mailing:domain:{domain}:concurrency", limit)
+
+
+def renew_domain_slot(domain: str, token) -> bool:
+    return _renew_slot(f"mailing:domain:{domain}:slots", token)
+
+
+def release_domain_slot(domain: str, token) -> None:
+    _give_back_slot(f"mailing:domain:{domain}:slots", token)
+
+
+def _adjust_limit(smtp, delta) -> float:
+    value = _adjust(
+        keys=[_limit_key(smtp.pk), f"mailing:smtp:{smtp.pk}:concurrency:cooldown"],
+        args=[delta, SMTP_CONCURRENCY_START, SMTP_CONCURRENCY_MIN, SMTP_CONCURRENCY_MAX, SMTP_CONCURRENCY_COOLDOWN],
+    )
+    return float(value)
+
+
+def on_delivered(smtp, count: int) -> float:
+    """Additive increase after `count` messages were accepted."""
+    return _adjust_limit(smtp, count) if count else concurrency_limit(smtp)
+
+
+def on_throttled(smtp) -> float:
+    """Multiplicative decrease after the server deferred or dropped us."""
+    return _adjust_limit(smtp, -SMTP_CONCURRENCY_DECREASE)
@@ -0,0 +1,94 @@
+import random
+
+from django.core.cache import cache
+
+from . import quota
+from .models import SMTPAccount
+
+# -----------------------------
+# Sender selection (multiple SMTP accounts per tenant)
+# -----------------------------
+# A file is sent through the active SMTP accounts of the user who uploaded it.
+# Each batch picks one account at random, weighted by remaining quota (token
+# buckets, see mailing.quota) divided by the account's observed send latency
+# (EWMA, kept in the cache), so faster accounts with more headroom take more of
+# the campaign. An account that runs out of quota or cannot be reached is
+# skipped and the batch fails over to the next one.
+
+LATENCY_ALPHA = 0.3  # EWMA weight of the newest observation
+LATENCY_DEFAULT = 0.5  # seconds per message before anything was observed
+LATENCY_FLOOR = 0.05  # seconds; keeps one very fast account from taking everything
+UNLIMITED_WEIGHT = 1000  # stands in for "remaining" when an account has no limits
+DOWN_TTL = 60  # seconds an unreachable account is skipped
+STATS_TTL = 7 * 24 * 60 * 60  # seconds
+
+
+def _latency_key(smtp_id) -> str:
+    return f"mailing:smtp:{smtp_id}:latency"
+
+
+def _down_key(smtp_id) -> str:
+    return f"mailing:smtp:{smtp_id}:down"
+
+
+def accounts_for(user_id) -> list:
+    """
+    Active accounts of the tenant; empty if it has none (sending then pauses:
+    a campaign never goes out through another user's account).
+    """
+    return list(SMTPAccount.objects.filter(user_id=user_id, is_active=True).order_by('id'))
+
+
+def observe_latency(smtp, seconds_per_message: float) -> None:
+    """Fold one observation into the account's latency EWMA (approximate under races)."""
+    key = _latency_key(smtp.pk)
+    previous = cache.get(key)
+    value = seconds_per_message if previous is None else (
+        LATENCY_ALPHA * seconds_per_message + (1 - LATENCY_ALPHA) * previous
+    )
+    cache.set(key, value, STATS_TTL)
+
+
+def mark_down(smtp) -> None:
+    """Skip an account that could not be reached for DOWN_TTL seconds."""
+    cache.set(_down_key(smtp.pk), True, DOWN_TTL)
+
+
+def _available(accounts, max_wait):
+    """[(account, weight)] for accounts that can send now, plus the soonest retry_after of the rest."""
+    flags = cache.get_many(
+        [_latency_key(a.pk) for a in accounts] + [_down_key(a.pk) for a in accounts]
+    )
+    available = []
+    soonest = None
+    for account in accounts:
+        if flags.get(_down_key(account.pk)):
+            soonest = DOWN_TTL if soonest is None else min(soonest, DOWN_TTL)
+            continue
+        state = quota.acquire(account, 0)
+        if state.remaining == 0 and state.retry_after > max_wait:
+            soonest = state.retry_after if soonest is None else min(soonest, state.retry_after)
+            continue
+        headroom = UNLIMITED_WEIGHT if state.remaining < 0 else max(state.remaining, 1)
+        latency = flags.get(_latency_key(account.pk), LATENCY_DEFAULT)
+        available.append((account, headroom / max(latency, LATENCY_FLOOR)))
+    return available, soonest
+
+
+def pick_account(user_id, max_wait: float, exclude=()):
+    """An account of the tenant that can send now (weighted random), or None."""
+    accounts = [a for a in accounts_for(user_id) if a.pk not in exclude]
+    available, _ = _available(accounts, max_wait)
+    if not available:
+        return None
+    accounts, weights = zip(*available)
+    return random.choices(accounts, weights=weights)[0]
+
+
+def seconds_until_available(user_id, max_wait: float):
+    """0 if some account of the tenant can send now, else seconds until one can; None without accounts."""
+    accounts = accounts_for(user_id)
+    if not accounts:
+        return None
+    available, soonest = _available(accounts, max_wait)
+    return 0 if available else soonest
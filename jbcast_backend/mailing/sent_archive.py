@@ -0,0 +1,201 @@
+import imaplib
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from celery.signals import worker_process_shutdown
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+from . import redis_client
+
+logger = get_task_logger(__name__)
+
+# -----------------------------
+# Sent-folder archiving (asynchronous, batched)
+# -----------------------------
+# Send tasks never talk IMAP: after a successful send the raw message (the
+# bytes already serialised for SMTP) is written to a spool file under
+# IMAP_SPOOL_DIR, its path is pushed onto a Redis list per SMTPAccount and an
+# archive task is scheduled (at most one per account at a time,
+# IMAP_BATCH_DELAY seconds later so messages accumulate). Redis only holds
+# paths, never message bodies (it is also the Celery broker); the spool is
+# capped per account by message count and total bytes. The archive task
+# APPENDs the queued messages over one IMAP session per account, kept open in
+# the worker process between batches. Messages are removed from the list (and
+# their spool files deleted) only after they were appended, so an IMAP failure
+# or a lost worker leaves them queued for the next run (a crash between APPEND
+# and trim can archive a message twice, never lose it). Archive workers must
+# share IMAP_SPOOL_DIR with the send workers (same host or shared volume).
+# IMAP has no multi-message APPEND in the base protocol, so a "batch" is a
+# series of APPENDs over one authenticated session.
+
+IMAP_DEFAULT_HOST = getattr(settings, "IMAP_DEFAULT_HOST", "")
+IMAP_BATCH_SIZE = max(1, int(getattr(settings, "IMAP_BATCH_SIZE", 50)))  # messages per LRANGE/APPEND round
+IMAP_BATCH_DELAY = getattr(settings, "IMAP_BATCH_DELAY", 5)  # seconds messages accumulate before a run
+IMAP_QUEUE_MAX = int(getattr(settings, "IMAP_QUEUE_MAX", 1000))  # queued messages per account; more are not archived
+IMAP_QUEUE_MAX_BYTES = int(getattr(settings, "IMAP_QUEUE_MAX_MB", 256)) * 1024 * 1024  # spooled bytes per account
+IMAP_SPOOL_DIR = getattr(
+    settings, "IMAP_SPOOL_DIR",
+    os.path.join(getattr(settings, "ATT_TMP_ROOT", tempfile.gettempdir()), "sent_spool"),
+)
+IMAP_RUN_SECONDS = 60  # an archive run hands over to a fresh task after this long
+IMAP_NOOP_AFTER = 30  # seconds idle before a kept session is checked with NOOP
+
+def _queue_key(smtp_id) -> str:
+    return f"mailing:imap:{smtp_id}:queue"
+
+
+def _bytes_key(smtp_id) -> str:
+    return f"mailing:imap:{smtp_id}:bytes"
+
+
+def scheduled_key(smtp_id) -> str:
+    """Cache key held while an archive task for the account is queued or running."""
+    return f"mailing:imap:{smtp_id}:scheduled"
+
+
+def imap_host_for(smtp) -> str:
+    """The account's IMAP host, else IMAP_DEFAULT_HOST; empty means archiving is off."""
+    return smtp.imap_host or IMAP_DEFAULT_HOST
+
+
+def enqueue(smtp, raw_message: bytes) -> bool:
+    """Spool one sent message for the account's Sent folder. False if the queue is full."""
+    key = _queue_key(smtp.pk)
+    client = redis_client.client()
+    spooled = int(client.get(_bytes_key(smtp.pk)) or 0)
+    if client.llen(key) >= IMAP_QUEUE_MAX or spooled + len(raw_message) > IMAP_QUEUE_MAX_BYTES:
+        logger.warning(f"IMAP archive queue for SMTP account {smtp.pk} is full; message not archived")
+        return False
+    directory = os.path.join(IMAP_SPOOL_DIR, str(smtp.pk))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{uuid.uuid4().hex}.eml")
+    with open(path, "wb") as fh:
+        fh.write(raw_message)
+    pipe = client.pipeline()
+    pipe.incrby(_bytes_key(smtp.pk), len(raw_message))
+    pipe.rpush(key, path)
+    pipe.execute()
+    return True
+
+
+def _discard(client, smtp_id, paths) -> None:
+    """Delete appended messages' spool files and take them off the byte count."""
+    freed = 0
+    for path in paths:
+        path = path.decode() if isinstance(path, bytes) else path
+        try:
+            freed += os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+    if freed:
+        client.decrby(_bytes_key(smtp_id), freed)
+
+
+def pending(smtp_id) -> int:
+    return redis_client.client().llen(_queue_key(smtp_id))
+
+
+# -----------------------------
+# Persistent IMAP sessions (per worker process)
+# -----------------------------
+_sessions = {}  # account key -> (IMAP4_SSL, last used)
+_lock = threading.Lock()
+
+
+def _session_key(smtp):
+    return (smtp.pk, imap_host_for(smtp), smtp.imap_port, smtp.email_host_user, smtp.email_host_password)
+
+
+def _close(imap) -> None:
+    try:
+        imap.logout()
+    except Exception:
+        pass
+
+
+def _session(smtp):
+    key = _session_key(smtp)
+    with _lock:
+        imap, last_used = _sessions.pop(key, (None, 0))
+    if imap is not None:
+        if time.monotonic() - last_used < IMAP_NOOP_AFTER:
+            return imap
+        try:
+            if imap.noop()[0] == "OK":
+                return imap
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        _close(imap)
+    imap = imaplib.IMAP4_SSL(imap_host_for(smtp), smtp.imap_port)
+    imap.login(smtp.email_host_user, smtp.email_host_password)
+    return imap
+
+
+def _keep(smtp, imap) -> None:
+    with _lock:
+        _sessions[_session_key(smtp)] = (imap, time.monotonic())
+
+
+def archive_pending(smtp) -> int:
+    """
+    APPEND the account's queued messages to its Sent folder in batches of
+    IMAP_BATCH_SIZE, for up to IMAP_RUN_SECONDS. Returns messages archived;
+    raises on IMAP errors (the unarchived messages stay queued).
+    """
+    key = _queue_key(smtp.pk)
+    client = redis_client.client()
+    archived = 0
+    deadline = time.monotonic() + IMAP_RUN_SECONDS
+    while time.monotonic() < deadline:
+        batch = client.lrange(key, 0, IMAP_BATCH_SIZE - 1)
+        if not batch:
+            break
+        imap = _session(smtp)
+        appended = 0
+        try:
+            for path in batch:
+                try:
+                    with open(path, "rb") as fh:
+                        raw_message = fh.read()
+                except FileNotFoundError:
+                    # Spool lost (another host's spool dir, cleaned up): nothing to archive
+                    logger.warning(f"Spooled message {path!r} for SMTP account {smtp.pk} is missing")
+                    appended += 1
+                    continue
+                status, data = imap.append(
+                    smtp.imap_sent_folder, "", imaplib.Time2Internaldate(time.time()), raw_message
+                )
+                if status != "OK":
+                    raise imaplib.IMAP4.error(f"APPEND to {smtp.imap_sent_folder} failed: {data}")
+                appended += 1
+        except BaseException:
+            _close(imap)
+            # Drop what was appended before the failure; the rest is retried
+            client.ltrim(key, appended, -1)
+            _discard(client, smtp.pk, batch[:appended])
+            raise
+        finally:
+            archived += appended
+        _keep(smtp, imap)
+        client.ltrim(key, len(batch), -1)
+        _discard(client, smtp.pk, batch)
+    return archived
+
+
+def close_all() -> None:
+    """Log out of every kept IMAP session in this process."""
+    with _lock:
+        sessions = [imap for imap, _ in _sessions.values()]
+        _sessions.clear()
+    for imap in sessions:
+        _close(imap)
+
+
+@worker_process_shutdown.connect
+def _close_sessions_on_shutdown(**kwargs):
+    close_all()
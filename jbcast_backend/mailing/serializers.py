@@ -1,13 +1,32 @@
+import re
+
 from rest_framework import serializers
-from .models import EmailFile, EmailRecord
+from .chunked_upload import UPLOAD_CHUNK_SIZE, UPLOAD_MAX_BYTES
+from .models import CampaignContent, EmailFile, EmailRecord, UploadSession
+
+ALLOWED_UPLOAD_EXTENSIONS = ['.csv', '.xls', '.xlsx']
+
+
+class CampaignContentSerializer(serializers.ModelSerializer):
+    """Shared subject/body for a campaign (sent once per file, not per record)."""
+    class Meta:
+        model = CampaignContent
+        fields = ['id', 'subject', 'body']
 
 
 class EmailRecordSerializer(serializers.ModelSerializer):
     """
     Serializer for individual email records associated with an uploaded file.
+    - `subject`: effective subject (record override or shared content)
+    - `body`: only set when this record's body differs from the file's content;
+      otherwise null (the shared body is exposed once on the file)
     - `attachments`: read-only list derived from the model's `attachments_urls`
     - `attachments_urls`: raw comma-separated URLs string (read-only)
+    - `attachment_errors`: {url: error} for attachments the prefetch could not fetch
+    - `next_attempt_at`: when a temporarily failed (4xx) send is retried, else null
     """
+    subject = serializers.SerializerMethodField(read_only=True)
+    body = serializers.SerializerMethodField(read_only=True)
     attachments = serializers.SerializerMethodField(read_only=True)
     attachments_urls = serializers.CharField(read_only=True, allow_blank=True, allow_null=True)
 
@@ -16,16 +35,27 @@ class EmailRecordSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'email', 'subject', 'body',
             'cc', 'bcc', 'is_sent', 'send_attempts',
-            'last_sent_at', 'error_message',
+            'last_sent_at', 'error_message', 'next_attempt_at',
             # New
-            'attachments_urls', 'attachments',
+            'attachments_urls', 'attachments', 'attachment_errors',
         ]
         read_only_fields = [
             'id', 'is_sent', 'send_attempts',
-            'last_sent_at', 'error_message',
-            'attachments_urls', 'attachments',
+            'last_sent_at', 'error_message', 'next_attempt_at',
+            'attachments_urls', 'attachments', 'attachment_errors',
         ]
 
+    def get_subject(self, obj):
+        return obj.effective_subject
+
+    def get_body(self, obj):
+        if obj.body is not None:
+            return obj.body
+        # obj.file is populated by the reverse prefetch, so this costs no query
+        if obj.content_id and obj.content_id != obj.file.content_id:
+            return obj.content.body
+        return None
+
     def get_attachments(self, obj):
         """Returns a clean list of http(s) URLs parsed from attachments_urls."""
         return obj.attachments_list
@@ -37,16 +67,52 @@ class EmailFileUploadSerializer(serializers.ModelSerializer):
     """
     class Meta:
         model = EmailFile
-        fields = ['id', 'title', 'file', 'uploaded_at']
+        fields = ['id', 'title', 'file', 'archive_to_sent', 'uploaded_at']
         read_only_fields = ['id', 'uploaded_at']
 
     def validate_file(self, file):
-        allowed_types = ['.csv', '.xls', '.xlsx']
-        if not any(str(file.name).lower().endswith(ext) for ext in allowed_types):
+        if not any(str(file.name).lower().endswith(ext) for ext in ALLOWED_UPLOAD_EXTENSIONS):
             raise serializers.ValidationError("Only .csv, .xls, and .xlsx files are allowed.")
         return file
 
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Chunked upload session. Created with title/filename/total_size/sha256;
+    `received_bytes` is the offset the next chunk must start at.
+    """
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id', 'title', 'filename', 'total_size', 'sha256', 'archive_to_sent',
+            'received_bytes', 'chunk_size', 'status', 'email_file', 'created_at',
+        ]
+        read_only_fields = ['id', 'received_bytes', 'chunk_size', 'status', 'email_file', 'created_at']
+
+    def get_chunk_size(self, obj):
+        return UPLOAD_CHUNK_SIZE
+
+    def validate_filename(self, filename):
+        if not any(filename.lower().endswith(ext) for ext in ALLOWED_UPLOAD_EXTENSIONS):
+            raise serializers.ValidationError("Only .csv, .xls, and .xlsx files are allowed.")
+        return filename
+
+    def validate_total_size(self, total_size):
+        if total_size <= 0:
+            raise serializers.ValidationError("File is empty.")
+        if total_size > UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f"File exceeds the {UPLOAD_MAX_BYTES} byte limit.")
+        return total_size
+
+    def validate_sha256(self, sha256):
+        sha256 = sha256.lower()
+        if not re.fullmatch(r"[0-9a-f]{64}", sha256):
+            raise serializers.ValidationError("Expected a hex-encoded SHA-256 digest.")
+        return sha256
+
+
 class EmailFileListSerializer(serializers.ModelSerializer):
     """
     Serializer for listing uploaded files, including sent/total counts.
@@ -63,14 +129,19 @@ class EmailFileListSerializer(serializers.ModelSerializer):
 class EmailFileDetailSerializer(serializers.ModelSerializer):
     """
     Serializer for showing file detail along with nested email records and counts.
+    The campaign subject/body is serialized once as `content`.
     """
+    content = CampaignContentSerializer(read_only=True)
     email_records = EmailRecordSerializer(many=True, read_only=True)
     sent_count = serializers.SerializerMethodField()
     total_count = serializers.SerializerMethodField()
 
     class Meta:
         model = EmailFile
-        fields = ['id', 'title', 'uploaded_at', 'sent_count', 'total_count', 'email_records']
+        fields = [
+            'id', 'title', 'uploaded_at', 'sent_count', 'total_count',
+            'archive_to_sent', 'attachments_prefetched_at', 'content', 'email_records',
+        ]
 
     def get_total_count(self, obj):
         # Use annotation if present; otherwise compute
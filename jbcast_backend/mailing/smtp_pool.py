@@ -0,0 +1,205 @@
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from celery.signals import worker_process_shutdown
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.message import sanitize_address
+
+logger = get_task_logger(__name__)
+
+# -----------------------------
+# Worker-local SMTP connection pool
+# -----------------------------
+# Opening an SMTP session costs TCP + STARTTLS + AUTH (often several hundred ms),
+# far more than sending one message. Each worker process keeps a few
+# authenticated sessions per SMTPAccount and reuses them across tasks:
+#   - a session idle for more than SMTP_POOL_NOOP_AFTER seconds is checked
+#     with NOOP before reuse and replaced if the server dropped it
+#   - a session is closed after SMTP_POOL_MAX_MESSAGES messages (servers
+#     often cap messages per connection)
+#   - sessions idle for more than SMTP_POOL_IDLE_TIMEOUT seconds are closed
+# The pool lives in module state, so with the prefork pool it is per child process.
+
+SMTP_POOL_MAX_MESSAGES = getattr(settings, "SMTP_POOL_MAX_MESSAGES", 100)
+SMTP_POOL_IDLE_TIMEOUT = getattr(settings, "SMTP_POOL_IDLE_TIMEOUT", 60)  # seconds
+SMTP_POOL_NOOP_AFTER = getattr(settings, "SMTP_POOL_NOOP_AFTER", 5)  # seconds idle before a NOOP check
+SMTP_POOL_MAX_IDLE = getattr(settings, "SMTP_POOL_MAX_IDLE", 2)  # idle sessions kept per account
+
+
+class SessionUnavailable(Exception):
+    """No session could be opened for the account (DNS, refused, TLS, AUTH, ...); see __cause__."""
+
+
+class PooledEmailBackend(EmailBackend):
+    """Django SMTP backend that counts messages and usage for pool recycling."""
+
+    def __init__(self, **kwargs):
+        super().__init__(fail_silently=False, **kwargs)
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+    def send_messages(self, email_messages):
+        sent = super().send_messages(email_messages)
+        self.messages_sent += sent or 0
+        self.last_used = time.monotonic()
+        return sent
+
+    def send_serialized(self, email_message) -> bytes:
+        """
+        Send one message as send_messages() would and return the bytes that went
+        over the wire, so a caller that also needs the raw message (the Sent
+        folder, mailing.sent_archive) does not serialise it a second time.
+        """
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(addr, encoding) for addr in email_message.recipients()]
+        raw_message = email_message.message().as_bytes(linesep="\r\n")
+        self.connection.sendmail(from_email, recipients, raw_message)
+        self.messages_sent += 1
+        self.last_used = time.monotonic()
+        return raw_message
+
+    def ensure_open(self) -> None:
+        """
+        For long batches: recycle at the message cap, reconnect if the session was
+        closed. Raises SessionUnavailable if the new session cannot be opened.
+        """
+        if self.connection is not None and self.messages_sent >= SMTP_POOL_MAX_MESSAGES:
+            self.close()
+        if self.connection is None:
+            self.messages_sent = 0
+            try:
+                self.open()
+            except Exception as e:
+                raise SessionUnavailable(str(e)) from e
+
+    def is_alive(self) -> bool:
+        if self.connection is None:
+            return False
+        try:
+            return self.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+
+_idle = {}  # pool key -> [PooledEmailBackend], most recently used last
+_lock = threading.Lock()
+
+
+def _pool_key(smtp):
+    # Credentials are part of the key so an edited account never reuses an old session
+    return (smtp.pk, smtp.email_host, smtp.email_port, smtp.email_host_user,
+            smtp.email_host_password, smtp.use_tls)
+
+
+def _close(backend) -> None:
+    try:
+        backend.close()
+    except Exception:
+        pass
+
+
+def _take_expired(now) -> list:
+    """Remove and return idle sessions past SMTP_POOL_IDLE_TIMEOUT (caller holds _lock)."""
+    expired = []
+    for key in list(_idle):
+        keep = []
+        for backend in _idle[key]:
+            if now - backend.last_used > SMTP_POOL_IDLE_TIMEOUT:
+                expired.append(backend)
+            else:
+                keep.append(backend)
+        if keep:
+            _idle[key] = keep
+        else:
+            del _idle[key]
+    return expired
+
+
+def _checkout(smtp) -> PooledEmailBackend:
+    key = _pool_key(smtp)
+    now = time.monotonic()
+    with _lock:
+        expired = _take_expired(now)
+        sessions = _idle.get(key)
+        backend = sessions.pop() if sessions else None
+    for stale in expired:
+        _close(stale)
+
+    if backend is not None:
+        if now - backend.last_used < SMTP_POOL_NOOP_AFTER or backend.is_alive():
+            return backend
+        _close(backend)
+
+    backend = PooledEmailBackend(
+        host=smtp.email_host,
+        port=smtp.email_port,
+        username=smtp.email_host_user,
+        password=smtp.email_host_password,
+        use_tls=smtp.use_tls,
+    )
+    backend.open()
+    logger.debug(f"Opened SMTP session for account {smtp.pk} ({smtp.email_host})")
+    return backend
+
+
+def _release(smtp, backend) -> None:
+    if backend.connection is None or backend.messages_sent >= SMTP_POOL_MAX_MESSAGES:
+        _close(backend)
+        return
+    backend.last_used = time.monotonic()
+    with _lock:
+        sessions = _idle.setdefault(_pool_key(smtp), [])
+        sessions.append(backend)
+        surplus = sessions[:-SMTP_POOL_MAX_IDLE] if len(sessions) > SMTP_POOL_MAX_IDLE else []
+        del sessions[:len(surplus)]
+    for extra in surplus:
+        _close(extra)
+
+
+@contextmanager
+def connection(smtp):
+    """
+    Borrow an open, authenticated connection for an SMTPAccount:
+
+        with smtp_pool.connection(smtp) as conn:
+            msg.connection = conn
+            msg.send()
+
+    Raises SessionUnavailable if no session can be opened; errors raised by the
+    block propagate unchanged. The session goes back to the pool on success; if
+    the block raises, the session is closed instead, since its SMTP state is unknown.
+    """
+    try:
+        backend = _checkout(smtp)
+    except Exception as e:
+        raise SessionUnavailable(str(e)) from e
+    try:
+        yield backend
+    except BaseException:
+        _close(backend)
+        raise
+    try:
+        _release(smtp, backend)
+    except Exception as e:
+        # The block's work is done; losing the session only costs a reconnect
+        logger.warning(f"Could not return SMTP session for account {smtp.pk} to the pool: {e}")
+        _close(backend)
+
+
+def close_all() -> None:
+    """Close every pooled session in this process."""
+    with _lock:
+        sessions = [backend for backends in _idle.values() for backend in backends]
+        _idle.clear()
+    for backend in sessions:
+        _close(backend)
+
+
+@worker_process_shutdown.connect
+def _close_pool_on_shutdown(**kwargs):
+    close_all()
@@ -0,0 +1,84 @@
+import time
+
+from django.conf import settings
+
+from .models import EmailRecord
+
+# -----------------------------
+# Buffered send-status writes
+# -----------------------------
+# A delivered message is written at once, in a one-row UPDATE, before the next
+# message goes out: is_sent and the claim release never wait in memory, so a
+# worker that dies mid-batch leaves no delivered record that reads as unsent
+# (and would be sent again). Only failures and deferrals are buffered on the
+# in-memory EmailRecord objects and written with one narrow bulk_update
+# (STATUS_FIELDS only, never subject/body) per flush: when the writer holds
+# STATUS_FLUSH_RECORDS of them, when the oldest is STATUS_FLUSH_SECONDS old,
+# and always when the send task leaves its `with` block (also on errors).
+# If the worker dies before a flush those records still read as unattempted
+# and are tried again once their lease runs out (mailing.claims). Because every
+# send task flushes before it returns, the dispatcher never sees a finished
+# window as unsent.
+
+STATUS_FLUSH_RECORDS = max(1, int(getattr(settings, "STATUS_FLUSH_RECORDS", 100)))
+STATUS_FLUSH_SECONDS = getattr(settings, "STATUS_FLUSH_SECONDS", 2)
+
+# The claim columns are included so the same write releases the record's lease
+# (mailing.claims). A writer given the claim token only writes the records still
+# claimed with it, so a task that lost its lease never clears another task's claim.
+STATUS_FIELDS = [
+    'is_sent', 'send_attempts', 'last_sent_at', 'error_message', 'updated_at', 'next_attempt_at',
+    'claim_token', 'claimed_until',
+]
+
+
+class StatusWriter:
+    """
+    Usage:
+        with StatusWriter(claim_token=token) as writer:
+            ...
+            writer.add(record)   # after updating its status fields in memory
+    """
+
+    def __init__(self, max_records: int = STATUS_FLUSH_RECORDS, max_seconds: float = STATUS_FLUSH_SECONDS,
+                 claim_token=None):
+        self.claim_token = claim_token
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.written = 0
+        self._buffer = {}  # pk -> record; a record updated twice is written once
+        self._oldest = None
+
+    def add(self, record) -> None:
+        if record.is_sent:
+            self._buffer.pop(record.pk, None)
+            self.written += self._queryset().filter(pk=record.pk).update(
+                **{name: getattr(record, name) for name in STATUS_FIELDS}
+            )
+            return
+        if not self._buffer:
+            self._oldest = time.monotonic()
+        self._buffer[record.pk] = record
+        if len(self._buffer) >= self.max_records or time.monotonic() - self._oldest >= self.max_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        records = list(self._buffer.values())
+        self.written += self._queryset().bulk_update(records, STATUS_FIELDS)
+        self._buffer = {}
+        self._oldest = None
+
+    def _queryset(self):
+        queryset = EmailRecord.objects.all()
+        if self.claim_token is not None:
+            queryset = queryset.filter(claim_token=self.claim_token)
+        return queryset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
@@ -1,36 +1,57 @@
+import io
 import os
 import time
+import functools
+import itertools
 import math
 import re
 import uuid
 import shutil
+import smtplib
 import mimetypes
 import tempfile
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
 from urllib.parse import urlparse, parse_qs
 
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
-from celery import shared_task, group
+from celery import shared_task, chord
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min, Q
 from django.utils import timezone
-from django.core.mail import EmailMultiAlternatives, get_connection
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags, escape
-
-from .models import EmailFile, EmailRecord, SMTPAccount
+from django.utils.dateparse import parse_datetime
+from django.core.mail import EmailMultiAlternatives
+from django.utils.html import escape
+
+from . import (
+    chunked_upload, claims, domains, mime_parts, progress, quota, rendering, send_control, senders, sent_archive,
+    smtp_pool,
+)
+from .attachment_cache import AttachmentCache
+from .csv_shards import CsvShardReader, plan_csv_shards
+from .models import CampaignContent, EmailFile, EmailRecord, RejectedRow, SMTPAccount, UploadSession
+from .status_writer import StatusWriter
 
 logger = get_task_logger(__name__)
 
 # -----------------------------
 # Attachment download defaults (self-contained)
 # -----------------------------
-# tmp root: <BASE_DIR>/email_attachments_tmp or /tmp/email_attachments_tmp
-ATT_TMP_ROOT = os.path.join(getattr(settings, "BASE_DIR", "/tmp"), "email_attachments_tmp")
+# tmp root (per-email temp dirs + the shared download cache); outside the checkout by default
+ATT_TMP_ROOT = getattr(settings, "ATT_TMP_ROOT", os.path.join(tempfile.gettempdir(), "jbcast_attachments"))
 ATT_TIMEOUT = 30  # seconds per request
 ATT_PER_FILE_MAX_MB = 20
 ATT_TOTAL_MAX_MB = 25
 ATT_ALLOWED_SCHEMES = {"http", "https"}
+ATT_FETCH_CONCURRENCY = max(1, int(getattr(settings, "ATT_FETCH_CONCURRENCY", 4)))  # downloads in flight per worker process
+ATT_FETCH_PER_HOST = max(1, int(getattr(settings, "ATT_FETCH_PER_HOST", 2)))  # pooled connections per host
+ATT_FETCH_DEADLINE = getattr(settings, "ATT_FETCH_DEADLINE", 60)  # seconds for all of one email's attachments
 
 # bytes
 ATT_PER_FILE_MAX = ATT_PER_FILE_MAX_MB * 1024 * 1024
@@ -38,6 +59,101 @@ ATT_TOTAL_MAX = ATT_TOTAL_MAX_MB * 1024 * 1024
 
 os.makedirs(ATT_TMP_ROOT, exist_ok=True)
 
+# Downloads are shared across recipients (and worker processes) through this cache
+attachment_downloads = AttachmentCache(os.path.join(ATT_TMP_ROOT, "cache"))
+
+# Cache misses are fetched concurrently over one keep-alive session per worker
+# process; each host gets at most ATT_FETCH_PER_HOST connections (further
+# requests to it wait for a free one), so several slow attachments on one row
+# cost about as long as the slowest one instead of their sum.
+_http = None
+_fetch_pool = None
+_fetch_lock = threading.Lock()
+
+
+def _http_session() -> requests.Session:
+    global _http
+    with _fetch_lock:
+        if _http is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=32, pool_maxsize=ATT_FETCH_PER_HOST, pool_block=True
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = "MailAttachmentFetcher/1.0"
+            _http = session
+        return _http
+
+
+def _fetch_executor() -> ThreadPoolExecutor:
+    global _fetch_pool
+    with _fetch_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=ATT_FETCH_CONCURRENCY, thread_name_prefix="att-fetch")
+        return _fetch_pool
+
+
+class _TotalLimitExceeded(ValueError):
+    pass
+
+
+class _AttachmentBudget:
+    """
+    Bytes still allowed for one email's attachments (ATT_TOTAL_MAX), shared by
+    its concurrent downloads: every chunk is debited as it arrives. Once one
+    download would go over, or the caller gives up, the others stop at their
+    next chunk.
+    """
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def take(self, n: int) -> bool:
+        with self._lock:
+            if self.closed or n > self.remaining:
+                self.closed = True
+                return False
+            self.remaining -= n
+            return True
+
+    def give_back(self, n: int) -> None:
+        with self._lock:
+            self.remaining += n
+
+    def close(self) -> None:
+        with self._lock:
+            self.closed = True
+
+# -----------------------------
+# Ingestion defaults
+# -----------------------------
+# Rows are accumulated and written with one bulk INSERT per batch (one transaction each)
+INGEST_BATCH_SIZE = max(1, int(getattr(settings, "INGEST_BATCH_SIZE", 1000)))
+# CSVs larger than one shard are split into byte ranges parsed by parallel tasks
+INGEST_SHARD_BYTES = int(getattr(settings, "INGEST_SHARD_BYTES", 32 * 1024 * 1024))
+INGEST_MAX_SHARDS = max(1, int(getattr(settings, "INGEST_MAX_SHARDS", 8)))
+
+# -----------------------------
+# Sending defaults
+# -----------------------------
+# Records handled per send task over one SMTP session (EmailFile.send_batch_size overrides)
+SEND_BATCH_SIZE = max(1, int(getattr(settings, "SEND_BATCH_SIZE", 50)))
+# Longest a send task sleeps for quota tokens before leaving records for a later window
+SEND_QUOTA_MAX_WAIT = float(getattr(settings, "SMTP_QUOTA_MAX_WAIT", 5))
+# Send tasks in flight per file: the next window is released when the current one drains
+SEND_WINDOW_BATCHES = max(1, int(getattr(settings, "SEND_WINDOW_BATCHES", 20)))
+SEND_DISPATCH_LOCK_TTL = 60 * 60  # seconds; refreshed every window
+SEND_SLOT_POLL = 0.5  # seconds between checks for a free session slot (mailing.send_control)
+# Records the dispatcher looks at per window, in windows: a long run of one
+# domain (capped per window, see mailing.domains) does not hold up the others
+SEND_DOMAIN_LOOKAHEAD = 4
+# Distinct attachment URLs per prefetch task (prefetch tasks run on their own
+# queue, see CELERY_TASK_ROUTES, so downloads never hold a send worker)
+ATT_PREFETCH_CHUNK = max(1, int(getattr(settings, "ATT_PREFETCH_CHUNK", 50)))
+
 
 def _normalize_attachments(value) -> str:
     """
@@ -81,6 +197,7 @@ def _normalize_attachments(value) -> str:
 # Google Drive helpers
 # -----------------------------
 _DRIVE_FILE_RE = re.compile(r"/file/d/([A-Za-z0-9_-]+)/")
+_DRIVE_DIRECT_PREFIX = "https://drive.google.com/uc?"
 
 
 def _drive_direct_url(url: str) -> str:
@@ -90,6 +207,10 @@ def _drive_direct_url(url: str) -> str:
     - https://drive.google.com/open?id=<ID>     -> same
     Leaves other URLs untouched.
     """
+    # Cheap substring checks first: most URLs are not Drive links, and links
+    # already rewritten at ingest must not be re-parsed on every send.
+    if "drive.google.com" not in url or url.startswith(_DRIVE_DIRECT_PREFIX):
+        return url
     try:
         parsed = urlparse(url)
         if "drive.google.com" not in parsed.netloc:
@@ -115,6 +236,20 @@ def _drive_direct_url(url: str) -> str:
     return url
 
 
+def _normalize_attachments_column(values) -> list:
+    """
+    Normalise a whole ingest batch of 'Attachments' cells (a Series or list),
+    same order, with _normalize_attachments; Google Drive share links are
+    rewritten to direct-download form here so the stored value never needs
+    re-parsing at send time.
+    """
+    out = []
+    for value in values:
+        urls = _normalize_attachments(value)
+        out.append(",".join(_drive_direct_url(u) for u in urls.split(",")) if urls else "")
+    return out
+
+
 def _safe_filename_from_url(url: str) -> str:
     """Derive a safe filename from the URL path, prefixed with a short UUID."""
     path = urlparse(url).path
@@ -124,14 +259,18 @@ def _safe_filename_from_url(url: str) -> str:
     return f"{uuid.uuid4().hex[:8]}_{base}"
 
 
-def _download_to_temp(url: str, tmp_dir: str):
+def _download_to_temp(url: str, tmp_dir: str, extra_headers=None, budget=None):
     """
     Download a single URL to tmp_dir with size/time limits.
-    Returns dict: {path, filename, mimetype, size}. Raises on failure/limits.
+    Returns dict: {path, filename, mimetype, size, etag, last_modified}, or None
+    when extra_headers made it a conditional request and the server replied
+    304 Not Modified. Raises on failure/limits. With a budget, the downloaded
+    bytes are debited from it (and given back if the download fails).
     """
     u = _drive_direct_url(url)
-    headers = {"User-Agent": "MailAttachmentFetcher/1.0"}
-    with requests.get(u, stream=True, timeout=ATT_TIMEOUT, headers=headers) as r:
+    with _http_session().get(u, stream=True, timeout=ATT_TIMEOUT, headers=extra_headers) as r:
+        if r.status_code == 304:
+            return None
         r.raise_for_status()
 
         # Determine filename (Content-Disposition > URL path)
@@ -149,35 +288,92 @@ def _download_to_temp(url: str, tmp_dir: str):
             mimetype = (mimetypes.guess_type(filename)[0]) or "application/octet-stream"
 
         # Enforce Content-Length if present
+        try:
+            cl = int(r.headers.get("Content-Length") or -1)
+        except ValueError:
+            cl = -1
+        if cl > ATT_PER_FILE_MAX:
+            raise ValueError(f"Attachment too large (>{ATT_PER_FILE_MAX_MB}MB): {url}")
+        if budget is not None and cl > budget.remaining:
+            budget.close()
+            raise _TotalLimitExceeded(url)
+
+        # Stream to disk with rolling size checks (this file, and the email's total)
         total = 0
-        if r.headers.get("Content-Length"):
-            try:
-                cl = int(r.headers["Content-Length"])
-                if cl > ATT_PER_FILE_MAX:
-                    raise ValueError(f"Attachment too large (>{ATT_PER_FILE_MAX_MB}MB): {url}")
-            except Exception:
-                pass
-
-        # Stream to disk with rolling size check
         os.makedirs(tmp_dir, exist_ok=True)
         out_path = os.path.join(tmp_dir, filename)
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if not chunk:
-                    continue
-                total += len(chunk)
-                if total > ATT_PER_FILE_MAX:
-                    raise ValueError(f"Attachment exceeded per-file limit (>{ATT_PER_FILE_MAX_MB}MB): {url}")
-                f.write(chunk)
+        try:
+            with open(out_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=8192):
+                    if not chunk:
+                        continue
+                    if budget is not None and not budget.take(len(chunk)):
+                        raise _TotalLimitExceeded(url)
+                    total += len(chunk)
+                    if total > ATT_PER_FILE_MAX:
+                        raise ValueError(f"Attachment exceeded per-file limit (>{ATT_PER_FILE_MAX_MB}MB): {url}")
+                    f.write(chunk)
+        except _TotalLimitExceeded:
+            raise
+        except Exception:
+            if budget is not None:
+                budget.give_back(total)
+            raise
 
-    return {"path": out_path, "filename": filename, "mimetype": mimetype, "size": total}
+    return {
+        "path": out_path, "filename": filename, "mimetype": mimetype, "size": total,
+        "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"),
+    }
 
 
-def _prepare_attachments_temp(urls) -> tuple[list, list, str]:
+def _cached_attachment(url: str, tmp_dir: str, budget=None, staged_at: float = None):
+    """
+    Fetch one URL through the shared download cache (keyed by the normalised
+    URL) and hard-link the cached bytes into tmp_dir. Same dict as _download_to_temp.
+    The size is debited from budget (while downloading on a miss, afterwards on a hit).
+    With staged_at (the prefetch timestamp) a copy validated since then is used
+    without contacting the origin; only a missing copy is downloaded.
     """
-    Given a list of URLs, download each into a per-email temp directory.
+    downloaded = False
+
+    def fetch(u, dest_dir, extra_headers):
+        nonlocal downloaded
+        meta = _download_to_temp(u, dest_dir, extra_headers, budget=budget)
+        downloaded = meta is not None
+        return meta
+
+    key_url = _drive_direct_url(url)
+    cached = None
+    if staged_at is not None:
+        # Anything still fresh when the prefetch ran was validated by it
+        cached = attachment_downloads.peek(key_url, staged_at - attachment_downloads.revalidate_after)
+    if cached is None:
+        if staged_at is not None:
+            logger.info(f"Attachment was not staged on this host, downloading: {url}")
+        cached = attachment_downloads.get(key_url, fetch)
+    if budget is not None and not downloaded and not budget.take(cached["size"]):
+        raise _TotalLimitExceeded(url)
+    out_path = os.path.join(tmp_dir, cached["filename"])
+    try:
+        os.link(cached["path"], out_path)
+    except FileExistsError:
+        pass  # the same URL listed twice on one row
+    except OSError:
+        shutil.copyfile(cached["path"], out_path)
+    return {"path": out_path, "filename": cached["filename"], "mimetype": cached["mimetype"], "size": cached["size"]}
+
+
+def _prepare_attachments_temp(urls, staged_at: float = None, failed=None) -> tuple[list, list, str]:
+    """
+    Given a list of URLs, place each into a per-email temp directory (from the
+    shared download cache, downloading only on a miss or a changed file).
+    URLs are fetched concurrently; ATT_TOTAL_MAX is enforced across all of
+    them as bytes arrive, and whatever is unfinished after ATT_FETCH_DEADLINE
+    is reported as an error. Attachments keep the order of `urls`.
+    staged_at: see _cached_attachment. failed: {url: error} from the prefetch
+    stage; those URLs are reported, not fetched again.
     Returns (attachments_meta, errors, temp_dir)
-      - attachments_meta: list of dicts as returned by _download_to_temp
+      - attachments_meta: list of dicts as returned by _cached_attachment
       - errors: list of error strings for any failures
       - temp_dir: the created temporary directory to clean up later
     """
@@ -185,37 +381,41 @@ def _prepare_attachments_temp(urls) -> tuple[list, list, str]:
         return [], [], None
 
     temp_dir = tempfile.mkdtemp(prefix="mail_", dir=ATT_TMP_ROOT)
+    budget = _AttachmentBudget(ATT_TOTAL_MAX)
+    pool = _fetch_executor()
+    failed = failed or {}
+    futures = [
+        None if url in failed else pool.submit(_cached_attachment, url, temp_dir, budget, staged_at)
+        for url in urls
+    ]
+    _, pending = wait_for_futures([f for f in futures if f is not None], timeout=ATT_FETCH_DEADLINE)
+    if pending:
+        budget.close()  # stops downloads still streaming
+        for future in pending:
+            future.cancel()
+
     errors = []
     metas = []
-    total_size = 0
-
-    for url in urls:
+    over_limit = False
+    for url, future in zip(urls, futures):
+        if future is None:
+            errors.append(f"{url}: {failed[url]}")
+            continue
+        if future in pending:
+            errors.append(f"{url}: not downloaded within {ATT_FETCH_DEADLINE}s")
+            continue
         try:
-            meta = _download_to_temp(url, temp_dir)
-            total_size += meta["size"]
-            if total_size > ATT_TOTAL_MAX:
-                errors.append(f"Total attachments exceeded limit (>{ATT_TOTAL_MAX_MB}MB). Skipped remaining.")
-                break
-            metas.append(meta)
+            metas.append(future.result())
+        except _TotalLimitExceeded:
+            over_limit = True
         except Exception as e:
             errors.append(f"{url}: {str(e)}")
+    if over_limit:
+        errors.append(f"Total attachments exceeded limit (>{ATT_TOTAL_MAX_MB}MB). Skipped remaining.")
 
     return metas, errors, temp_dir
 
 
-# -----------------------------
-# HTML detection for body rendering
-# -----------------------------
-_HTML_TAG_RE = re.compile(r'</?[a-z][\s\S]*?>', re.IGNORECASE)
-
-
-def _looks_like_html(text: str) -> bool:
-    """Heuristic: does the string contain any HTML tag-like patterns?"""
-    if not text:
-        return False
-    return bool(_HTML_TAG_RE.search(text))
-
-
 # -----------------------------
 # XLSX rich-text helpers (best-effort)
 # -----------------------------
@@ -231,7 +431,7 @@ def _xlsx_cell_to_string_or_html(cell) -> str:
         return ""
 
     s = str(v)
-    if _looks_like_html(s):
+    if rendering.looks_like_html(s):
         # Already HTML-ish, keep as-is
         return s
 
@@ -240,14 +440,18 @@ def _xlsx_cell_to_string_or_html(cell) -> str:
         from openpyxl.cell.rich_text import CellRichText, TextBlock  # type: ignore
         if isinstance(v, CellRichText):
             parts = []
-            for block in v:  # iterate TextBlock runs
-                txt = escape(getattr(block, "text", "") or "")
-                if getattr(block, "bold", False):
-                    txt = f"<b>{txt}</b>"
-                if getattr(block, "italic", False):
-                    txt = f"<i>{txt}</i>"
-                if getattr(block, "underline", False):
-                    txt = f"<u>{txt}</u>"
+            for block in v:  # iterate runs: plain str or TextBlock(font, text)
+                if isinstance(block, TextBlock):
+                    font = block.font
+                    txt = escape(block.text or "").replace("\u2028", "\n")
+                    if getattr(font, "b", False):
+                        txt = f"<b>{txt}</b>"
+                    if getattr(font, "i", False):
+                        txt = f"<i>{txt}</i>"
+                    if getattr(font, "u", None):
+                        txt = f"<u>{txt}</u>"
+                else:
+                    txt = escape(str(block)).replace("\u2028", "\n")
                 parts.append(txt)
             return "".join(parts)
     except Exception:
@@ -258,14 +462,119 @@ def _xlsx_cell_to_string_or_html(cell) -> str:
     return s.replace("\u2028", "\n")
 
 
-def _read_defaults_and_rows(file_path: str):
+def _iter_xlsx_rows(ws, header_map, min_row: int = 2):
+    """
+    Stream data rows (min_row onwards; row 1 is the header) from a read-only
+    worksheet, one dict per row. Only the Body cell goes through the
+    rich-text → HTML conversion.
+    """
+    def col(name):
+        return header_map.get(name)
+
+    def text(cells, name):
+        idx = col(name)
+        if idx is None or idx >= len(cells):
+            return ""
+        return str(cells[idx].value or "").strip()
+
+    for cells in ws.iter_rows(min_row=min_row):
+        body_idx = col("Body")
+        attachments_idx = col("Attachments")
+        body = ""
+        if body_idx is not None and body_idx < len(cells):
+            body = _xlsx_cell_to_string_or_html(cells[body_idx])
+        attachments_raw = None
+        if attachments_idx is not None and attachments_idx < len(cells):
+            attachments_raw = cells[attachments_idx].value
+        yield {
+            "Name": text(cells, "Name"),
+            "Email": text(cells, "Email"),
+            "Subject": text(cells, "Subject"),
+            "Body": body,
+            "Attachments": attachments_raw,
+        }
+
+
+def _batched(rows, size):
+    """Group an iterable of row dicts into lists of at most `size` rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Columns every ingested row dict carries (missing columns become "" / None)
+_INGEST_TEXT_COLUMNS = ("Name", "Email", "Subject")
+
+
+def _frame_to_rows(df) -> list:
+    """
+    Vectorised normalisation of one DataFrame chunk into row dicts:
+      - Name/Email/Subject: NaN → "", cast to str, stripped
+      - Body: NaN → "", \u2028 normalised to newline (HTML typed by the user is kept)
+      - Attachments: validated URL string via _normalize_attachments_column
+    """
+    try:
+        df.columns = df.columns.str.strip()
+    except Exception:
+        pass
+
+    out = pd.DataFrame(index=df.index)
+    for name in _INGEST_TEXT_COLUMNS:
+        if name in df.columns:
+            out[name] = df[name].fillna("").astype(str).str.strip()
+        else:
+            out[name] = ""
+    if "Body" in df.columns:
+        out["Body"] = df["Body"].fillna("").astype(str).str.replace("\u2028", "\n", regex=False)
+    else:
+        out["Body"] = ""
+    if "Attachments" in df.columns:
+        out["Attachments"] = _normalize_attachments_column(df["Attachments"])
+    else:
+        out["Attachments"] = ""
+    return out.to_dict("records")
+
+
+def _iter_frame_chunks(file_path: str, chunk_size: int, skip_rows: int = 0):
+    """
+    Yield DataFrame chunks of at most `chunk_size` rows, starting after the first
+    `skip_rows` data rows (resume). CSV is read incrementally (chunksize) so memory
+    stays flat, and skipped records are only tokenised, never converted; .xls has
+    no streaming reader in pandas, so it is loaded once and sliced.
+    """
+    if file_path.endswith('.csv'):
+        # dtype=str: keep values verbatim (no float coercion of numeric-looking cells);
+        # skiprows counts records (not physical lines), so quoted newlines are safe
+        skiprows = range(1, skip_rows + 1) if skip_rows else None
+        with pd.read_csv(file_path, dtype=str, chunksize=chunk_size, skiprows=skiprows) as reader:
+            yield from reader
+    elif file_path.endswith(('.xls', '.xlsx')):  # .xlsx here only if openpyxl import failed
+        df = pd.read_excel(file_path, dtype=str)
+        for offset in range(skip_rows, len(df), chunk_size):
+            yield df.iloc[offset:offset + chunk_size]
+    else:
+        raise ValueError("Unsupported file format. Only CSV, XLS, and XLSX are allowed.")
+
+
+def _read_defaults_and_batches(file_path: str, batch_size: int = INGEST_BATCH_SIZE, skip_rows: int = 0):
     """
     Unified reader:
-      - For .xlsx: use openpyxl to best-effort preserve Body formatting.
-      - For .csv/.xls: use pandas; rich formatting is not present in these formats,
-        but HTML typed into cells will be preserved as text.
-    Returns (rows: list[dict], default_subject: str, default_body: str)
+      - For .xlsx: use openpyxl in read-only (streaming) mode with rich text enabled,
+        to best-effort preserve Body formatting with constant memory.
+      - For .csv/.xls: use pandas in chunks with vectorised column normalisation;
+        rich formatting is not present in these formats, but HTML typed into cells
+        will be preserved as text.
+    Returns (batches: iterable[list[dict]], default_subject: str, default_body: str)
     where each dict minimally has keys: Name, Email, Subject, Body, Attachments
+    (Attachments already normalised to a validated, comma-separated URL string).
+    Batches are generated lazily; iterate them exactly once. With skip_rows > 0
+    (resuming from a checkpoint) defaults still come from the first data row, but
+    batches start after the first `skip_rows` data rows.
     """
     ext = os.path.splitext(file_path)[1].lower()
 
@@ -277,120 +586,367 @@ def _read_defaults_and_rows(file_path: str):
             ext = ".xlsfallback"  # force pandas path
 
     if ext == ".xlsx":
-        wb = load_workbook(file_path, data_only=True)  # read-only False to access rich text
-        ws = wb.active
+        # read_only streams rows from the zip; rich_text keeps Body runs as CellRichText
+        wb = load_workbook(file_path, read_only=True, data_only=True, rich_text=True)
+        try:
+            ws = wb.active
 
-        # Build header map (strip spaces)
-        header_map = {}
-        for col in range(1, ws.max_column + 1):
-            key = ws.cell(row=1, column=col).value
-            if key is not None:
-                header_map[str(key).strip()] = col
+            # Build header map (strip spaces) → 0-based column index
+            header_map = {}
+            for header in ws.iter_rows(min_row=1, max_row=1, values_only=True):
+                for idx, key in enumerate(header):
+                    if key is not None:
+                        header_map[str(key).strip()] = idx
 
-        def col(name):
-            return header_map.get(name)
+            rows = _iter_xlsx_rows(ws, header_map)
+            first = next(rows, None)
+        except Exception:
+            wb.close()
+            raise
 
-        # Defaults from first data row (row 2)
-        default_subject = ""
-        default_body = ""
-        if col("Subject"):
-            default_subject = str(ws.cell(row=2, column=col("Subject")).value or "").strip()
-        if col("Body"):
-            default_body = _xlsx_cell_to_string_or_html(ws.cell(row=2, column=col("Body")))
-
-        rows = []
-        for r in range(2, ws.max_row + 1):
-            name = str(ws.cell(row=r, column=col("Name")).value or "").strip() if col("Name") else ""
-            email = str(ws.cell(row=r, column=col("Email")).value or "").strip() if col("Email") else ""
-            subject = str(ws.cell(row=r, column=col("Subject")).value or "").strip() if col("Subject") else ""
-            # We will use default_body later; still read per-row body in case you want to switch strategy
-            body_cell = ws.cell(row=r, column=col("Body")) if col("Body") else None
-            body = _xlsx_cell_to_string_or_html(body_cell) if body_cell else ""
-            attachments_raw = ws.cell(row=r, column=col("Attachments")).value if col("Attachments") else None
-            rows.append({
-                "Name": name,
-                "Email": email,
-                "Subject": subject,
-                "Body": body,
-                "Attachments": attachments_raw,
-            })
-        wb.close()
-        return rows, default_subject, default_body
-
-    # Fallback: CSV / XLS (pandas)
-    if file_path.endswith('.csv'):
-        df = pd.read_csv(file_path)
-    elif file_path.endswith(('.xls', '.xlsx')):  # .xlsx here only if openpyxl import failed
-        df = pd.read_excel(file_path)
-    else:
-        raise ValueError("Unsupported file format. Only CSV, XLS, and XLSX are allowed.")
+        if first is None:
+            wb.close()
+            return [], "", ""
 
-    if df.empty:
+        # Defaults from first data row (row 2)
+        default_subject = first["Subject"]
+        default_body = first["Body"]
+        if skip_rows:
+            rows.close()
+            rows = _iter_xlsx_rows(ws, header_map, min_row=2 + skip_rows)
+        else:
+            rows = itertools.chain([first], rows)
+
+        def stream():
+            try:
+                for batch in _batched(rows, batch_size):
+                    normalized = _normalize_attachments_column([r["Attachments"] for r in batch])
+                    for row, urls in zip(batch, normalized):
+                        row["Attachments"] = urls
+                    yield batch
+            finally:
+                wb.close()
+
+        return stream(), default_subject, default_body
+
+    # Fallback: CSV / XLS (pandas, chunked)
+    if skip_rows:
+        default_subject, default_body = _read_first_row_defaults(file_path)
+        chunks = _iter_frame_chunks(file_path, batch_size, skip_rows)
+        return (_frame_to_rows(chunk) for chunk in chunks), default_subject, default_body
+
+    chunks = _iter_frame_chunks(file_path, batch_size)
+    first_batch = []
+    for chunk in chunks:
+        first_batch = _frame_to_rows(chunk)
+        if first_batch:
+            break
+
+    if not first_batch:
+        chunks.close()
         return [], "", ""
 
-    try:
-        df.columns = df.columns.str.strip()
-    except Exception:
-        pass
+    default_subject = first_batch[0]["Subject"]
+    default_body = first_batch[0]["Body"]
+
+    def stream():
+        try:
+            yield first_batch
+            for chunk in chunks:
+                yield _frame_to_rows(chunk)
+        finally:
+            chunks.close()
 
-    first_row = df.iloc[0]
-    default_subject = str(first_row.get('Subject', '')).strip()
-    # Normalize special unicode line separator to newline; preserve any HTML typed by user
-    default_body = str(first_row.get('Body', '')).replace('\u2028', '\n')
+    return stream(), default_subject, default_body
 
-    rows = []
-    for _, row in df.iterrows():
-        rows.append({
-            "Name": str(row.get('Name', '')).strip(),
-            "Email": str(row.get('Email', '')).strip(),
-            "Subject": str(row.get('Subject', '')).strip(),
-            "Body": str(row.get('Body', '')).replace('\u2028', '\n'),
-            "Attachments": row.get('Attachments', None),
-        })
-    return rows, default_subject, default_body
 
+def _save_checkpoint(email_file_id, key: str, offset: int) -> None:
+    """Store the committed row offset for one ingest stream (call inside a transaction)."""
+    email_file = EmailFile.objects.select_for_update().only('id', 'ingest_checkpoints').get(id=email_file_id)
+    email_file.ingest_checkpoints[key] = offset
+    email_file.save(update_fields=['ingest_checkpoints'])
 
-@shared_task(bind=True)
+
+def _bulk_insert_records(records, rejected=(), checkpoint=None) -> int:
+    """
+    Write one batch of unsaved EmailRecord instances (and the batch's RejectedRows)
+    with bulk INSERTs inside one transaction, so a batch is either fully present
+    or absent. checkpoint=(email_file_id, key, offset) is committed with the batch.
+    Returns the number of records written.
+    """
+    if not records and not rejected and checkpoint is None:
+        return 0
+    with transaction.atomic():
+        EmailRecord.objects.bulk_create(records, batch_size=INGEST_BATCH_SIZE)
+        if rejected:
+            RejectedRow.objects.bulk_create(rejected, batch_size=INGEST_BATCH_SIZE)
+        if checkpoint is not None:
+            _save_checkpoint(*checkpoint)
+    return len(records)
+
+
+# -----------------------------
+# Recipient validation (ingest)
+# -----------------------------
+# Syntax only (no DNS): dot-atom local part, hostname labels, alphabetic or IDN TLD
+_EMAIL_RE = re.compile(
+    r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+"
+    r"(?:[A-Za-z]{2,63}|xn--[A-Za-z0-9-]{1,59})"
+)
+_EMAIL_MAX_LENGTH = 254
+
+
+class _RowValidator:
+    """
+    Per-task recipient checks: syntax via the precompiled _EMAIL_RE and
+    de-duplication on EmailRecord.key_for (hash set, first occurrence wins).
+    `seen` holds keys already taken, e.g. email_key values of existing records.
+    """
+
+    def __init__(self, seen=()):
+        self._seen = set(seen)
+
+    def rejection_reason(self, email: str):
+        if not email:
+            return RejectedRow.REASON_MISSING_EMAIL
+        if len(email) > _EMAIL_MAX_LENGTH or not _EMAIL_RE.fullmatch(email):
+            return RejectedRow.REASON_INVALID_EMAIL
+        key = EmailRecord.key_for(email)
+        if key in self._seen:
+            return RejectedRow.REASON_DUPLICATE
+        self._seen.add(key)
+        return None
+
+
+class _RowContent:
+    """
+    Resolves each row to a shared CampaignContent: the file defaults (subject/body
+    from the first data row) unless the row carries its own non-empty Subject/Body
+    that differs, in which case that combination is interned once per task.
+    """
+    CACHE_MAX = 10_000
+
+    def __init__(self, default):
+        self.default = default
+        self._cache = {default.content_hash: default}
+
+    def for_row(self, row):
+        subject = row.get("Subject") or self.default.subject
+        body = row.get("Body") or ""
+        if not body.strip():
+            body = self.default.body
+        if subject == self.default.subject and body == self.default.body:
+            return self.default
+
+        content_hash = CampaignContent.hash_for(subject, body)
+        content = self._cache.get(content_hash)
+        if content is None:
+            if len(self._cache) >= self.CACHE_MAX:
+                self._cache = {self.default.content_hash: self.default}
+            content = self._cache[content_hash] = CampaignContent.intern(subject, body)
+        return content
+
+
+def _build_records(email_file, rows, contents, validator, first_row=None) -> tuple[list, list]:
+    """
+    Turn one batch of row dicts into unsaved EmailRecords plus RejectedRows for rows
+    without a usable address. first_row is the sheet row number of rows[0], if known.
+    """
+    records = []
+    rejected = []
+    for index, row in enumerate(rows):
+        email = row.get("Email", "").strip()
+        reason = validator.rejection_reason(email)
+        if reason:
+            rejected.append(RejectedRow(
+                file=email_file,
+                row_number=first_row + index if first_row else None,
+                name=row.get("Name", "").strip()[:255],
+                email=email[:320],
+                reason=reason,
+            ))
+            continue
+
+        # Subject/body live in CampaignContent (can be HTML from xlsx rich text, or plain);
+        # the record's own subject/body stay NULL unless overridden later
+        records.append(EmailRecord(
+            file=email_file,
+            name=row.get("Name", "").strip(),
+            email=email,
+            domain=EmailRecord.domain_of(email),
+            email_key=EmailRecord.key_for(email),
+            content=contents.for_row(row),
+            cc='',
+            bcc='',
+            attachments_urls=row.get("Attachments") or '',
+            is_sent=False
+        ))
+    return records, rejected
+
+
+def _set_file_content(email_file, default_subject, default_body):
+    """Intern the campaign defaults and attach them to the file."""
+    email_file.content = CampaignContent.intern(default_subject, default_body)
+    email_file.save(update_fields=["content"])
+    return email_file.content
+
+
+def _ingest_batches(email_file, batches, content, first_row=None,
+                    checkpoint_key=None, skip_rows=0, validator=None) -> tuple[int, int]:
+    """
+    Validate and insert every batch, publishing throttled progress.
+    first_row is the sheet row number of the first batch's first row, when known.
+    With checkpoint_key, the running row offset (starting at skip_rows) is committed
+    together with each batch. Returns (rows_seen, records_created) for this run.
+    """
+    contents = _RowContent(content)
+    validator = validator or _RowValidator()
+    tracker = progress.IngestProgress(email_file.id)
+    seen_count = 0
+    created_count = 0
+    try:
+        for rows in batches:
+            row_number = first_row + seen_count if first_row else None
+            records, rejected = _build_records(email_file, rows, contents, validator, row_number)
+            seen_count += len(rows)
+            checkpoint = (email_file.id, checkpoint_key, skip_rows + seen_count) if checkpoint_key else None
+            inserted = _bulk_insert_records(records, rejected, checkpoint)
+            created_count += inserted
+            tracker.add(parsed=len(rows), inserted=inserted, rejected=len(rejected))
+    finally:
+        tracker.flush()
+    return seen_count, created_count
+
+
+def _read_first_row_defaults(file_path: str) -> tuple[str, str]:
+    """Subject/Body defaults from the first data row of a CSV/XLS, parsed like any other chunk."""
+    if file_path.endswith('.csv'):
+        df = pd.read_csv(file_path, dtype=str, nrows=1)
+    else:
+        df = pd.read_excel(file_path, dtype=str, nrows=1)
+    rows = _frame_to_rows(df)
+    if not rows:
+        return "", ""
+    return rows[0]["Subject"], rows[0]["Body"]
+
+
+def _iter_csv_shard_batches(file_path: str, header_end: int, start: int, end: int, skip_rows: int = 0):
+    """Stream one CSV byte-range shard (header prepended) as row-dict batches, after skip_rows rows."""
+    with open(file_path, "rb") as fh:
+        header = fh.read(header_end)
+    raw = CsvShardReader(file_path, header, start, end)
+    skiprows = range(1, skip_rows + 1) if skip_rows else None
+    with io.BufferedReader(raw) as stream:
+        with pd.read_csv(stream, dtype=str, chunksize=INGEST_BATCH_SIZE, skiprows=skiprows) as reader:
+            for chunk in reader:
+                yield _frame_to_rows(chunk)
+
+
+def _log_ingest_completed(email_file_id, created_count, elapsed) -> str:
+    rate = created_count / elapsed if elapsed > 0 else float(created_count)
+    logger.info(
+        f"[TASK COMPLETED] Created {created_count} records for file ID {email_file_id} "
+        f"in {elapsed:.2f}s ({rate:.0f} rows/sec)"
+    )
+    return f"Processed file ID {email_file_id} with {created_count} records ({rate:.0f} rows/sec)."
+
+
+def _dispatch_csv_shards(email_file, file_path):
+    """
+    Fan a large CSV out to parallel shard tasks joined by a chord.
+    Returns a status string when sharded, or None if the file is small enough
+    to be ingested in a single task.
+    """
+    header, shards = plan_csv_shards(file_path, INGEST_SHARD_BYTES, INGEST_MAX_SHARDS)
+    if len(shards) < 2:
+        return None
+
+    # Redelivered after the chord was sent: the shard tasks own the file now
+    # (they resume from their own checkpoints), so do not queue them twice.
+    # The marker is written only once the chord is queued; a worker lost in
+    # between queues the shards again rather than never.
+    if email_file.ingest_checkpoints.get("dispatched"):
+        logger.warning(f"[TASK SKIPPED] Ingest shards for file ID {email_file.id} were already queued")
+        return f"Ingest shards for file ID {email_file.id} already queued."
+
+    # Defaults come from the first data row of the whole file, not of each shard
+    content = _set_file_content(email_file, *_read_first_row_defaults(file_path))
+    header_end = len(header)
+    job = chord(
+        ingest_file_shard.s(email_file.id, index, header_end, start, end, content.id)
+        for index, (start, end) in enumerate(shards)
+    )
+    job(finalize_file_ingest.s(email_file.id, time.time()))
+    # Shard tasks may already be saving their checkpoints: update under the row lock
+    with transaction.atomic():
+        _save_checkpoint(email_file.id, "dispatched", len(shards))
+
+    logger.info(f"[TASK SHARDED] File ID {email_file.id} split into {len(shards)} shards")
+    return f"Queued {len(shards)} ingest shards for file ID {email_file.id}."
+
+
+def _verify_upload_checksum(email_file, file_path):
+    """Files assembled from a chunked upload must match the SHA-256 the client declared."""
+    expected = UploadSession.objects.filter(email_file=email_file).values_list('sha256', flat=True).first()
+    if expected and chunked_upload.file_sha256(file_path) != expected:
+        raise ValueError("Checksum mismatch; upload the file again.")
+
+
+# acks_late + reject_on_worker_lost: a worker killed mid-ingest (crash, deploy) gets
+# the task redelivered, and the checkpoints on EmailFile make the retry resume
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
 def process_uploaded_file(self, email_file_id):
     logger.info(f"[TASK STARTED] Processing file: {email_file_id}")
     try:
         email_file = EmailFile.objects.get(id=email_file_id)
         file_path = email_file.file.path
 
+        if email_file.ingest_completed_at:
+            logger.info(f"[TASK SKIPPED] File ID {email_file_id} was already ingested")
+            return f"File ID {email_file_id} already ingested."
+
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"Uploaded file not found at path: {file_path}")
 
-        # Read rows + defaults with best-effort formatting preservation
-        rows, default_subject, default_body = _read_defaults_and_rows(file_path)
+        progress.set_state(email_file_id, progress.STATE_PARSING)
+        # A resumed run (any checkpoint) was already verified by the first one
+        if not email_file.ingest_checkpoints:
+            _verify_upload_checksum(email_file, file_path)
+
+        # Large CSVs are parsed in parallel by shard tasks
+        if file_path.lower().endswith(".csv"):
+            sharded = _dispatch_csv_shards(email_file, file_path)
+            if sharded:
+                return sharded
+
+        # Resume after the last committed batch of an interrupted run
+        skip_rows = email_file.ingest_checkpoints.get("rows", 0)
+        validator = None
+        if skip_rows:
+            logger.info(f"[TASK RESUMED] File ID {email_file_id} resuming after {skip_rows} rows")
+            existing = EmailRecord.objects.filter(file=email_file).values_list('email_key', flat=True)
+            validator = _RowValidator(seen=existing.iterator())
+
+        # Read row batches + defaults with best-effort formatting preservation (streamed)
+        batches, default_subject, default_body = _read_defaults_and_batches(file_path, skip_rows=skip_rows)
+
+        started = time.monotonic()
+        content = _set_file_content(email_file, default_subject, default_body)
+        # Data starts on sheet row 2 (row 1 is the header)
+        seen_count, created_count = _ingest_batches(
+            email_file, batches, content, first_row=2 + skip_rows,
+            checkpoint_key="rows", skip_rows=skip_rows, validator=validator,
+        )
 
-        if not rows:
+        email_file.ingest_completed_at = timezone.now()
+        email_file.save(update_fields=["ingest_completed_at"])
+        progress.set_state(email_file_id, progress.STATE_COMPLETED)
+        if not seen_count and not skip_rows:
             logger.warning(f"Uploaded file {file_path} is empty.")
             return f"No rows to process for file ID {email_file_id}."
 
-        created_count = 0
-        for row in rows:
-            email = row.get("Email", "").strip()
-            if not email:
-                continue
-
-            attachments_urls = _normalize_attachments(row.get("Attachments", None))
-
-            # Keep existing behavior: use subject/body from the first data row as defaults
-            EmailRecord.objects.create(
-                file=email_file,
-                name=row.get("Name", "").strip(),
-                email=email,
-                subject=default_subject,
-                body=default_body,  # can be HTML (xlsx rich text → HTML) or plain (csv/xls)
-                cc='',
-                bcc='',
-                attachments_urls=attachments_urls,
-                is_sent=False
-            )
-            created_count += 1
-
-        logger.info(f"[TASK COMPLETED] Created {created_count} records for file ID {email_file_id}")
-        return f"Processed file ID {email_file_id} with {created_count} records."
+        return _log_ingest_completed(email_file_id, created_count, time.monotonic() - started)
 
     except EmailFile.DoesNotExist:
         logger.error(f"EmailFile with ID {email_file_id} does not exist.")
@@ -398,160 +954,835 @@ def process_uploaded_file(self, email_file_id):
 
     except Exception as e:
         logger.exception(f"Exception during file processing: {str(e)}")
+        progress.set_state(email_file_id, progress.STATE_FAILED, error=str(e))
         return f"Error processing file ID {email_file_id}: {str(e)}"
 
 
-@shared_task(bind=True, max_retries=3)
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def ingest_file_shard(self, email_file_id, shard_index, header_end, start, end, content_id):
+    """
+    Parse and insert one byte range of a CSV upload (see mailing.csv_shards),
+    resuming after the shard's checkpoint if it was interrupted before.
+    Returns a dict so finalize_file_ingest can aggregate the whole file.
+    """
+    result = {"shard": shard_index, "seen": 0, "created": 0, "error": ""}
+    try:
+        email_file = EmailFile.objects.get(id=email_file_id)
+        content = CampaignContent.objects.get(id=content_id)
+        checkpoint_key = f"{start}-{end}"
+        skip_rows = email_file.ingest_checkpoints.get(checkpoint_key, 0)
+        batches = _iter_csv_shard_batches(email_file.file.path, header_end, start, end, skip_rows)
+        # Duplicates against rows committed before a resume are resolved in finalize_file_ingest
+        result["seen"], result["created"] = _ingest_batches(
+            email_file, batches, content, checkpoint_key=checkpoint_key, skip_rows=skip_rows,
+        )
+        logger.info(f"[SHARD COMPLETED] File ID {email_file_id} shard {shard_index}: {result['created']} records")
+    except Exception as e:
+        logger.exception(f"Exception in ingest shard {shard_index} of file ID {email_file_id}: {str(e)}")
+        result["error"] = str(e)[:500]
+    return result
+
+
+def _reject_cross_shard_duplicates(email_file_id) -> int:
+    """
+    Keep the lowest-id record per email_key and move the rest to
+    RejectedRow(reason=duplicate). Returns the number of records removed.
+    """
+    records = EmailRecord.objects.filter(file_id=email_file_id)
+    keepers = records.values('email_key').annotate(keep=Min('id')).values('keep')
+    losers = records.exclude(id__in=keepers)
+    with transaction.atomic():
+        rejected = [
+            RejectedRow(file_id=email_file_id, name=name, email=email, reason=RejectedRow.REASON_DUPLICATE)
+            for name, email in losers.values_list('name', 'email').iterator()
+        ]
+        if not rejected:
+            return 0
+        RejectedRow.objects.bulk_create(rejected, batch_size=INGEST_BATCH_SIZE)
+        losers.delete()
+    return len(rejected)
+
+
+@shared_task
+def finalize_file_ingest(results, email_file_id, started_at):
+    """Chord callback: aggregate shard results once every shard has finished."""
+    created_count = sum(r.get("created", 0) for r in results)
+    try:
+        # Each shard only de-duplicates within itself; resolve duplicates across shards here
+        duplicates = _reject_cross_shard_duplicates(email_file_id)
+        created_count -= duplicates
+        if duplicates:
+            tracker = progress.IngestProgress(email_file_id)
+            tracker.add(inserted=-duplicates, rejected=duplicates)
+            tracker.flush()
+    except Exception as e:
+        logger.exception(f"Cross-shard de-duplication failed for file ID {email_file_id}: {str(e)}")
+    errors = [f"shard {r['shard']}: {r['error']}" for r in results if r.get("error")]
+    if errors:
+        logger.error(f"File ID {email_file_id} ingested with shard errors: {' | '.join(errors)}")
+        progress.set_state(email_file_id, progress.STATE_FAILED, error=" | ".join(errors))
+    else:
+        EmailFile.objects.filter(id=email_file_id).update(ingest_completed_at=timezone.now())
+        progress.set_state(email_file_id, progress.STATE_COMPLETED)
+    return _log_ingest_completed(email_file_id, created_count, time.time() - started_at)
+
+
+def _dispatch_lock_key(email_file_id) -> str:
+    return f"mailing:send:{email_file_id}:dispatching"
+
+
+# -----------------------------
+# Attachment prefetch (runs before the send wave)
+# -----------------------------
+# "Send all" first stages every distinct attachment URL of the file's unsent
+# records in the shared download cache, on the attachments queue. Records
+# whose attachments could not be fetched get EmailRecord.attachment_errors
+# before any email goes out, and send workers then attach the staged copies
+# without contacting the origin (a copy missing on their host, e.g. evicted,
+# is still downloaded). Prefetch workers must share ATT_TMP_ROOT with the
+# send workers (same host or shared volume) for the staged copies to be used.
+
+def _start_sending(email_file_id, batch_size, run_started):
+    dispatch_send_window.delay(email_file_id, 0, batch_size, run_started)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def prefetch_attachments_for_file(email_file_id, batch_size, run_started):
+    """Fan the file's distinct attachment URLs out to prefetch tasks, then start sending."""
+    try:
+        values = (
+            EmailRecord.objects.filter(file_id=email_file_id, is_sent=False)
+            .exclude(attachments_urls__isnull=True).exclude(attachments_urls='')
+            .order_by().values_list('attachments_urls', flat=True).distinct()
+        )
+        urls = set()
+        for value in values.iterator(chunk_size=2000):
+            urls.update(_drive_direct_url(u) for u in EmailRecord.split_attachment_urls(value))
+
+        if not urls:
+            _start_sending(email_file_id, batch_size, run_started)
+            return f"No attachments to prefetch for file ID {email_file_id}"
+
+        urls = sorted(urls)
+        header = [
+            prefetch_attachment_urls.s(urls[i:i + ATT_PREFETCH_CHUNK])
+            for i in range(0, len(urls), ATT_PREFETCH_CHUNK)
+        ]
+        chord(header)(finish_attachment_prefetch.s(email_file_id, batch_size, run_started))
+        return f"Prefetching {len(urls)} attachments for file ID {email_file_id} in {len(header)} tasks"
+
+    except Exception as e:
+        # Prefetch is an optimisation: send workers download whatever is not staged
+        logger.exception(f"Attachment prefetch failed for file ID {email_file_id}, sending without it: {str(e)}")
+        _start_sending(email_file_id, batch_size, run_started)
+        return f"Prefetch failed for file ID {email_file_id}: {str(e)}"
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def prefetch_attachment_urls(urls):
+    """
+    Download (or revalidate) normalised URLs into the shared cache, concurrently.
+    Returns {url: {"size": bytes}} or {url: {"error": message}} per URL.
+    """
+    pool = _fetch_executor()
+    futures = [(url, pool.submit(attachment_downloads.get, url, _download_to_temp)) for url in urls]
+    out = {}
+    for url, future in futures:
+        try:
+            out[url] = {"size": future.result()["size"]}
+        except Exception as e:
+            out[url] = {"error": str(e)}
+    return out
+
+
+@shared_task
+def finish_attachment_prefetch(results, email_file_id, batch_size, run_started):
+    """Chord callback: flag records with unfetchable attachments, then start sending."""
+    try:
+        outcome = {}
+        for chunk in results:
+            outcome.update(chunk)
+
+        flagged = 0
+        changed = []
+        records = (
+            EmailRecord.objects.filter(file_id=email_file_id, is_sent=False)
+            .only('id', 'attachments_urls', 'attachment_errors')
+        )
+        for record in records.iterator(chunk_size=2000):
+            errors = {}
+            for url in record.attachments_list:
+                error = outcome.get(_drive_direct_url(url), {}).get("error")
+                if error:
+                    errors[url] = error
+            flagged += bool(errors)
+            if errors != record.attachment_errors:
+                record.attachment_errors = errors
+                changed.append(record)
+            if len(changed) >= INGEST_BATCH_SIZE:
+                EmailRecord.objects.bulk_update(changed, ['attachment_errors'])
+                changed = []
+        if changed:
+            EmailRecord.objects.bulk_update(changed, ['attachment_errors'])
+
+        # Copies fetched (or still fresh) since the run started count as staged
+        EmailFile.objects.filter(id=email_file_id).update(attachments_prefetched_at=parse_datetime(run_started))
+        failed_urls = sum(1 for r in outcome.values() if r.get("error"))
+        logger.info(
+            f"[PREFETCH COMPLETED] File ID {email_file_id}: {len(outcome)} attachments, "
+            f"{failed_urls} failed, {flagged} records flagged"
+        )
+    except Exception as e:
+        logger.exception(f"Finishing attachment prefetch failed for file ID {email_file_id}: {str(e)}")
+
+    cache.set(_dispatch_lock_key(email_file_id), True, SEND_DISPATCH_LOCK_TTL)
+    _start_sending(email_file_id, batch_size, run_started)
+    return f"Prefetched attachments for file ID {email_file_id}; sending started."
+
+
+def _fill_record_domains(email_file_id) -> None:
+    """Set EmailRecord.domain on unsent records ingested before it existed."""
+    missing = EmailRecord.objects.filter(file_id=email_file_id, is_sent=False, domain='').only('id', 'email')
+    changed = []
+    for record in missing.iterator(chunk_size=2000):
+        record.domain = EmailRecord.domain_of(record.email)
+        if record.domain:
+            changed.append(record)
+        if len(changed) >= INGEST_BATCH_SIZE:
+            EmailRecord.objects.bulk_update(changed, ['domain'])
+            changed = []
+    if changed:
+        EmailRecord.objects.bulk_update(changed, ['domain'])
+
+
+@shared_task(bind=True)
 def send_emails_for_file(self, email_file_id):
     """
-    Parallelize sending by fanning out one Celery task per record.
-    Leverages worker concurrency instead of serial loop.
+    Start sending a file's unsent records. Attachments are prefetched first
+    (see prefetch_attachments_for_file). Nothing is enqueued up front:
+    dispatch_send_window pages through the records by id and releases one
+    window of send tasks at a time, so broker and result-backend memory is
+    bounded by the window size, not the campaign size.
     """
     try:
         file = EmailFile.objects.get(id=email_file_id)
-        smtp = SMTPAccount.objects.last()
-
-        # Reset daily counters if day changed (coarse-grained; per-record task also checks)
-        if smtp and smtp.last_reset.date() < timezone.now().date():
-            smtp.emails_sent_today = 0
-            smtp.rate_limited = False
-            smtp.last_reset = timezone.now()
-            smtp.save()
-
-        # Get unsent records
-        record_ids = list(file.email_records.filter(is_sent=False).values_list('id', flat=True))
-        if not record_ids:
+
+        if not file.email_records.filter(is_sent=False).exists():
             return f"No pending emails for file ID {file.id}"
 
-        # Fan-out to parallel tasks (respecting your Celery worker pool size)
-        job = group(send_email_record.s(rid) for rid in record_ids)
-        job.apply_async()
+        # One dispatcher per file; a second "send all" while one runs is a no-op
+        if not cache.add(_dispatch_lock_key(file.id), True, SEND_DISPATCH_LOCK_TTL):
+            return f"Sending already in progress for file ID {file.id}"
 
-        return f"Queued {len(record_ids)} emails for file ID {file.id}"
+        _fill_record_domains(file.id)
+        batch_size = file.send_batch_size or SEND_BATCH_SIZE
+        run_started = timezone.now()
+        EmailFile.objects.filter(id=file.id).update(send_started_at=run_started)
+        prefetch_attachments_for_file.delay(file.id, batch_size, run_started.isoformat())
+        return f"Started sending file ID {file.id} in batches of {batch_size}"
 
     except Exception as e:
         logger.exception(f"Fatal error queueing emails: {str(e)}")
         return f"Fatal error sending emails: {str(e)}"
 
 
-@shared_task(bind=True)
-def send_email_record(self, record_id):
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def dispatch_send_window(email_file_id, after_id, batch_size, run_started=None):
     """
-    Sends a single email (HTML + plain alternative), downloads/attaches files,
-    and cleans up temporary files. Runs safely in parallel across workers.
+    Enqueue the next window of unsent records with id > after_id, as a chord
+    whose callback dispatches the window after it. A window has as many send
+    tasks as the tenant's accounts currently allow concurrent sessions (AIMD,
+    mailing.send_control), at most SEND_WINDOW_BATCHES. Each task sends to one
+    recipient domain; the domains take turns, none gets more tasks than its
+    concurrency limit and domains out of rate are skipped (mailing.domains).
+    Each record fails at most once per run (started at run_started), so records
+    that fail permanently are not picked up again; records deferred by a 4xx
+    reply are, once their next_attempt_at has passed, and records skipped because
+    every account ran out of quota are, by a pass from the start once tokens return.
+    While the tenant's accounts are out of quota the window is re-scheduled for
+    when tokens are available again, instead of queueing tasks that would wait.
     """
+    lock_key = _dispatch_lock_key(email_file_id)
     try:
-        record = EmailRecord.objects.get(id=record_id)
+        now = timezone.now()
+        pending = EmailRecord.objects.filter(
+            claims.claimable(now), Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+            file_id=email_file_id,
+        )
+        if run_started:
+            # Attempted in this run and not deferred for a retry: sent or failed for good
+            pending = pending.exclude(last_sent_at__gte=parse_datetime(run_started), next_attempt_at__isnull=True)
+
+        owner_id = EmailFile.objects.values_list('user_id', flat=True).get(id=email_file_id)
+        wait = senders.seconds_until_available(owner_id, SEND_QUOTA_MAX_WAIT)
+        if wait is None:
+            cache.delete(lock_key)
+            logger.warning(f"[SEND PAUSED] File ID {email_file_id}: no SMTP account configured")
+            return f"Sending paused for file ID {email_file_id} (no SMTP account)."
+
+        if wait:
+            # Every account of the tenant is out of quota (or unreachable)
+            delay = min(wait, SEND_DISPATCH_LOCK_TTL // 2)
+            cache.set(lock_key, True, SEND_DISPATCH_LOCK_TTL)
+            dispatch_send_window.apply_async((email_file_id, 0, batch_size, run_started), countdown=delay)
+            logger.info(f"[SEND THROTTLED] File ID {email_file_id}: quota exhausted, next window in {delay:.0f}s")
+            return f"Quota exhausted; file ID {email_file_id} resumes in {delay:.0f}s."
+
+        max_batches = min(SEND_WINDOW_BATCHES, _send_concurrency(owner_id))
+        window, cursor, blocked_for = _next_window(pending, after_id, batch_size, max_batches)
+        if not window and blocked_for:
+            # Every domain left is at its per-minute limit
+            delay = min(max(blocked_for, 1), SEND_DISPATCH_LOCK_TTL // 2)
+            cache.set(lock_key, True, SEND_DISPATCH_LOCK_TTL)
+            dispatch_send_window.apply_async((email_file_id, 0, batch_size, run_started), countdown=delay)
+            logger.info(f"[SEND THROTTLED] File ID {email_file_id}: domain rate limits, next window in {delay:.0f}s")
+            return f"Domain rate limits reached; file ID {email_file_id} resumes in {delay:.0f}s."
+        if not window:
+            # Records leased by another task (a single send, or a worker that died)
+            # are checked again when their lease ends, so crashed sends are reclaimed;
+            # records deferred by a 4xx reply when their retry is due
+            waiting = EmailRecord.objects.filter(file_id=email_file_id, is_sent=False).aggregate(
+                lease_end=Min('claimed_until', filter=Q(claimed_until__gt=now)),
+                retry_at=Min('next_attempt_at', filter=Q(next_attempt_at__gt=now)),
+            )
+            wake_at = min((t for t in waiting.values() if t), default=None)
+            if wake_at:
+                delay = min(max((wake_at - now).total_seconds(), 1), SEND_DISPATCH_LOCK_TTL // 2)
+                cache.set(lock_key, True, SEND_DISPATCH_LOCK_TTL)
+                dispatch_send_window.apply_async((email_file_id, 0, batch_size, run_started), countdown=delay)
+                return f"Waiting {delay:.0f}s for leased or deferred records of file ID {email_file_id}."
+            cache.delete(lock_key)
+            logger.info(f"[SEND COMPLETED] All windows dispatched for file ID {email_file_id}")
+            return f"Finished dispatching file ID {email_file_id}."
+
+        cache.set(lock_key, True, SEND_DISPATCH_LOCK_TTL)
+        if batch_size <= 1:
+            header = [send_email_record.s(batch[0], retry_deferred=False) for batch in window]
+        else:
+            # Chord members must store results; they are dropped once the callback fires
+            header = [send_email_batch.s(batch).set(ignore_result=False) for batch in window]
+        chord(header)(dispatch_send_window.si(email_file_id, cursor, batch_size, run_started))
+        return f"Dispatched {sum(map(len, window))} emails for file ID {email_file_id} in {len(window)} tasks."
 
-        if record.is_sent:
-            return f"Email {record.email} already sent."
+    except Exception as e:
+        cache.delete(lock_key)
+        logger.exception(f"Fatal error dispatching emails for file ID {email_file_id}: {str(e)}")
+        return f"Fatal error dispatching emails: {str(e)}"
 
-        smtp = SMTPAccount.objects.last()
-        if not smtp:
-            return "No SMTP account configured."
 
-        # Simple daily reset (race tolerant; worst-case double reset within day boundary)
-        if smtp.last_reset.date() < timezone.now().date():
-            smtp.emails_sent_today = 0
-            smtp.rate_limited = False
-            smtp.last_reset = timezone.now()
-            smtp.save()
+@shared_task
+def reclaim_expired_claims():
+    """
+    Periodic (CELERY_BEAT_SCHEDULE): resume sending for files with unsent
+    records whose claim ran out, i.e. whose send task died. The dispatcher
+    normally picks those up itself, but only while its chain of windows is
+    alive; this does not depend on it. Files with a live dispatcher (its lock
+    is held) are left to it; the expired claims of the others are dropped
+    and a dispatcher is started for the file's latest run.
+    """
+    now = timezone.now()
+    expired = EmailRecord.objects.filter(is_sent=False, claimed_until__lte=now)
+    file_ids = set(expired.values_list('file_id', flat=True).distinct())
+    resumed = 0
+    for email_file in EmailFile.objects.filter(id__in=file_ids):
+        if not cache.add(_dispatch_lock_key(email_file.id), True, SEND_DISPATCH_LOCK_TTL):
+            continue
+        expired.filter(file_id=email_file.id).update(claim_token=None, claimed_until=None)
+        run_started = email_file.send_started_at.isoformat() if email_file.send_started_at else None
+        dispatch_send_window.delay(email_file.id, 0, email_file.send_batch_size or SEND_BATCH_SIZE, run_started)
+        logger.warning(f"[SEND RESUMED] File ID {email_file.id}: reclaiming records of a lost send task")
+        resumed += 1
+    return f"Resumed sending for {resumed} of {len(file_ids)} files with expired claims."
+
 
-        if smtp.rate_limited or smtp.emails_sent_today >= 500:
-            smtp.rate_limited = True
-            smtp.save()
-            return f"Gmail quota reached for {record.file.user.email}"
+def _domain_batches(rows, batch_size, max_batches) -> tuple[list, float]:
+    """
+    Split (id, domain) rows into single-domain batches, at most the domain's
+    concurrency per domain, and interleave them round-robin (the first batch of
+    every domain, then the second, ...) up to max_batches. Domains out of rate
+    for longer than SEND_QUOTA_MAX_WAIT are skipped.
+    Returns (batches, seconds until the soonest skipped domain has rate again).
+    """
+    by_domain = {}
+    for record_id, domain in rows:
+        by_domain.setdefault(domain, []).append(record_id)
 
-        connection = None
-        temp_dir = None
+    queues = []
+    blocked_for = None
+    for domain, ids in by_domain.items():
         try:
-            connection = get_connection(
-                host=smtp.email_host,
-                port=smtp.email_port,
-                username=smtp.email_host_user,
-                password=smtp.email_host_password,
-                use_tls=smtp.use_tls
-            )
+            state = domains.take_tokens(domain, 0)
+        except Exception as e:
+            logger.warning(f"Could not read the send rate of domain {domain}: {e}")
+            state = quota.Grant(0, -1, 0.0)
+        if state.remaining == 0 and state.retry_after > SEND_QUOTA_MAX_WAIT:
+            blocked_for = state.retry_after if blocked_for is None else min(blocked_for, state.retry_after)
+            continue
+        queues.append(list(itertools.islice(_batched(ids, batch_size), domains.limits_for(domain).concurrency)))
 
-            subject = record.subject or "No Subject"
-            raw_body = record.body or ""
-            context = {
-                'name': record.name,
-                'body': raw_body,
-                'subject': subject,
-                'is_html': _looks_like_html(raw_body),
-            }
-
-            # Render template once; send as multipart/alternative
-            html_content = render_to_string("emails/default_email.html", context)
-            plain_content = strip_tags(html_content)
-
-            msg = EmailMultiAlternatives(
-                subject=subject,
-                body=plain_content,  # plain text part
-                from_email=smtp.email_host_user,
-                to=[record.email],
-                cc=record.cc.split(',') if record.cc else [],
-                bcc=record.bcc.split(',') if record.bcc else [],
-                connection=connection
-            )
-            msg.attach_alternative(html_content, "text/html")
+    batches = [batch for turn in itertools.zip_longest(*queues) for batch in turn if batch]
+    return batches[:max_batches], blocked_for
 
-            # Download + attach files (per-email temp dir)
-            attachments_meta, dl_errors, temp_dir = _prepare_attachments_temp(record.attachments_list)
-            for meta in attachments_meta:
-                with open(meta["path"], "rb") as fh:
-                    msg.attach(meta["filename"], fh.read(), meta["mimetype"])
 
-            msg.send()
+def _next_window(pending, after_id, batch_size, max_batches) -> tuple[list, int, float]:
+    """
+    The next window of batches (see _domain_batches) from the pending records
+    with id > after_id, reading SEND_DOMAIN_LOOKAHEAD windows' worth at a time.
+    Records passed over (their domain was capped or out of rate, or quota ran
+    out mid-window) are picked up by a pass from the start once the end of the
+    file is reached. Returns (batches, cursor for the next window, seconds
+    until a skipped domain has rate again when no batch could be formed).
+    """
+    lookahead = batch_size * max_batches * SEND_DOMAIN_LOOKAHEAD
+    cursor = after_id
+    wrapped = not after_id
+    blocked_for = None
+    while True:
+        rows = list(pending.filter(id__gt=cursor).order_by('id').values_list('id', 'domain')[:lookahead])
+        if not rows:
+            if wrapped:
+                return [], 0, blocked_for
+            cursor, wrapped = 0, True
+            continue
+        batches, wait = _domain_batches(rows, batch_size, max_batches)
+        cursor = rows[-1][0]
+        if batches:
+            return batches, cursor, None
+        if wait is not None:
+            blocked_for = wait if blocked_for is None else min(blocked_for, wait)
 
+
+def _send_concurrency(owner_id) -> int:
+    """Send sessions the tenant's accounts may currently run at once."""
+    try:
+        return max(1, sum(int(send_control.concurrency_limit(a)) for a in senders.accounts_for(owner_id)))
+    except Exception as e:
+        logger.warning(f"Could not read SMTP concurrency limits for user {owner_id}: {e}")
+        return SEND_WINDOW_BATCHES
+
+
+def _take_send_token(smtp) -> bool:
+    """
+    Take one send token for the account (mailing.quota), waiting up to
+    SEND_QUOTA_MAX_WAIT seconds for short-window buckets to refill.
+    False when the account is out of quota for longer than that.
+    """
+    deadline = time.monotonic() + SEND_QUOTA_MAX_WAIT
+    while True:
+        grant = quota.acquire(smtp)
+        if grant.granted:
+            return True
+        if time.monotonic() + grant.retry_after > deadline:
+            return False
+        time.sleep(grant.retry_after)
+
+
+def _give_back_send_token(smtp) -> None:
+    try:
+        quota.refund(smtp, 1)
+    except Exception as e:
+        logger.warning(f"Could not return an unused send token for SMTP account {smtp.pk}: {e}")
+
+
+def _build_message(record, smtp):
+    """
+    Render one record into an EmailMultiAlternatives (HTML + plain alternative)
+    with its attachments downloaded into a per-email temp dir.
+    Returns (msg, dl_errors, temp_dir); the caller removes temp_dir.
+    """
+    subject = record.effective_subject or "No Subject"
+    raw_body = record.effective_body or ""
+
+    # Template rendered once per subject/body (mailing.rendering); send as multipart/alternative
+    html_content, plain_content = rendering.render_email(record.name, subject, raw_body)
+
+    msg = EmailMultiAlternatives(
+        subject=subject,
+        body=plain_content,  # plain text part
+        from_email=smtp.email_host_user,
+        to=[record.email],
+        cc=record.cc.split(',') if record.cc else [],
+        bcc=record.bcc.split(',') if record.bcc else [],
+    )
+    msg.attach_alternative(html_content, "text/html")
+
+    # Attach files (per-email temp dir); staged by the prefetch stage when it ran
+    prefetched_at = record.file.attachments_prefetched_at
+    attachments_meta, dl_errors, temp_dir = _prepare_attachments_temp(
+        record.attachments_list,
+        staged_at=prefetched_at.timestamp() if prefetched_at else None,
+        failed=record.attachment_errors,
+    )
+    for meta in attachments_meta:
+        # Encoded once per file and shared by every message (mailing.mime_parts)
+        msg.attach(mime_parts.attachment_part(meta["path"], meta["filename"], meta["mimetype"]))
+    return msg, dl_errors, temp_dir
+
+
+def _mark_sent(record, dl_errors, now):
+    """Mark sent + notes (in memory; the caller persists)."""
+    record.is_sent = True
+    record.send_attempts += 1
+    record.last_sent_at = now
+    record.updated_at = now
+    record.next_attempt_at = None
+    claims.clear(record)
+    if dl_errors:
+        note = " | ".join(dl_errors)[:500]
+        record.error_message = (record.error_message or "")
+        if record.error_message:
+            record.error_message += " | "
+        record.error_message += f"Attachment notes: {note}"
+    else:
+        record.error_message = ''
+
+
+def _mark_failed(record, error_msg, dl_errors, now):
+    """Record a failed attempt (in memory; the caller persists)."""
+    record.send_attempts += 1
+    record.last_sent_at = now
+    record.updated_at = now
+    record.next_attempt_at = None
+    claims.clear(record)
+    # bubble up attachment errors if any
+    if dl_errors:
+        error_msg = f"Attachment errors: {' | '.join(dl_errors)} | Send error: {error_msg}"
+    record.error_message = error_msg
+
+
+def _mark_deferred(record, error_msg, dl_errors, now):
+    """Record a temporary (4xx) failure and when to retry it (in memory; the caller persists)."""
+    _mark_failed(record, error_msg, dl_errors, now)
+    record.next_attempt_at = now + timedelta(seconds=send_control.retry_delay(record.send_attempts))
+    record.error_message = (
+        f"Deferred, retry {record.send_attempts} of {send_control.SEND_MAX_ATTEMPTS - 1} "
+        f"at {record.next_attempt_at:%Y-%m-%d %H:%M:%S}: {record.error_message}"
+    )[:1000]
+
+
+def _send_records(smtp, records, writer, lease) -> tuple[int, list]:
+    """
+    Send `records` in order over one pooled SMTP session, stopping when the
+    account runs out of quota, the server throttles us (mailing.send_control:
+    the record is deferred and the account's concurrency halved), the session
+    cannot be reopened (the account is marked down) or the task loses its claim
+    on the records (`lease`, a mailing.claims.Lease). A temporary
+    failure of one recipient only defers that record; permanent ones fail it.
+    Each attempted record is updated in memory and handed to `writer` (a
+    StatusWriter) to persist. Returns (sent_count, attempted_records).
+    """
+    sent_count = 0
+    send_seconds = 0.0
+    attempted = []
+    with smtp_pool.connection(smtp) as connection:
+        for record in records:
+            try:
+                # Reconnects at the message cap or after a drop; if that fails,
+                # the rest of the batch fails over to another account
+                connection.ensure_open()
+            except smtp_pool.SessionUnavailable as e:
+                _session_unavailable(smtp, e)
+                break
+            if not lease.keep():
+                logger.warning(f"Claim lost mid-batch (SMTP account {smtp.pk}); leaving the rest to its new owner")
+                break
+
+            dl_errors = []
+            temp_dir = None
             try:
-                save_to_sent_folder(smtp, msg)
+                msg, dl_errors, temp_dir = _build_message(record, smtp)
+                # The token is taken last, so a message that is never sent
+                # (build error, no quota) does not use up the account's quota
+                try:
+                    has_token = _take_send_token(smtp)
+                except Exception as e:
+                    logger.error(f"Quota check failed for SMTP account {smtp.pk}: {e}")
+                    has_token = False
+                if not has_token:
+                    break
+                started = time.monotonic()
+                try:
+                    raw_message = connection.send_serialized(msg)
+                except Exception:
+                    # Not accepted: quota counts delivered messages, like record_sent()
+                    _give_back_send_token(smtp)
+                    raise
+                send_seconds += time.monotonic() - started
+
+                _archive_sent(smtp, record, raw_message)
+                _mark_sent(record, dl_errors, timezone.now())
+                sent_count += 1
             except Exception as e:
-                logger.warning(f"Could not save to Sent folder: {e}")
-
-            # Mark sent + notes
-            record.is_sent = True
-            record.send_attempts += 1
-            record.last_sent_at = timezone.now()
-            if dl_errors:
-                note = " | ".join(dl_errors)[:500]
-                record.error_message = (record.error_message or "")
-                if record.error_message:
-                    record.error_message += " | "
-                record.error_message += f"Attachment notes: {note}"
-            else:
-                record.error_message = ''
-            record.save()
-
-            # Update quota (coarse; in parallel you may see slight races which are acceptable for soft caps)
-            smtp.emails_sent_today += 1
-            smtp.save()
+                error_msg = str(e)[:500]
+                reply = send_control.classify(e)
+                if reply.kind != send_control.PERMANENT and record.send_attempts + 1 < send_control.SEND_MAX_ATTEMPTS:
+                    logger.warning(f"Deferred email to {record.email} ({reply.kind}): {error_msg}")
+                    _mark_deferred(record, error_msg, dl_errors, timezone.now())
+                else:
+                    logger.error(f"Error sending email to {record.email}: {error_msg}")
+                    _mark_failed(record, error_msg, dl_errors, timezone.now())
+                # The server answered, so the session is still in sync; otherwise
+                # (disconnect, timeout, 421 which closes the session) drop it
+                if reply.code == 421 or not isinstance(
+                    e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)
+                ):
+                    connection.close()
+                if reply.kind == send_control.THROTTLED:
+                    _throttle_account(smtp)
+                    attempted.append(record)
+                    writer.add(record)
+                    break
+            finally:
+                if temp_dir and os.path.isdir(temp_dir):
+                    try:
+                        shutil.rmtree(temp_dir, ignore_errors=True)
+                    except Exception as ce:
+                        logger.warning(f"Failed to cleanup temp dir {temp_dir}: {ce}")
+            attempted.append(record)
+            writer.add(record)
+    if sent_count:
+        senders.observe_latency(smtp, send_seconds / sent_count)
+    return sent_count, attempted
+
+
+def _throttle_account(smtp):
+    try:
+        limit = send_control.on_throttled(smtp)
+        logger.warning(f"SMTP account {smtp.pk} throttled us; concurrency limit now {limit:.1f}")
+    except Exception as e:
+        logger.warning(f"Could not lower concurrency for SMTP account {smtp.pk}: {e}")
+
+
+def _session_unavailable(smtp, e):
+    logger.warning(f"SMTP account {smtp.pk} ({smtp.email_host}) unavailable, failing over: {e}")
+    senders.mark_down(smtp)
+    if send_control.classify(e.__cause__).code == 421:
+        _throttle_account(smtp)
+
+
+def _acquire_account(owner_id, excluded):
+    """
+    Pick an account of the owner (not in excluded) and take one of its session
+    slots, waiting up to SEND_QUOTA_MAX_WAIT while every candidate is at its
+    concurrency limit. Returns (smtp, slot) or (None, None).
+    """
+    deadline = time.monotonic() + SEND_QUOTA_MAX_WAIT
+    while True:
+        busy = set()
+        while True:
+            smtp = senders.pick_account(owner_id, SEND_QUOTA_MAX_WAIT, exclude=excluded | busy)
+            if smtp is None:
+                break
+            try:
+                slot = send_control.acquire_slot(smtp)
+            except Exception as e:
+                logger.error(f"Concurrency check failed for SMTP account {smtp.pk}: {e}")
+                slot = None
+            if slot:
+                return smtp, slot
+            busy.add(smtp.pk)
+        if not busy or time.monotonic() + SEND_SLOT_POLL > deadline:
+            return None, None
+        time.sleep(SEND_SLOT_POLL)
+
+
+def _add_sent_to_quota(smtp, sent_count):
+    # Sent count lives in Redis; the SMTPAccount row is only reconciled periodically
+    try:
+        quota.record_sent(smtp, sent_count)
+        quota.reconcile(smtp)
+    except Exception as e:
+        logger.warning(f"Could not record quota usage for SMTP account {smtp.pk}: {e}")
+
+
+def _send_with_failover(owner_id, records, writer, lease) -> tuple[int, list]:
+    """
+    Send `records` through the owner's SMTP accounts: the weighted pick takes
+    as many as its quota allows, then the rest fail over to the next account
+    (also when an account cannot be reached or throttles us). Each account is
+    used while holding one of its concurrency slots (mailing.send_control),
+    renewed along with the claim. Returns (sent_count, attempted).
+    """
+    sent_total = 0
+    attempted_all = []
+    pending = records
+    excluded = set()
+    while pending and not lease.lost:
+        smtp, slot = _acquire_account(owner_id, excluded)
+        if smtp is None:
+            break
+        excluded.add(smtp.pk)
+        renew_slot = functools.partial(send_control.renew_slot, smtp, slot)
+        lease.hold(renew_slot)
+        try:
+            sent_count, attempted = _send_records(smtp, pending, writer, lease)
+        except smtp_pool.SessionUnavailable as e:
+            # Session could not be opened (auth, DNS, refused, 421 ...): nothing was
+            # sent through it, so try another account. Any other error (e.g. writing
+            # statuses) propagates: records may already have gone out.
+            _session_unavailable(smtp, e)
+            continue
+        finally:
+            lease.drop(renew_slot)
+            send_control.release_slot(smtp, slot)
+        _add_sent_to_quota(smtp, sent_count)
+        try:
+            send_control.on_delivered(smtp, sent_count)
+        except Exception as e:
+            logger.warning(f"Could not raise concurrency for SMTP account {smtp.pk}: {e}")
+        sent_total += sent_count
+        attempted_all += attempted
+        pending = pending[len(attempted):]
+    return sent_total, attempted_all
 
-            return f"Email sent to {record.email}"
 
+def _acquire_domain_slot(domain):
+    """A session slot for the recipient domain, waiting up to SEND_QUOTA_MAX_WAIT; None if none freed up."""
+    deadline = time.monotonic() + SEND_QUOTA_MAX_WAIT
+    while True:
+        try:
+            slot = domains.acquire_slot(domain)
         except Exception as e:
-            error_msg = str(e)[:500]
-            logger.error(f"Error sending single email: {error_msg}")
-            record.send_attempts += 1
-            record.last_sent_at = timezone.now()
-            # bubble up attachment errors if any
-            if 'dl_errors' in locals() and dl_errors:
-                error_msg = f"Attachment errors: {' | '.join(dl_errors)} | Send error: {error_msg}"
-            record.error_message = error_msg
-            record.save()
-            return f"Error sending email to {record.email}: {error_msg}"
+            logger.error(f"Concurrency check failed for domain {domain}: {e}")
+            return None
+        if slot or time.monotonic() + SEND_SLOT_POLL > deadline:
+            return slot
+        time.sleep(SEND_SLOT_POLL)
+
+
+def _take_domain_tokens(domain, count) -> int:
+    """
+    Take up to `count` messages' worth of the domain's per-minute rate, waiting
+    up to SEND_QUOTA_MAX_WAIT for the first one. Returns how many were granted.
+    """
+    deadline = time.monotonic() + SEND_QUOTA_MAX_WAIT
+    while True:
+        try:
+            grant = domains.take_tokens(domain, count)
+        except Exception as e:
+            logger.error(f"Rate check failed for domain {domain}: {e}")
+            return 0
+        if grant.granted:
+            return grant.granted
+        if time.monotonic() + grant.retry_after > deadline:
+            return 0
+        time.sleep(grant.retry_after)
+
+
+def _give_back_domain_tokens(domain, count) -> None:
+    # Rate taken for records no account got to (quota, throttling) goes back to the domain
+    try:
+        domains.give_back_tokens(domain, count)
+    except Exception as e:
+        logger.warning(f"Could not return {count} unused tokens for domain {domain}: {e}")
+
+
+def _send_by_domain(owner_id, records, writer, lease) -> tuple[int, list]:
+    """
+    Send `records` one recipient domain at a time (dispatcher batches hold a
+    single domain), each while holding one of the domain's session slots and
+    within its per-minute rate (mailing.domains); records over either limit
+    are left unattempted, and rate taken for records that were not attempted
+    is given back. Returns (sent_count, attempted).
+    """
+    sent_total = 0
+    attempted_all = []
+    for domain, group in itertools.groupby(records, key=lambda r: r.domain):
+        if lease.lost:
+            break
+        group = list(group)
+        slot = _acquire_domain_slot(domain)
+        if slot is None:
+            continue
+        renew_slot = functools.partial(domains.renew_slot, domain, slot)
+        lease.hold(renew_slot)
+        try:
+            allowed = _take_domain_tokens(domain, len(group))
+            if allowed:
+                sent_count, attempted = _send_with_failover(owner_id, group[:allowed], writer, lease)
+                sent_total += sent_count
+                attempted_all += attempted
+                _give_back_domain_tokens(domain, allowed - len(attempted))
         finally:
-            if temp_dir and os.path.isdir(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                except Exception as ce:
-                    logger.warning(f"Failed to cleanup temp dir {temp_dir}: {ce}")
-            if connection:
-                try:
-                    connection.close()
-                except Exception:
-                    pass
+            lease.drop(renew_slot)
+            domains.release_slot(domain, slot)
+    return sent_total, attempted_all
+
+
+# acks_late: a batch lost with its worker is redelivered, so the window's chord
+# still fires; the claims make the redelivery safe (records already sent or
+# leased by the dead task are skipped and picked up by a later window)
+@shared_task(bind=True, ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def send_email_batch(self, record_ids):
+    """
+    Sends a batch of records over a single SMTP session per account: one UPDATE
+    to claim them (mailing.claims), one query to load them, narrow bulk UPDATEs
+    for their statuses (one per flush of the StatusWriter, at least one per
+    batch); quota comes from Redis.
+    """
+    try:
+        token = claims.claim(record_ids)
+        records = list(
+            EmailRecord.objects
+            .select_related('content', 'file')
+            .filter(claim_token=token)
+            .order_by('id')
+        )
+        if not records:
+            return "No pending emails in batch (already sent or being sent)."
+
+        # Statuses are written in narrow bulk UPDATEs as the batch goes (mailing.status_writer)
+        with StatusWriter(claim_token=token) as writer:
+            sent_count, attempted = _send_by_domain(records[0].file.user_id, records, writer, claims.Lease(token))
+        attempted_ids = {r.pk for r in attempted}
+        claims.release(token, [r.pk for r in records if r.pk not in attempted_ids])
+
+        if len(attempted) < len(records):
+            return f"No SMTP quota or domain capacity left; sent {sent_count}, {len(records) - len(attempted)} left pending"
+        return f"Sent {sent_count}/{len(records)} emails in batch ({len(attempted) - sent_count} failed)"
+
+    except Exception as e:
+        error_msg = str(e)[:500]
+        logger.error(f"Fatal error sending email batch: {error_msg}")
+        return f"Fatal error sending email batch: {error_msg}"
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def send_email_record(self, record_id, retry_deferred=True):
+    """
+    Sends a single email (HTML + plain alternative), downloads/attaches files,
+    and cleans up temporary files. Runs safely in parallel across workers.
+    A temporary (4xx) failure re-enqueues the task for the record's
+    next_attempt_at, unless retry_deferred is False (the dispatcher retries it).
+    """
+    try:
+        record = EmailRecord.objects.select_related('content', 'file__user').get(id=record_id)
+
+        if record.is_sent:
+            return f"Email {record.email} already sent."
+
+        if not senders.accounts_for(record.file.user_id):
+            return "No SMTP account configured."
+
+        # Only the task holding the claim sends; a racing bulk send or retry backs off
+        token = claims.claim([record.id])
+        record = EmailRecord.objects.select_related('content', 'file__user').filter(claim_token=token).first()
+        if record is None:
+            return f"Email {record_id} already sent or being sent."
+
+        with StatusWriter(claim_token=token) as writer:
+            sent_count, attempted = _send_by_domain(record.file.user_id, [record], writer, claims.Lease(token))
+        if not attempted:
+            claims.release(token, [record.pk])
+            return f"Gmail quota reached for {record.file.user.email}"
+
+        if sent_count:
+            return f"Email sent to {record.email}"
+        if record.next_attempt_at and retry_deferred:
+            delay = max((record.next_attempt_at - timezone.now()).total_seconds(), 1)
+            send_email_record.apply_async((record.pk,), countdown=delay)
+            return f"Email to {record.email} deferred; retrying in {delay:.0f}s"
+        return f"Error sending email to {record.email}: {record.error_message}"
 
     except Exception as e:
         error_msg = str(e)[:500]
@@ -559,23 +1790,49 @@ def send_email_record(self, record_id):
         return f"Fatal error sending email: {error_msg}"
 
 
-import imaplib, time
+# -----------------------------
+# Sent-folder archiving (see mailing.sent_archive)
+# -----------------------------
+ARCHIVE_LOCK_TTL = 10 * 60  # seconds; one archive task per account queued or running
+ARCHIVE_RETRY_DELAY = 60  # seconds before retrying after an IMAP error
 
 
-def save_to_sent_folder(smtp, email_message):
-    """
-    Save a fully prepared Django EmailMultiAlternatives (with attachments)
-    into the Sent folder via IMAP.
-    """
-    raw_message = email_message.message().as_bytes()
+def _schedule_archive(smtp_id, countdown=sent_archive.IMAP_BATCH_DELAY) -> None:
+    if cache.add(sent_archive.scheduled_key(smtp_id), True, ARCHIVE_LOCK_TTL):
+        archive_sent_messages.apply_async((smtp_id,), countdown=countdown)
+
+
+def _archive_sent(smtp, record, raw_message) -> None:
+    """Queue a sent message (as sent) for the account's Sent folder, unless the campaign opted out."""
+    if not record.file.archive_to_sent or not sent_archive.imap_host_for(smtp):
+        return
+    try:
+        if sent_archive.enqueue(smtp, raw_message):
+            _schedule_archive(smtp.pk)
+    except Exception as e:
+        logger.warning(f"Could not queue message for the Sent folder: {e}")
 
-    with imaplib.IMAP4_SSL("mail1014.onamae.ne.jp") as imap:
-        imap.login(smtp.email_host_user, smtp.email_host_password)
-        imap.append(
-            "Sent",  # confirmed from imap.list()
-            "",  # no flags
-            imaplib.Time2Internaldate(time.time()),
-            raw_message
-        )
-        imap.logout()
 
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def archive_sent_messages(smtp_id):
+    """
+    Append an account's queued sent messages to its IMAP Sent folder over one
+    kept-open session, then re-schedule itself while messages remain.
+    """
+    countdown = 0
+    try:
+        smtp = SMTPAccount.objects.get(pk=smtp_id)
+        archived = sent_archive.archive_pending(smtp)
+        result = f"Archived {archived} messages for SMTP account {smtp_id}"
+    except SMTPAccount.DoesNotExist:
+        cache.delete(sent_archive.scheduled_key(smtp_id))
+        return f"SMTP account {smtp_id} no longer exists"
+    except Exception as e:
+        logger.warning(f"Sent-folder archiving failed for SMTP account {smtp_id}, retrying: {e}")
+        countdown = ARCHIVE_RETRY_DELAY
+        result = f"Archiving failed for SMTP account {smtp_id}: {e}"
+
+    cache.delete(sent_archive.scheduled_key(smtp_id))
+    if sent_archive.pending(smtp_id):
+        _schedule_archive(smtp_id, countdown)
+    return result
@@ -1,3 +1,821 @@
-from django.test import TestCase
+import csv
+import email
+import hashlib
+import os
+import smtplib
+import socket
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pandas as pd
+from rest_framework.test import APIClient
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+try:
+    import fakeredis  # optional: the Redis (Lua script) tests are skipped without it
+except ImportError:
+    fakeredis = None
+
+from . import (
+    chunked_upload, claims, counters, csv_shards, mime_parts, progress, quota, redis_client, rendering, send_control,
+    senders, tasks,
+)
+from .csv_shards import CsvShardReader, plan_csv_shards
+from .models import CampaignContent, EmailFile, EmailRecord, RejectedRow, SMTPAccount, UploadSession
+from .status_writer import StatusWriter
+from .tasks import _drive_direct_url, _normalize_attachments, _normalize_attachments_column
+
+
+def _normalize_per_row(value) -> str:
+    """The scalar path the column normaliser replaces: validate, then rewrite Drive links."""
+    urls = _normalize_attachments(value)
+    return ",".join(_drive_direct_url(u) for u in urls.split(",")) if urls else ""
+
+
+class NormalizeAttachmentsColumnTests(SimpleTestCase):
+    CELLS = [
+        None,
+        float("nan"),
+        "nan",
+        "",
+        "   ",
+        42,
+        "not a url",
+        "https://a.example/x.pdf",
+        " https://a.example/x.pdf ; http://b.example/y.png\nftp://c.example/z ,, mailto:me@x.com ",
+        "HTTPS://A.example/upper.pdf",
+        "javascript:alert(1),https://ok.example/doc",
+        "https://drive.google.com/file/d/AbC_-123/view?usp=sharing",
+        "https://drive.google.com/open?id=XyZ987",
+        "https://drive.google.com/uc?export=download&id=Done1",
+        "https://a.example/1, https://drive.google.com/file/d/F1/view ;https://drive.google.com/open?id=F2",
+        "http://[::1",
+        "https://a.example/ok, http://[::1, https://b.example/ok",
+    ]
+
+    def test_matches_per_row_normaliser(self):
+        self.assertEqual(
+            _normalize_attachments_column(self.CELLS),
+            [_normalize_per_row(cell) for cell in self.CELLS],
+        )
+
+    def test_each_cell_alone_matches(self):
+        for cell in self.CELLS:
+            with self.subTest(cell=cell):
+                self.assertEqual(_normalize_attachments_column([cell]), [_normalize_per_row(cell)])
+
+    def test_accepts_series_and_keeps_order(self):
+        series = pd.Series(self.CELLS[::-1])
+        self.assertEqual(
+            _normalize_attachments_column(series),
+            [_normalize_per_row(cell) for cell in self.CELLS[::-1]],
+        )
+
+    def test_drive_links_rewritten_to_direct_download(self):
+        self.assertEqual(
+            _normalize_attachments_column(["https://drive.google.com/file/d/AbC_-123/view?usp=sharing"]),
+            ["https://drive.google.com/uc?export=download&id=AbC_-123"],
+        )
+
+    def test_empty_column(self):
+        self.assertEqual(_normalize_attachments_column([]), [])
+
+    def test_malformed_urls_are_dropped(self):
+        self.assertEqual(
+            _normalize_attachments_column(["https://a.example/ok, http://[::1, https://b.example/ok"]),
+            ["https://a.example/ok,https://b.example/ok"],
+        )
+
+
+class PlanCsvShardsTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def write_rows(self, count):
+        with open(self.path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Name", "Email", "Body"])
+            for i in range(count):
+                # Quoted newlines (some right where a naive split would land) and escaped quotes
+                body = f'Hi "{i}",\n\nline two\n' + "x" * (i % 7) + ("\n" * (i % 3))
+                writer.writerow([f"n{i}", f"r{i}@x.com", body])
+
+    def read_shards(self, header, shards):
+        frames = []
+        for start, end in shards:
+            with CsvShardReader(self.path, header, start, end) as stream:
+                frames.append(pd.read_csv(stream, dtype=str, keep_default_na=False))
+        return pd.concat(frames, ignore_index=True)
+
+    def assert_shards_cover_file(self, shard_bytes, max_shards):
+        header, shards = plan_csv_shards(self.path, shard_bytes, max_shards)
+        self.assertEqual(header, b"Name,Email,Body\r\n")
+        self.assertLessEqual(len(shards), max_shards)
+        # Contiguous and covering every data byte exactly once
+        self.assertEqual(shards[0][0], len(header))
+        self.assertEqual(shards[-1][1], os.path.getsize(self.path))
+        for (_, end), (start, _) in zip(shards, shards[1:]):
+            self.assertEqual(end, start)
+        # Every shard starts on a record: parsing them one by one gives the whole file
+        whole = pd.read_csv(self.path, dtype=str, keep_default_na=False)
+        pd.testing.assert_frame_equal(self.read_shards(header, shards), whole)
+        return shards
+
+    def test_boundaries_skip_quoted_newlines(self):
+        self.write_rows(500)
+        shards = self.assert_shards_cover_file(shard_bytes=512, max_shards=64)
+        self.assertGreater(len(shards), 1)
+
+    def test_quote_state_carries_across_scan_blocks(self):
+        self.write_rows(300)
+        with mock.patch.object(csv_shards, "SCAN_BLOCK_SIZE", 7):
+            self.assert_shards_cover_file(shard_bytes=300, max_shards=50)
+
+    def test_small_file_is_one_shard(self):
+        self.write_rows(3)
+        self.assertEqual(len(self.assert_shards_cover_file(shard_bytes=1 << 20, max_shards=8)), 1)
+
+    def test_header_only(self):
+        self.write_rows(0)
+        header, shards = plan_csv_shards(self.path, 100, 4)
+        self.assertEqual((header, shards), (b"Name,Email,Body\r\n", []))
+
+
+class AttachmentPartTests(SimpleTestCase):
+    def setUp(self):
+        mime_parts.clear()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def file(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as fh:
+            fh.write(data)
+        return path
+
+    def sent_attachments(self, parts):
+        msg = EmailMultiAlternatives("Subject", "Body", "from@x.com", ["to@x.com"])
+        for part in parts:
+            msg.attach(part)
+        parsed = email.message_from_bytes(msg.message().as_bytes(linesep="\r\n"), policy=email.policy.default)
+        return [(p.get_filename(), p.get_content_type(), p.get_payload(decode=True)) for p in parsed.iter_attachments()]
+
+    def test_parts_round_trip_through_a_message(self):
+        cases = [
+            ("brochure.pdf", "application/pdf", bytes(range(256)) * 40),
+            ("notes.txt", "text/plain", "caf\u00e9 \u2013 ok\n".encode("utf-8")),
+            ("r\u00e9sum\u00e9 2024.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+             b"PK\x03\x04 zipped"),
+            ("unknown.bin", None, b"\x00\x01\x02"),
+        ]
+        parts = [mime_parts.attachment_part(self.file(f"f{i}", data), name, mimetype)
+                 for i, (name, mimetype, data) in enumerate(cases)]
+        self.assertEqual(self.sent_attachments(parts), [
+            (name, mimetype or "application/octet-stream", data) for name, mimetype, data in cases
+        ])
+        self.assertEqual(parts[1].get_content_charset(), "utf-8")
+
+    def test_part_is_built_once_per_file(self):
+        path = self.file("a.pdf", b"%PDF-1.4 data")
+        first = mime_parts.attachment_part(path, "a.pdf", "application/pdf")
+        self.assertIs(mime_parts.attachment_part(path, "a.pdf", "application/pdf"), first)
+        # Shared by many messages, and unchanged by being sent
+        self.assertEqual(self.sent_attachments([first]), self.sent_attachments([first]))
+
+
+def _use_fake_redis(test):
+    """Point the shared Redis client at a fresh in-memory Redis for the duration of `test`."""
+    client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    patcher = mock.patch.object(redis_client, "_client", client)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return client
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = _use_fake_redis(self)
+
+    def account(self, per_second=0, per_hour=0, per_day=0):
+        return SimpleNamespace(pk=1, max_per_second=per_second, max_per_hour=per_hour, max_per_day=per_day)
+
+    def test_grants_up_to_the_emptiest_bucket(self):
+        smtp = self.account(per_second=10, per_day=500)
+        grant = quota.acquire(smtp, 25)
+        self.assertEqual((grant.granted, grant.remaining), (10, 0))
+        self.assertGreater(grant.retry_after, 0)
+        self.assertLessEqual(grant.retry_after, 1)
+        self.assertEqual(quota.acquire(smtp, 0).granted, 0)
+
+    def test_day_cap_is_never_exceeded(self):
+        smtp = self.account(per_day=500)
+        self.assertEqual(quota.acquire(smtp, 300).granted, 300)
+        self.assertEqual(quota.acquire(smtp, 300).granted, 200)
+        grant = quota.acquire(smtp, 1)
+        self.assertEqual((grant.granted, grant.remaining), (0, 0))
+        # Nothing comes back before local midnight
+        self.assertAlmostEqual(grant.retry_after, quota._seconds_until_midnight(), delta=5)
+
+    def test_day_cap_does_not_refill_during_the_day(self):
+        smtp = self.account(per_second=100, per_day=150)
+        today = timezone.localdate()
+        with mock.patch.object(quota, "_seconds_until_midnight", return_value=24 * 60 * 60), \
+                mock.patch.object(quota.timezone, "localdate", return_value=today):
+            self.assertEqual(quota.acquire(smtp, 200).granted, 100)
+            # 23 hours later (Redis TIME included) the per-second bucket is full again,
+            # but the day only has what is left of its 150, not 23 hours of refill
+            with mock.patch("time.time", return_value=time.time() + 23 * 60 * 60):
+                self.assertEqual(quota.acquire(smtp, 200).granted, 50)
+                self.assertEqual(quota.acquire(smtp, 200).granted, 0)
+
+    def test_day_cap_starts_over_on_a_new_day(self):
+        smtp = self.account(per_day=5)
+        self.assertEqual(quota.acquire(smtp, 10).granted, 5)
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        with mock.patch.object(quota.timezone, "localdate", return_value=tomorrow):
+            self.assertEqual(quota.acquire(smtp, 10).granted, 5)
+
+    def test_no_limits_grants_everything(self):
+        grant = quota.acquire(self.account(), 1000)
+        self.assertEqual((grant.granted, grant.retry_after), (1000, 0.0))
+
+    def test_refund_returns_day_cap_tokens_without_going_negative(self):
+        smtp = self.account(per_second=100, per_day=5)
+        self.assertEqual(quota.acquire(smtp, 5).granted, 5)
+        quota.refund(smtp, 2)
+        self.assertEqual(quota.acquire(smtp, 5).granted, 2)
+        quota.refund(smtp, 50)
+        self.assertEqual(quota.acquire(smtp, 50).granted, 5)
+
+    def test_domain_refund_is_capped_at_the_limit(self):
+        self.assertEqual(quota.acquire_domain("example.com", 10, 8).granted, 8)
+        quota.refund_domain("example.com", 10, 5)
+        self.assertEqual(quota.acquire_domain("example.com", 10, 20).granted, 7)
+        quota.refund_domain("example.com", 10, 50)
+        self.assertEqual(quota.acquire_domain("example.com", 10, 20).granted, 10)
+
+
+class ClaimTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user("owner")
+        content = CampaignContent.intern("Subject", "Body")
+        email_file = EmailFile.objects.create(user=user, title="t", file="uploads/t.csv", content=content)
+        EmailRecord.objects.bulk_create([
+            EmailRecord(file=email_file, name=f"n{i}", email=f"r{i}@x.com", content=content) for i in range(10)
+        ])
+        self.ids = list(EmailRecord.objects.order_by("id").values_list("id", flat=True))
+
+    def held(self, token):
+        return set(EmailRecord.objects.filter(claim_token=token).values_list("id", flat=True))
+
+    def expire(self, token):
+        EmailRecord.objects.filter(claim_token=token).update(claimed_until=timezone.now() - timedelta(seconds=1))
+
+    def test_overlapping_claims_never_share_a_record(self):
+        first = claims.claim(self.ids[:6])
+        second = claims.claim(self.ids[3:])
+        self.assertEqual(self.held(first), set(self.ids[:6]))
+        self.assertEqual(self.held(second), set(self.ids[6:]))
+        self.assertEqual(self.held(claims.claim(self.ids)), set())
+
+    def test_records_are_claimable_again_once_the_lease_runs_out(self):
+        first = claims.claim(self.ids)
+        self.expire(first)
+        second = claims.claim(self.ids)
+        self.assertEqual(self.held(second), set(self.ids))
+        self.assertEqual(self.held(first), set())
+
+    def test_sent_records_are_never_claimed(self):
+        EmailRecord.objects.filter(id__in=self.ids[:4]).update(is_sent=True)
+        self.assertEqual(self.held(claims.claim(self.ids)), set(self.ids[4:]))
+
+    def test_release_only_frees_the_tokens_own_records(self):
+        first = claims.claim(self.ids[:5])
+        second = claims.claim(self.ids[5:])
+        claims.release(first, self.ids)
+        self.assertEqual(self.held(second), set(self.ids[5:]))
+        self.assertEqual(self.held(claims.claim(self.ids)), set(self.ids[:5]))
+
+    def test_renew_extends_a_live_lease_only(self):
+        token = claims.claim(self.ids)
+        EmailRecord.objects.filter(claim_token=token).update(claimed_until=timezone.now() + timedelta(seconds=5))
+        self.assertEqual(claims.renew(token), len(self.ids))
+        self.assertGreater(
+            EmailRecord.objects.get(id=self.ids[0]).claimed_until,
+            timezone.now() + timedelta(seconds=claims.CLAIM_LEASE_SECONDS - 60),
+        )
+        self.expire(token)
+        self.assertEqual(claims.renew(token), 0)
+
+    def test_lease_is_lost_for_good_once_a_renewal_fails(self):
+        lease = claims.Lease(claims.claim(self.ids))
+        with mock.patch.object(claims, "CLAIM_RENEW_SECONDS", 0):
+            self.assertTrue(lease.keep())
+            self.expire(lease.token)
+            self.assertFalse(lease.keep())
+            # A lost lease stays lost, even if the rows would renew again
+            EmailRecord.objects.filter(claim_token=lease.token).update(
+                claimed_until=timezone.now() + timedelta(hours=1)
+            )
+            self.assertFalse(lease.keep())
+
+    def test_lease_is_lost_when_a_held_slot_is(self):
+        lease = claims.Lease(claims.claim(self.ids))
+        lease.hold(lambda: False)
+        with mock.patch.object(claims, "CLAIM_RENEW_SECONDS", 0):
+            self.assertFalse(lease.keep())
+
+    def test_status_write_leaves_a_new_owners_claim_alone(self):
+        first = claims.claim(self.ids)
+        records = list(EmailRecord.objects.filter(claim_token=first))
+        self.expire(first)
+        second = claims.claim(self.ids)
+        with StatusWriter(claim_token=first) as writer:
+            for record in records:
+                record.is_sent = True
+                claims.clear(record)
+                writer.add(record)
+        self.assertEqual(writer.written, 0)
+        self.assertEqual(self.held(second), set(self.ids))
+        self.assertFalse(EmailRecord.objects.filter(is_sent=True).exists())
+
+
+    def test_sent_records_are_written_before_the_next_send(self):
+        token = claims.claim(self.ids)
+        sent, failed = EmailRecord.objects.filter(claim_token=token).order_by("id")[:2]
+        writer = StatusWriter(claim_token=token)
+        sent.is_sent = True
+        claims.clear(sent)
+        writer.add(sent)
+        failed.error_message = "550 no such user"
+        claims.clear(failed)
+        writer.add(failed)
+        # Without a flush (as if the worker died here): the delivery is durable, the failure is not
+        stored = EmailRecord.objects.in_bulk([sent.pk, failed.pk])
+        self.assertEqual((stored[sent.pk].is_sent, stored[sent.pk].claim_token), (True, None))
+        self.assertEqual((stored[failed.pk].error_message, stored[failed.pk].claim_token), (None, token))
+        writer.flush()
+        self.assertEqual(EmailRecord.objects.get(pk=failed.pk).error_message, "550 no such user")
+
+
+class AccountsForTests(TestCase):
+    def account(self, user, **kwargs):
+        return SMTPAccount.objects.create(
+            user=user, email_host="smtp.x.com", email_host_user=f"{user.username}@x.com",
+            email_host_password="p", **kwargs
+        )
+
+    def test_only_the_tenants_active_accounts(self):
+        tenant, other = User.objects.create_user("tenant"), User.objects.create_user("other")
+        own = self.account(tenant)
+        self.account(tenant, is_active=False)
+        self.account(other)
+        self.assertEqual(senders.accounts_for(tenant.id), [own])
+
+    def test_never_another_tenants_account(self):
+        tenant, other = User.objects.create_user("tenant"), User.objects.create_user("other")
+        self.account(other)
+        self.assertEqual(senders.accounts_for(tenant.id), [])
+        self.assertIsNone(senders.seconds_until_available(tenant.id, 5))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ReclaimExpiredClaimsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user("owner")
+        content = CampaignContent.intern("Subject", "Body")
+        self.started = timezone.now() - timedelta(hours=1)
+        self.file = EmailFile.objects.create(
+            user=user, title="t", file="uploads/t.csv", content=content, send_batch_size=25,
+            send_started_at=self.started,
+        )
+        now = timezone.now()
+        EmailRecord.objects.bulk_create([
+            EmailRecord(file=self.file, name=f"n{i}", email=f"r{i}@x.com", content=content,
+                        claim_token=uuid.uuid4(),
+                        claimed_until=now + timedelta(seconds=-60 if i < 3 else 60))
+            for i in range(5)
+        ])
+        patcher = mock.patch.object(tasks.dispatch_send_window, "delay")
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resumes_files_with_expired_claims(self):
+        tasks.reclaim_expired_claims()
+        self.delay.assert_called_once_with(self.file.id, 0, 25, self.started.isoformat())
+        # Expired claims are dropped, live ones kept
+        self.assertEqual(EmailRecord.objects.filter(claim_token__isnull=True).count(), 3)
+        self.assertEqual(EmailRecord.objects.filter(claimed_until__gt=timezone.now()).count(), 2)
+
+    def test_leaves_files_with_a_live_dispatcher_alone(self):
+        cache.add(tasks._dispatch_lock_key(self.file.id), True, 60)
+        tasks.reclaim_expired_claims()
+        self.delay.assert_not_called()
+        self.assertEqual(EmailRecord.objects.filter(claim_token__isnull=True).count(), 0)
+
+
+class EmailFileDetailViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        default = CampaignContent.intern("Hello", "Default body")
+        self.file = EmailFile.objects.create(user=self.user, title="t", file="uploads/t.csv", content=default)
+        EmailRecord.objects.bulk_create([
+            EmailRecord(file=self.file, name=f"n{i}", email=f"r{i}@x.com", content=default) for i in range(20)
+        ])
+
+    def add_overrides(self, count):
+        records = []
+        for i in range(count):
+            content = CampaignContent.intern(f"Subject {i}", f"Body {i}")
+            records.append(EmailRecord(file=self.file, name=f"o{i}", email=f"o{i}@x.com", content=content))
+        EmailRecord.objects.bulk_create(records)
+
+    def get(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("email-file-detail", args=[self.file.id]))
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_override_bodies_are_returned_without_a_query_each(self):
+        self.add_overrides(2)
+        _, few = self.get()
+        self.add_overrides(10)
+        data, many = self.get()
+        self.assertEqual(many, few)
+        bodies = {r["email"]: r["body"] for r in data["email_records"]}
+        self.assertEqual(bodies["r0@x.com"], None)
+        self.assertEqual(bodies["o1@x.com"], "Body 1")
+
+
+def _use_temp_media(test):
+    """Point MEDIA_ROOT at a fresh temporary directory for the duration of `test`."""
+    media = tempfile.TemporaryDirectory()
+    test.addCleanup(media.cleanup)
+    media_settings = override_settings(MEDIA_ROOT=media.name)
+    media_settings.enable()
+    test.addCleanup(media_settings.disable)
+    return media.name
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class UploadSessionTests(TestCase):
+    data = b"name,email\nA,a@x.com\n"
+
+    def setUp(self):
+        _use_temp_media(self)
+        self.user = User.objects.create_user("owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create(self, **extra):
+        body = {
+            "title": "t", "filename": "t.csv", "total_size": len(self.data),
+            "sha256": hashlib.sha256(self.data).hexdigest(), **extra,
+        }
+        response = self.client.post(reverse("upload-session-create"), body, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()["id"]
+
+    def put(self, session_id, start, chunk):
+        return self.client.put(
+            reverse("upload-session-chunk", args=[session_id]), data=chunk,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(chunk) - 1}/{len(self.data)}",
+        )
+
+    def complete(self, session_id):
+        with mock.patch.object(tasks.process_uploaded_file, "delay") as delay:
+            response = self.client.post(reverse("upload-session-complete", args=[session_id]))
+        return response, delay
+
+    def test_create_validates_the_declared_file(self):
+        url = reverse("upload-session-create")
+        for extra in ({"filename": "t.exe"}, {"total_size": 0}, {"sha256": "abc"}):
+            body = {"title": "t", "filename": "t.csv", "total_size": 1, "sha256": "a" * 64, **extra}
+            self.assertEqual(self.client.post(url, body, format="json").status_code, 400, extra)
+
+    def test_upload_resumes_from_received_bytes(self):
+        session_id = self.create()
+        self.assertEqual(self.put(session_id, 0, self.data[:5]).json()["received_bytes"], 5)
+        status_url = reverse("upload-session-chunk", args=[session_id])
+        self.assertEqual(self.client.get(status_url).json()["received_bytes"], 5)
+
+        replayed = self.put(session_id, 0, self.data[:5])
+        self.assertEqual((replayed.status_code, replayed.json()["received_bytes"]), (409, 5))
+        self.assertEqual(self.put(session_id, 5, self.data[5:]).json()["received_bytes"], len(self.data))
+
+        response, delay = self.complete(session_id)
+        self.assertEqual(response.status_code, 201)
+        email_file = EmailFile.objects.get(id=response.json()["id"])
+        with open(email_file.file.path, "rb") as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertFalse(os.path.exists(chunked_upload.partial_path(UploadSession.objects.get(id=session_id))))
+
+        again, delay = self.complete(session_id)
+        self.assertEqual((again.status_code, again.json()["id"]), (200, email_file.id))
+        delay.assert_not_called()
+
+    def test_chunk_must_match_its_content_range(self):
+        session_id = self.create()
+        url = reverse("upload-session-chunk", args=[session_id])
+        no_range = self.client.put(url, data=self.data, content_type="application/octet-stream")
+        self.assertEqual(no_range.status_code, 400)
+        wrong_total = self.client.put(
+            url, data=self.data, content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes 0-{len(self.data) - 1}/{len(self.data) + 1}",
+        )
+        self.assertEqual(wrong_total.status_code, 400)
+        with mock.patch.object(chunked_upload, "UPLOAD_CHUNK_SIZE", 4):
+            self.assertEqual(self.put(session_id, 0, self.data[:5]).status_code, 413)
+        self.assertEqual(UploadSession.objects.get(id=session_id).received_bytes, 0)
+
+    def test_incomplete_upload_cannot_be_completed(self):
+        session_id = self.create()
+        self.put(session_id, 0, self.data[:5])
+        response, delay = self.complete(session_id)
+        self.assertEqual((response.status_code, response.json()["received_bytes"]), (409, 5))
+        self.assertFalse(EmailFile.objects.exists())
+
+    def test_abandoned_upload_is_removed_with_its_partial_file(self):
+        session_id = self.create()
+        self.put(session_id, 0, self.data[:5])
+        path = chunked_upload.partial_path(UploadSession.objects.get(id=session_id))
+        self.assertTrue(os.path.exists(path))
+        response = self.client.delete(reverse("upload-session-chunk", args=[session_id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(UploadSession.objects.filter(id=session_id).exists())
+
+    def test_sessions_belong_to_their_owner(self):
+        session_id = self.create()
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user("other"))
+        self.assertEqual(other.get(reverse("upload-session-chunk", args=[session_id])).status_code, 404)
+        self.assertEqual(other.post(reverse("upload-session-complete", args=[session_id])).status_code, 404)
+
+    def test_complete_hands_off_without_hashing_and_keeps_archive_to_sent(self):
+        session_id = self.create(archive_to_sent=False)
+        self.assertEqual(self.put(session_id, 0, self.data).status_code, 200)
+        with mock.patch.object(chunked_upload, "file_sha256") as file_sha256:
+            response, delay = self.complete(session_id)
+        self.assertEqual(response.status_code, 201)
+        file_sha256.assert_not_called()
+        email_file = EmailFile.objects.get(id=response.json()["id"])
+        self.assertFalse(email_file.archive_to_sent)
+        delay.assert_called_once_with(email_file.id)
+
+    def test_ingest_rejects_a_file_that_does_not_match_its_checksum(self):
+        session_id = self.create()
+        self.put(session_id, 0, self.data)
+        response, _ = self.complete(session_id)
+        email_file = EmailFile.objects.get(id=response.json()["id"])
+        tasks._verify_upload_checksum(email_file, email_file.file.path)
+
+        UploadSession.objects.filter(id=session_id).update(sha256="0" * 64)
+        tasks.process_uploaded_file.run(email_file.id)
+        self.assertFalse(EmailRecord.objects.filter(file=email_file).exists())
+        self.assertEqual(progress.get_progress(email_file.id)["state"], progress.STATE_FAILED)
+        self.assertIn("Checksum mismatch", progress.get_progress(email_file.id)["error"])
+
+
+class CrossShardDuplicateTests(TestCase):
+    def test_keeps_the_first_record_per_case_folded_address(self):
+        user = User.objects.create_user("owner")
+        email_file = EmailFile.objects.create(user=user, title="t", file="uploads/t.csv")
+        emails = ["Straße@x.com", "a@x.com", "STRASSE@x.com", "A@X.COM", "b@x.com", "strasse@x.com"]
+        EmailRecord.objects.bulk_create([
+            EmailRecord(file=email_file, name=f"n{i}", email=e, email_key=EmailRecord.key_for(e))
+            for i, e in enumerate(emails)
+        ])
+
+        with CaptureQueriesContext(connection) as queries:
+            removed = tasks._reject_cross_shard_duplicates(email_file.id)
+        self.assertEqual(removed, 3)
+        # Independent of how many addresses are duplicated
+        self.assertLessEqual(len(queries), 6)
+        kept = EmailRecord.objects.filter(file=email_file).order_by("id").values_list("email", flat=True)
+        self.assertEqual(list(kept), ["Straße@x.com", "a@x.com", "b@x.com"])
+        rejected = RejectedRow.objects.filter(file=email_file, reason=RejectedRow.REASON_DUPLICATE)
+        self.assertEqual(
+            sorted(rejected.values_list("email", flat=True)), ["A@X.COM", "STRASSE@x.com", "strasse@x.com"],
+        )
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CounterTests(SimpleTestCase):
+    def test_incr_starts_a_missing_counter_and_adds_to_it(self):
+        counters.incr("mailing:test:counter", 3, 60)
+        counters.incr("mailing:test:counter", 2, 60)
+        self.assertEqual(cache.get("mailing:test:counter"), 5)
+
+
+def _write_upload(media_root, name, rows) -> str:
+    """Write a CSV (header Name,Email,Subject,Body) under uploads/; returns its storage name."""
+    os.makedirs(os.path.join(media_root, "uploads"), exist_ok=True)
+    with open(os.path.join(media_root, "uploads", name), "w", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["Name", "Email", "Subject", "Body"])
+        writer.writerows(rows)
+    return f"uploads/{name}"
+
+
+class RowValidatorTests(SimpleTestCase):
+    def test_rejection_reasons(self):
+        validator = tasks._RowValidator()
+        self.assertIsNone(validator.rejection_reason("a@x.com"))
+        self.assertEqual(validator.rejection_reason(""), RejectedRow.REASON_MISSING_EMAIL)
+        for invalid in ("a", "a@x", "a@@x.com", "a b@x.com", "a@-x.com", "a@x.c0m", "a" * 250 + "@x.com"):
+            self.assertEqual(validator.rejection_reason(invalid), RejectedRow.REASON_INVALID_EMAIL, invalid)
+        self.assertIsNone(validator.rejection_reason("b@xn--bcher-kva.com"))
+
+    def test_duplicates_are_case_insensitive_and_first_wins(self):
+        validator = tasks._RowValidator(seen=[EmailRecord.key_for("Old@x.com")])
+        self.assertEqual(validator.rejection_reason("old@X.COM"), RejectedRow.REASON_DUPLICATE)
+        self.assertIsNone(validator.rejection_reason("New@x.com"))
+        self.assertEqual(validator.rejection_reason("NEW@x.com"), RejectedRow.REASON_DUPLICATE)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class IngestValidationTests(TestCase):
+    def setUp(self):
+        cache.clear()  # progress counters are keyed by file id, which other tests reuse
+        self.media = _use_temp_media(self)
+        self.user = User.objects.create_user("owner")
+
+    def test_invalid_and_duplicate_rows_are_rejected_with_their_row_number(self):
+        name = _write_upload(self.media, "v.csv", [
+            ["A", "a@x.com", "Hi", "Body"],
+            ["B", "", "", ""],
+            ["C", "not-an-email", "", ""],
+            ["D", " A@X.com ", "", ""],
+            ["E", "e@x.com", "", ""],
+        ])
+        email_file = EmailFile.objects.create(user=self.user, title="t", file=name)
+        tasks.process_uploaded_file.run(email_file.id)
+
+        records = EmailRecord.objects.filter(file=email_file).order_by("id")
+        self.assertEqual(
+            list(records.values_list("email", "email_key")), [("a@x.com", "a@x.com"), ("e@x.com", "e@x.com")],
+        )
+        rejected = RejectedRow.objects.filter(file=email_file).order_by("row_number")
+        self.assertEqual(list(rejected.values_list("row_number", "email", "reason")), [
+            (3, "", RejectedRow.REASON_MISSING_EMAIL),
+            (4, "not-an-email", RejectedRow.REASON_INVALID_EMAIL),
+            (5, "A@X.com", RejectedRow.REASON_DUPLICATE),
+        ])
+        self.assertEqual(
+            {k: progress.get_progress(email_file.id)[k] for k in progress.COUNTERS},
+            {"rows_parsed": 5, "rows_inserted": 2, "rows_rejected": 3},
+        )
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class IngestResumeTests(TestCase):
+    rows = [[f"n{i}", f"r{i % 7}@x.com" if i % 5 == 4 else f"r{i}@x.com", "Hi", "Body"] for i in range(12)]
+
+    def setUp(self):
+        self.media = _use_temp_media(self)
+        self.user = User.objects.create_user("owner")
+        # Batches of 2 rows, so the file is committed (and checkpointed) in several steps
+        read = tasks._read_defaults_and_batches
+        patcher = mock.patch.object(
+            tasks, "_read_defaults_and_batches", lambda path, skip_rows=0: read(path, 2, skip_rows),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ingest(self, name):
+        email_file = EmailFile.objects.create(user=self.user, title=name, file=_write_upload(self.media, name, self.rows))
+        tasks.process_uploaded_file.run(email_file.id)
+        return email_file
+
+    def outcome(self, email_file):
+        email_file.refresh_from_db()
+        return (
+            list(EmailRecord.objects.filter(file=email_file).order_by("id").values_list("email", flat=True)),
+            list(RejectedRow.objects.filter(file=email_file).order_by("id").values_list("row_number", "reason")),
+            email_file.ingest_checkpoints,
+        )
+
+    def test_interrupted_ingest_resumes_after_the_last_committed_batch(self):
+        expected = self.outcome(self.ingest("clean.csv"))
+
+        insert = tasks._bulk_insert_records
+        calls = []
+
+        def dies_on_the_fourth_batch(*args):
+            calls.append(args)
+            if len(calls) == 4:
+                raise RuntimeError("worker lost")
+            return insert(*args)
+
+        with mock.patch.object(tasks, "_bulk_insert_records", dies_on_the_fourth_batch):
+            email_file = self.ingest("resumed.csv")
+        email_file.refresh_from_db()
+        self.assertEqual(email_file.ingest_checkpoints, {"rows": 6})
+        self.assertIsNone(email_file.ingest_completed_at)
+
+        # Redelivery: rows 1-6 are skipped, and a later duplicate of one of them is still rejected
+        tasks.process_uploaded_file.run(email_file.id)
+        self.assertEqual(self.outcome(email_file), expected)
+        self.assertEqual(expected[2], {"rows": 12})
+        self.assertIn((11, RejectedRow.REASON_DUPLICATE), expected[1])
+
+    def test_completed_ingest_is_not_run_again(self):
+        email_file = self.ingest("done.csv")
+        before = self.outcome(email_file)
+        tasks.process_uploaded_file.run(email_file.id)
+        self.assertEqual(self.outcome(email_file), before)
+
+
+class RenderOnceTests(SimpleTestCase):
+    names = [None, "", "Ann", "O'Neil & <Sons>", "Zoë 中文", " ", "0"]
+    contents = [
+        ("Hello", "Plain body\nsecond line"),
+        ("Q&A <soon>", "<p>HTML <b>body</b></p>\n<ul><li>one</li></ul>"),
+        ("", ""),
+        ("Unbalanced", "<p>open <!-- comment"),
+    ]
+
+    def setUp(self):
+        rendering.clear()
+        self.addCleanup(rendering.clear)
+
+    def test_matches_a_full_render_per_record(self):
+        for subject, body in self.contents:
+            for name in self.names:
+                with self.subTest(subject=subject, name=name):
+                    self.assertEqual(
+                        rendering.render_email(name, subject, body), rendering.render_uncached(name, subject, body),
+                    )
+
+    def test_template_is_rendered_once_per_subject_and_body(self):
+        with mock.patch.object(rendering, "render_to_string", wraps=rendering.render_to_string) as render:
+            for name in ("Ann", "Bob", "Cy"):
+                rendering.render_email(name, "Hello", "Body")
+            rendering.render_email(None, "Hello", "Body")
+        # Once with the name placeholder, once for records without a name
+        self.assertEqual(render.call_count, 2)
+
+
+class SendControlClassifyTests(SimpleTestCase):
+    def test_reply_codes(self):
+        cases = [
+            (smtplib.SMTPDataError(550, b"5.1.1 User unknown"), send_control.PERMANENT, 550),
+            (smtplib.SMTPDataError(451, b"4.3.0 Try again later"), send_control.TRANSIENT, 451),
+            (smtplib.SMTPDataError(450, b"4.7.1 Rate limited, slow down"), send_control.THROTTLED, 450),
+            (smtplib.SMTPSenderRefused(421, b"Too many connections", "me@x.com"), send_control.THROTTLED, 421),
+        ]
+        for exc, kind, code in cases:
+            with self.subTest(exc=exc):
+                reply = send_control.classify(exc)
+                self.assertEqual((reply.kind, reply.code), (kind, code))
+        self.assertEqual(send_control.classify(cases[0][0]).message, "5.1.1 User unknown")
+
+    def test_refused_recipients_report_the_most_retryable_reply(self):
+        exc = smtplib.SMTPRecipientsRefused({
+            "a@x.com": (550, b"5.1.1 User unknown"),
+            "b@x.com": (452, b"4.2.2 Mailbox full"),
+        })
+        self.assertEqual(send_control.classify(exc).kind, send_control.TRANSIENT)
+        exc.recipients["c@x.com"] = (421, b"Service not available")
+        self.assertEqual(send_control.classify(exc).kind, send_control.THROTTLED)
+        permanent = smtplib.SMTPRecipientsRefused({"a@x.com": (553, b"5.1.3 Bad address")})
+        self.assertEqual(send_control.classify(permanent).kind, send_control.PERMANENT)
+
+    def test_dropped_connections_throttle_and_anything_else_is_permanent(self):
+        for exc in (smtplib.SMTPServerDisconnected(), socket.timeout("timed out"), ConnectionResetError()):
+            with self.subTest(exc=exc):
+                self.assertEqual(send_control.classify(exc).kind, send_control.THROTTLED)
+        self.assertEqual(send_control.classify(ValueError("bad header")).kind, send_control.PERMANENT)
+
+    def test_retry_delay_doubles_up_to_the_cap_with_jitter(self):
+        base, cap = send_control.SEND_RETRY_BASE_DELAY, send_control.SEND_RETRY_MAX_DELAY
+        for attempt in range(1, 12):
+            ceiling = min(cap, base * 2 ** (attempt - 1))
+            with mock.patch.object(send_control.random, "uniform", lambda low, high: low):
+                self.assertEqual(send_control.retry_delay(attempt), ceiling / 2)
+            with mock.patch.object(send_control.random, "uniform", lambda low, high: high):
+                self.assertEqual(send_control.retry_delay(attempt), ceiling)
+        ceiling = min(cap, base * 4)
+        delays = {send_control.retry_delay(3) for _ in range(20)}
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(ceiling / 2 <= d <= ceiling for d in delays))
@@ -1,9 +1,15 @@
 from django.urls import path
 from .views import (
     EmailFileUploadView,
+    UploadSessionCreateView,
+    UploadSessionChunkView,
+    UploadSessionCompleteView,
     EmailFileListView,
     EmailFileDetailView,
+    EmailFileProgressView,
+    EmailFileRejectedRowsView,
     EmailFileDeleteView,
+    AttachmentCacheStatsView,
     SendAllEmailsView,
     SendSingleEmailView,
 )
@@ -13,8 +19,13 @@ urlpatterns = [
     # File Upload & Management Endpoints
     # ----------------------------------------
     path('upload/', EmailFileUploadView.as_view(), name='email-file-upload'),
+    path('uploads/', UploadSessionCreateView.as_view(), name='upload-session-create'),
+    path('uploads/<uuid:pk>/', UploadSessionChunkView.as_view(), name='upload-session-chunk'),
+    path('uploads/<uuid:pk>/complete/', UploadSessionCompleteView.as_view(), name='upload-session-complete'),
     path('files/', EmailFileListView.as_view(), name='email-file-list'),
     path('files/<int:pk>/', EmailFileDetailView.as_view(), name='email-file-detail'),
+    path('files/<int:pk>/progress/', EmailFileProgressView.as_view(), name='email-file-progress'),
+    path('files/<int:pk>/rejected/', EmailFileRejectedRowsView.as_view(), name='email-file-rejected-rows'),
     path('files/<int:pk>/delete/', EmailFileDeleteView.as_view(), name='email-file-delete'),
 
     # ----------------------------------------
@@ -22,4 +33,9 @@ urlpatterns = [
     # ----------------------------------------
     path('files/<int:pk>/send/', SendAllEmailsView.as_view(), name='email-file-send-all'),
     path('email/<int:pk>/send/', SendSingleEmailView.as_view(), name='email-record-send'),
+
+    # ----------------------------------------
+    # Monitoring
+    # ----------------------------------------
+    path('attachments/cache/', AttachmentCacheStatsView.as_view(), name='attachment-cache-stats'),
 ]
@@ -1,17 +1,24 @@
+import csv
 import logging
+import re
+from django.db import transaction
 from django.db.models import Count, Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import generics, permissions, status, views
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 
-from .models import EmailFile, EmailRecord
+from .models import EmailFile, EmailRecord, RejectedRow, UploadSession
 from .serializers import (
     EmailFileUploadSerializer,
     EmailFileListSerializer,
     EmailFileDetailSerializer,
+    UploadSessionSerializer,
 )
-from .tasks import process_uploaded_file, send_emails_for_file, send_email_record
+from . import chunked_upload, progress
+from .tasks import attachment_downloads, process_uploaded_file, send_emails_for_file, send_email_record
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +35,7 @@ class EmailFileUploadView(generics.CreateAPIView):
     def perform_create(self, serializer):
         file_instance = serializer.save(user=self.request.user)
         try:
+            progress.reset(file_instance.id)
             process_uploaded_file.delay(file_instance.id)
         except Exception:
             logger.exception("Failed to queue file processing task")
@@ -41,6 +49,127 @@ class EmailFileUploadView(generics.CreateAPIView):
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+# ----------------------------------------
+# Chunked upload: init → PUT chunks (in order) → complete
+# Chunks stream straight to MEDIA_ROOT/uploads/; the EmailFile is created
+# and parsing queued only after the SHA-256 of the whole file matches
+# ----------------------------------------
+_CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class UploadSessionCreateView(generics.CreateAPIView):
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+
+class UploadSessionChunkView(views.APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        """Session status; `received_bytes` is where an interrupted upload resumes."""
+        session = get_object_or_404(UploadSession, id=pk, user=request.user)
+        return Response(UploadSessionSerializer(session).data)
+
+    def put(self, request, pk):
+        """
+        Append one chunk. Raw bytes in the body, position in
+        `Content-Range: bytes <start>-<end>/<total>`; start must equal received_bytes.
+        """
+        session = get_object_or_404(UploadSession, id=pk, user=request.user)
+        if session.status != UploadSession.STATUS_OPEN:
+            return Response({"detail": "Upload already completed."}, status=status.HTTP_409_CONFLICT)
+
+        match = _CONTENT_RANGE_RE.fullmatch(request.headers.get('Content-Range', '').strip())
+        if not match:
+            return Response(
+                {"detail": "Content-Range header required: bytes <start>-<end>/<total>."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        start, end, total = (int(v) for v in match.groups())
+        length = end - start + 1
+        if total != session.total_size or length <= 0 or end >= total:
+            return Response({"detail": "Content-Range does not match this upload."}, status=status.HTTP_400_BAD_REQUEST)
+        if length > chunked_upload.UPLOAD_CHUNK_SIZE:
+            return Response(
+                {"detail": f"Chunks are limited to {chunked_upload.UPLOAD_CHUNK_SIZE} bytes."},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        if request.META.get('CONTENT_LENGTH') != str(length):
+            return Response({"detail": "Content-Length must equal the Content-Range length."}, status=status.HTTP_400_BAD_REQUEST)
+        if start != session.received_bytes:
+            return Response(
+                {"detail": "Chunk out of order.", "received_bytes": session.received_bytes},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        # Raw request stream: the chunk is copied to disk block by block, never parsed
+        written = chunked_upload.write_chunk(session, request.stream, start, length)
+        updated = (
+            UploadSession.objects
+            .filter(id=session.id, status=UploadSession.STATUS_OPEN, received_bytes=start)
+            .update(received_bytes=start + written, updated_at=timezone.now())
+        )
+        if not updated:
+            session.refresh_from_db()
+            return Response(
+                {"detail": "Chunk out of order.", "received_bytes": session.received_bytes},
+                status=status.HTTP_409_CONFLICT
+            )
+        if written < length:
+            return Response(
+                {"detail": "Incomplete chunk.", "received_bytes": start + written},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({"received_bytes": start + written, "total_size": session.total_size})
+
+    def delete(self, request, pk):
+        """Abandon an open upload and remove its partial file."""
+        session = get_object_or_404(UploadSession, id=pk, user=request.user, status=UploadSession.STATUS_OPEN)
+        chunked_upload.discard(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionCompleteView(views.APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), id=pk, user=request.user)
+            if session.status == UploadSession.STATUS_COMPLETED:
+                serializer = EmailFileUploadSerializer(session.email_file, context={'request': request})
+                return Response(serializer.data, status=status.HTTP_200_OK)
+            if session.received_bytes != session.total_size:
+                return Response(
+                    {"detail": "Upload is incomplete.", "received_bytes": session.received_bytes},
+                    status=status.HTTP_409_CONFLICT
+                )
+
+            # The checksum is verified by the ingest task, off the request and
+            # outside this lock (hashing up to UPLOAD_MAX_BYTES takes seconds)
+            email_file = EmailFile.objects.create(
+                user=request.user,
+                title=session.title,
+                file=chunked_upload.promote(session),
+                archive_to_sent=session.archive_to_sent,
+            )
+            session.status = UploadSession.STATUS_COMPLETED
+            session.email_file = email_file
+            session.save(update_fields=['status', 'email_file', 'updated_at'])
+
+        try:
+            progress.reset(email_file.id)
+            process_uploaded_file.delay(email_file.id)
+        except Exception:
+            logger.exception("Failed to queue file processing task")
+            raise
+        serializer = EmailFileUploadSerializer(email_file, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
 # ----------------------------------------
 # List Uploaded Files (for current user) + counts
 # ----------------------------------------
@@ -79,8 +208,66 @@ class EmailFileDetailView(generics.RetrieveAPIView):
                 total_count=Count('email_records'),
                 sent_count=Count('email_records', filter=Q(email_records__is_sent=True)),
             )
-            .prefetch_related('email_records')
+            .select_related('content')
+            # Records' contents are prefetched once per distinct content (the default
+            # plus any per-row overrides), not joined per record: the shared body is
+            # read once and an override's body never costs a query per record
+            .prefetch_related('email_records__content')
+        )
+
+
+# ----------------------------------------
+# Ingestion progress for a file (cache-backed, no record queries)
+# ----------------------------------------
+class EmailFileProgressView(views.APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        if not EmailFile.objects.filter(id=pk, user=request.user).exists():
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"file_id": pk, **progress.get_progress(pk)})
+
+
+# ----------------------------------------
+# Download rejected rows (invalid / duplicate / missing email) as CSV
+# ----------------------------------------
+class _Echo:
+    """File-like object whose write() returns the line, for streaming csv.writer output."""
+    def write(self, value):
+        return value
+
+
+class EmailFileRejectedRowsView(views.APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        email_file = get_object_or_404(EmailFile, id=pk, user=request.user)
+        rows = (
+            RejectedRow.objects
+            .filter(file=email_file)
+            .order_by('row_number', 'id')
+            .values_list('row_number', 'name', 'email', 'reason')
         )
+        writer = csv.writer(_Echo())
+
+        def stream():
+            yield writer.writerow(['Row', 'Name', 'Email', 'Reason'])
+            for row_number, name, email, reason in rows.iterator(chunk_size=2000):
+                yield writer.writerow([row_number or '', name, email, reason])
+
+        response = StreamingHttpResponse(stream(), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="file_{email_file.id}_rejected_rows.csv"'
+        return response
+
+
+# ----------------------------------------
+# Attachment download cache: hit/miss counters + size (admin only)
+# ----------------------------------------
+class AttachmentCacheStatsView(views.APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(attachment_downloads.stats())
 
 
 # ----------------------------------------
@@ -101,6 +288,19 @@ class SendAllEmailsView(views.APIView):
 
     def post(self, request, pk):
         email_file = get_object_or_404(EmailFile, id=pk, user=request.user)
+
+        # Optional per-campaign override of records per send task (kept for later sends)
+        batch_size = request.data.get('batch_size')
+        if batch_size not in (None, ''):
+            try:
+                batch_size = int(batch_size)
+            except (TypeError, ValueError):
+                batch_size = 0
+            if not 1 <= batch_size <= 1000:
+                return Response({"error": "batch_size must be between 1 and 1000."}, status=status.HTTP_400_BAD_REQUEST)
+            email_file.send_batch_size = batch_size
+            email_file.save(update_fields=['send_batch_size'])
+
         try:
             send_emails_for_file.delay(email_file.id)
             return Response({"message": "Email sending initiated."}, status=status.HTTP_202_ACCEPTED)
@@ -123,6 +323,11 @@ class SendSingleEmailView(views.APIView):
                 {"detail": "Email already sent."},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        if email_record.is_claimed:
+            return Response(
+                {"detail": "Email is being sent."},
+                status=status.HTTP_409_CONFLICT
+            )
 
         try:
             send_email_record.delay(email_record.id)